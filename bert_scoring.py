@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from bert_score import BERTScorer
+from bert_score.utils import get_bert_embedding, greedy_cos_idf
+
+# BERTScore of generated labels against reference labels, as BERTScorer(lang="en", rescale_with_baseline=True)
+# gives it, without reloading the model for every call or scoring one pair at a time:
+# - get_scorer returns one scorer per setting for the whole session (and training run)
+# - sentences are embedded in batches of similar token length, pairs are matched in batches of similar length
+# - embeddings of the references, which never change across models and epochs, are cached in memory and
+#   on disk (cache_dir), so scoring another file of generated labels only embeds the generated labels
+# - a whole file of generated labels is scored in one call
+
+_scorers = {}
+
+
+def get_scorer(lang='en', rescale_with_baseline=True, cache_dir='.bert_score_cache', **kwargs):
+    # the scorer of these settings, built (and the model loaded) on the first call only
+    key = (lang, rescale_with_baseline, cache_dir, tuple(sorted(kwargs.items())))
+    if key not in _scorers:
+        _scorers[key] = CachedScorer(BERTScorer(lang=lang, rescale_with_baseline=rescale_with_baseline, **kwargs),
+                                     cache_dir)
+    return _scorers[key]
+
+
+def score(cands, refs, **kwargs):
+    # P, R, F1 of each candidate against its reference, with the shared scorer of the settings in kwargs
+    return get_scorer(**kwargs).score(cands, refs)
+
+
+class CachedScorer(object):
+    def __init__(self, scorer, cache_dir=None, batch_size=64):
+        # idf weights depend on the scored corpus, so only the default (idf=False) embeddings are cached
+        assert not scorer.idf, 'embeddings with idf weights are not cached'
+        assert not scorer.all_layers, 'only the scores of one layer are supported'
+        self.scorer = scorer
+        self.batch_size = batch_size
+        self.idf_dict = defaultdict(lambda: 1.0)
+        self.idf_dict[scorer._tokenizer.sep_token_id] = 0
+        self.idf_dict[scorer._tokenizer.cls_token_id] = 0
+        self.cache_path = os.path.join(cache_dir, scorer.hash.replace('/', '_') + '.pt') if cache_dir else None
+        self.references = {}
+        if self.cache_path and os.path.exists(self.cache_path):
+            self.references = torch.load(self.cache_path)
+
+    def embed(self, sentences):
+        # embedding and idf weights of each (unique) sentence, unpadded, in batches of similar length
+        lengths = {s: len(self.scorer._tokenizer.tokenize(s)) for s in set(sentences)}
+        ordered = sorted(lengths, key=lengths.get, reverse=True)
+        stats = {}
+        for i in range(0, len(ordered), self.batch_size):
+            batch = ordered[i:i + self.batch_size]
+            embs, masks, padded_idf = get_bert_embedding(batch, self.scorer._model, self.scorer._tokenizer,
+                                                         self.idf_dict, device=self.scorer.device,
+                                                         all_layers=self.scorer.all_layers)
+            embs = embs.cpu()
+            masks = masks.cpu()
+            padded_idf = padded_idf.cpu()
+            for j, sen in enumerate(batch):
+                sequence_len = masks[j].sum().item()
+                stats[sen] = (embs[j, :sequence_len], padded_idf[j, :sequence_len])
+        return stats
+
+    def reference_stats(self, refs):
+        missing = [r for r in set(refs) if r not in self.references]
+        if missing:
+            self.references.update(self.embed(missing))
+            self.save()
+        return self.references
+
+    def save(self):
+        if self.cache_path:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            torch.save(self.references, self.cache_path + '.tmp')
+            os.replace(self.cache_path + '.tmp', self.cache_path)
+
+    def score(self, cands, refs):
+        # P, R, F1 tensors in the order of the pairs, as BERTScorer.score(cands, refs)
+        cands = list(cands)
+        refs = list(refs)
+        ref_stats = self.reference_stats(refs)
+        cand_stats = self.embed(cands)
+        device = self.scorer.device
+
+        def pad_batch_stats(sentences, stats):
+            emb, idf = zip(*[stats[s] for s in sentences])
+            lens = torch.tensor([e.size(0) for e in emb])
+            emb_pad = pad_sequence([e.to(device) for e in emb], batch_first=True, padding_value=2.0)
+            idf_pad = pad_sequence([i.to(device) for i in idf], batch_first=True)
+            pad_mask = (torch.arange(int(lens.max())).expand(len(lens), -1) < lens.unsqueeze(1)).to(device)
+            return emb_pad, pad_mask, idf_pad
+
+        # pairs of similar length are matched together, so little of each batch is padding
+        order = sorted(range(len(cands)), key=lambda i: (ref_stats[refs[i]][0].size(0), cand_stats[cands[i]][0].size(0)))
+        preds = torch.zeros((len(cands), 3))
+        with torch.no_grad():
+            for i in range(0, len(order), self.batch_size):
+                batch = order[i:i + self.batch_size]
+                P, R, F1 = greedy_cos_idf(*pad_batch_stats([refs[j] for j in batch], ref_stats),
+                                          *pad_batch_stats([cands[j] for j in batch], cand_stats),
+                                          self.scorer.all_layers)
+                preds[batch] = torch.stack((P, R, F1), dim=-1).cpu()
+        if self.scorer.rescale_with_baseline:
+            preds = (preds - self.scorer.baseline_vals) / (1 - self.scorer.baseline_vals)
+        return preds[..., 0], preds[..., 1], preds[..., 2]
+
+
+class ScoringPipeline(object):
+    # scores batches of generated labels on a worker thread while the next batches are generated:
+    # put() hands a batch over through a bounded queue (blocking once max_queue batches wait, so
+    # generation never runs far ahead), and the scores are written into per-sample tensors and
+    # running sums as batches complete
+    def __init__(self, scorer, n_samples, max_queue=4):
+        self.scorer = scorer
+        self.batches = queue.Queue(maxsize=max_queue)
+        self.preds = torch.zeros((n_samples, 3))
+        self.sums = torch.zeros(3, dtype=torch.float64)
+        self.count = 0
+        self.error = None
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def run(self):
+        while True:
+            item = self.batches.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            indices, cands, refs = item
+            try:
+                P, R, F1 = self.scorer.score(cands, refs)
+            except Exception as e:
+                self.error = e
+                continue
+            scores = torch.stack((P, R, F1), dim=-1)
+            self.preds[indices] = scores
+            self.sums += scores.sum(dim=0, dtype=torch.float64)
+            self.count += len(indices)
+
+    def put(self, indices, cands, refs):
+        self.batches.put((list(indices), list(cands), list(refs)))
+
+    def mean(self):
+        # P, R, F1 means of the samples scored so far
+        return tuple((self.sums / max(self.count, 1)).float())
+
+    def close(self):
+        # wait for the queued batches, and return the per-sample P, R, F1
+        self.batches.put(None)
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
+        return self.preds[:, 0], self.preds[:, 1], self.preds[:, 2]
+
+
+def generate_and_score(engine, documents, references, scorer=None, max_queue=4):
+    # generate the labels of documents with an inference.InferenceEngine and score them against references,
+    # scoring each batch while the next ones are generated; returns the labels and the per-sample P, R, F1
+    if scorer is None:
+        scorer = get_scorer()
+    labels = [None] * len(documents)
+    pipeline = ScoringPipeline(scorer, len(documents), max_queue)
+    try:
+        for batch, batch_labels in engine.stream_batches(documents):
+            for i, label in zip(batch, batch_labels):
+                labels[i] = label
+            pipeline.put(batch, batch_labels, [references[i] for i in batch])
+    finally:
+        P, R, F1 = pipeline.close()
+    return labels, (P, R, F1)
+
+
+def main(argv=None):
+    # score files of generated labels (one label per line) against the same references, i.e. every model variant
+    parser = argparse.ArgumentParser(description='BERTScore of generated label files against reference labels')
+    parser.add_argument('references', help="JSON dataset of the reference labels, i.e. ./data/train_test_labeled_dataset.json")
+    parser.add_argument('generated', nargs='+', help='files of generated labels, one per line')
+    parser.add_argument('--key', default='summary_test')
+    parser.add_argument('--cache-dir', default='.bert_score_cache')
+    args = parser.parse_args(argv)
+
+    with open(args.references, 'r') as f:
+        refs = json.load(f)[args.key]
+    scorer = get_scorer(lang='en', rescale_with_baseline=True, cache_dir=args.cache_dir)
+    print('file, P, R, F1, seconds')
+    for path in args.generated:
+        with open(path, 'r') as f:
+            cands = [line.rstrip() for line in f]
+        start = time.perf_counter()
+        P, R, F1 = scorer.score(cands, refs)
+        print('{}, {:.3f}, {:.3f}, {:.3f}, {:.2f}'.format(path, P.mean(), R.mean(), F1.mean(), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
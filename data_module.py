@@ -0,0 +1,418 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+# Data loading for the training notebooks (Pegasus.ipynb, Pegasus_Finetuned_and_Automatic_Evaluation.ipynb and
+# Pegasus_TML.ipynb). Most process fragments are short, so padding every sample to the longest document of the
+# corpus (padding=True) or to a fixed max_length spends most of the training compute on pad tokens:
+# - texts are tokenised once, unpadded, and the token ids cached on disk (cache_dir) as flat memory-mapped
+#   arrays (TokenArray), so a sample is a slice of the mapped file, shared by all processes reading it
+# - whole JSON dataset files are converted once per tokenizer (convert, load_tokenized), so a run with the
+#   same file and tokenizer neither parses, lowercases nor tokenises it again
+# - each batch is padded to its own longest sample by the collator (dynamic padding)
+# - LengthGroupedBatchSampler puts samples of similar length in the same batch, in a shuffled order of batches
+# - PaddingStats reports how much of the padded batches is padding, against fixed and random-batch padding
+#
+# python data_module.py ./data/masked_sent_train.json ./data/masked_sent_val.json --lowercase
+
+TOKENIZATION_VERSION = 2
+# labels padded with -100 are left out of the loss of the model
+LABEL_PAD_TOKEN_ID = -100
+
+
+def tokenizer_fingerprint(tokenizer):
+    # changes with the vocabulary, normalisation, special tokens and maximum length of the tokenizer, not with
+    # its path
+    key = hashlib.blake2b(digest_size=16)
+    key.update(repr((type(tokenizer).__name__, tokenizer.model_max_length)).encode())
+    if getattr(tokenizer, 'is_fast', False):
+        state = json.loads(tokenizer.backend_tokenizer.to_str())
+        # truncation and padding are set on the backend by the last call of the tokenizer
+        state.pop('truncation', None)
+        state.pop('padding', None)
+        key.update(json.dumps(state, sort_keys=True).encode())
+    else:
+        key.update(repr(sorted(tokenizer.get_vocab().items())).encode())
+    key.update(repr(sorted(tokenizer.special_tokens_map.items())).encode())
+    return key.hexdigest()
+
+
+class TokenArray(object):
+    # token id sequences stored flat, sequence i being ids[offsets[i]:offsets[i + 1]]; loaded from disk, both
+    # arrays are memory-mapped (copy-on-write), and a sequence is a tensor on the mapped pages, not a copy
+    def __init__(self, ids, offsets, path=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.path = path
+
+    @classmethod
+    def from_sequences(cls, sequences):
+        lengths = np.fromiter((len(x) for x in sequences), dtype=np.int64, count=len(sequences))
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids = np.fromiter((i for x in sequences for i in x), dtype=np.int32, count=int(offsets[-1]))
+        return cls(ids, offsets)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path + '.ids.npy', mmap_mode='c'), np.load(path + '.offsets.npy', mmap_mode='c'), path)
+
+    def save(self, path):
+        # the offsets are written last, so an interrupted save leaves no array behind that would be loaded
+        for suffix, array in [('.ids.npy', self.ids), ('.offsets.npy', self.offsets)]:
+            with open(path + suffix + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(path + suffix + '.tmp', path + suffix)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.ids[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getstate__(self):
+        # data loader workers map the saved arrays again rather than receive a copy of them
+        if self.path is not None:
+            return {'path': self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'ids' in state:
+            self.__dict__.update(state)
+        else:
+            self.__dict__.update(TokenArray.load(state['path']).__dict__)
+
+
+def sequence_lengths(sequences):
+    if isinstance(sequences, TokenArray):
+        return sequences.lengths
+    return np.array([len(x) for x in sequences], dtype=np.int64)
+
+
+def tokenize(texts, tokenizer, max_length=None, cache_dir=None, lowercase=False):
+    # token ids of each text as a TokenArray, unpadded and truncated to max_length (the model's maximum by
+    # default); every distinct text is tokenised once, and the result is cached in cache_dir, if given
+    texts = [x.lower() for x in texts] if lowercase else list(texts)
+    path = None
+    if cache_dir:
+        key = hashlib.blake2b(digest_size=16)
+        key.update(repr((TOKENIZATION_VERSION, tokenizer_fingerprint(tokenizer), max_length)).encode())
+        for text in texts:
+            key.update(text.encode() + b'\0')
+        path = os.path.join(cache_dir, key.hexdigest())
+        if os.path.exists(path + '.offsets.npy'):
+            return TokenArray.load(path)
+
+    unique = list(dict.fromkeys(texts))
+    encodings = tokenizer(unique, truncation=True, max_length=max_length)['input_ids']
+    ids = dict(zip(unique, encodings))
+    tokens = TokenArray.from_sequences([ids[text] for text in texts])
+
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tokens.save(path)
+        return TokenArray.load(path)
+    return tokens
+
+
+def convert(path, tokenizer, cache_dir='./cache/tokenized', lowercase=False, max_length=None):
+    # tokenises every field of a JSON dataset file that is a list of texts (i.e. 'document', 'summary_train')
+    # or of equally long lists of texts (the triplets of the triplet datasets, stored flat, width texts per row)
+    # and returns the directory of the fields; the directory is named by a hash of the file, the tokenizer and
+    # the settings, so it is converted again as soon as any of them changes
+    with open(path, 'rb') as f:
+        content = f.read()
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    key = hashlib.blake2b(repr((TOKENIZATION_VERSION, fingerprint, max_length, lowercase)).encode(), digest_size=16)
+    key.update(content)
+    store_dir = os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + '-' + key.hexdigest())
+    if os.path.exists(os.path.join(store_dir, 'meta.json')):
+        return store_dir
+
+    tmp_dir = store_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    fields = {}
+    for name, values in json.loads(content).items():
+        if not isinstance(values, list) or not values:
+            continue
+        if all(isinstance(x, str) for x in values):
+            width = 1
+            texts = values
+        elif (all(isinstance(x, list) and len(x) == len(values[0]) for x in values)
+              and all(isinstance(t, str) for x in values for t in x)):
+            width = len(values[0])
+            texts = [t for x in values for t in x]
+        else:
+            continue
+        tokens = tokenize(texts, tokenizer, max_length, lowercase=lowercase)
+        tokens.save(os.path.join(tmp_dir, name))
+        fields[name] = {'rows': len(values), 'width': width, 'tokens': int(tokens.offsets[-1])}
+    meta = {'version': TOKENIZATION_VERSION, 'tokenizer': fingerprint, 'tokenizer_name': tokenizer.name_or_path,
+            'max_length': max_length, 'lowercase': lowercase, 'source': path, 'fields': fields}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp_dir, store_dir)
+    return store_dir
+
+
+class TokenizedStore(object):
+    # the memory-mapped fields of a converted dataset file, i.e. store['document'] is a TokenArray
+    def __init__(self, store_dir, tokenizer=None):
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != TOKENIZATION_VERSION:
+            raise ValueError(store_dir + ' was converted by version ' + str(self.meta['version']) + ', not '
+                             + str(TOKENIZATION_VERSION))
+        if tokenizer is not None and self.meta['tokenizer'] != tokenizer_fingerprint(tokenizer):
+            raise ValueError(store_dir + ' was tokenised by another tokenizer (' + self.meta['tokenizer_name'] + ')')
+        self.store_dir = store_dir
+        self.fields = {}
+
+    def keys(self):
+        return self.meta['fields'].keys()
+
+    def width(self, name):
+        return self.meta['fields'][name]['width']
+
+    def __getitem__(self, name):
+        if name not in self.fields:
+            if name not in self.meta['fields']:
+                raise KeyError(name)
+            self.fields[name] = TokenArray.load(os.path.join(self.store_dir, name))
+        return self.fields[name]
+
+
+def load_tokenized(path, tokenizer, lowercase=False, max_length=None, cache_dir='./cache/tokenized'):
+    # the TokenizedStore of a JSON dataset file, converted on the first call with this file and tokenizer
+    return TokenizedStore(convert(path, tokenizer, cache_dir, lowercase, max_length), tokenizer)
+
+
+def pad(sequences, pad_value):
+    # a (batch size, longest sequence) tensor of the sequences, and its attention mask
+    length = max(len(x) for x in sequences)
+    padded = torch.full((len(sequences), length), pad_value, dtype=torch.long)
+    mask = torch.zeros((len(sequences), length), dtype=torch.long)
+    for i, x in enumerate(sequences):
+        padded[i, :len(x)] = torch.as_tensor(x, dtype=torch.long)
+        mask[i, :len(x)] = 1
+    return padded, mask
+
+
+class Seq2SeqDataset(Dataset):
+    # documents and their summaries as unpadded token ids (TokenArrays or lists of token ids), i.e. the masked
+    # sentences or the labeled dataset
+    def __init__(self, input_ids, labels):
+        self.input_ids = input_ids
+        self.labels = labels
+        self.lengths = sequence_lengths(input_ids)
+
+    @classmethod
+    def from_texts(cls, texts, labels, tokenizer, max_length=None, cache_dir=None):
+        return cls(tokenize(texts, tokenizer, max_length, cache_dir), tokenize(labels, tokenizer, max_length, cache_dir))
+
+    def field_lengths(self):
+        # token lengths of each padded field, for PaddingStats
+        return {'input_ids': self.lengths, 'labels': sequence_lengths(self.labels)}
+
+    def __getitem__(self, idx):
+        return {'input_ids': self.input_ids[idx], 'labels': self.labels[idx]}
+
+    def __len__(self):
+        return len(self.input_ids)
+
+
+class Seq2SeqCollator(object):
+    # pads a batch to its longest document and longest summary; the padding of the labels is ignored by the loss
+    def __init__(self, pad_token_id, label_pad_token_id=LABEL_PAD_TOKEN_ID):
+        self.pad_token_id = pad_token_id
+        self.label_pad_token_id = label_pad_token_id
+
+    def __call__(self, items):
+        input_ids, attention_mask = pad([x['input_ids'] for x in items], self.pad_token_id)
+        labels, _ = pad([x['labels'] for x in items], self.label_pad_token_id)
+        return {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': labels}
+
+
+class TripletDataset(Dataset):
+    # (anchor, positive, negative) sentences as unpadded token ids, from one or more groups of triplets stored
+    # flat (three sentences per triplet), i.e. the fields of a converted triplet dataset
+    def __init__(self, *groups):
+        self.groups = groups
+        sizes = [len(group) // 3 for group in groups]
+        self.group_idx = np.repeat(np.arange(len(groups)), sizes)
+        self.row_idx = np.concatenate([np.arange(size) for size in sizes]) if groups else np.zeros(0, dtype=np.int64)
+        self.sentence_lengths = (np.concatenate([sequence_lengths(group)[:3 * size].reshape(-1, 3)
+                                                 for group, size in zip(groups, sizes)])
+                                 if groups else np.zeros((0, 3), dtype=np.int64))
+        self.lengths = self.sentence_lengths.max(axis=1, initial=0)
+
+    @classmethod
+    def from_triplets(cls, triplets, tokenizer, max_length=50, cache_dir=None):
+        # a sentence shared by many triplets is tokenised once
+        return cls(tokenize([s for t in triplets for s in t], tokenizer, max_length, cache_dir))
+
+    def field_lengths(self):
+        return {name: self.sentence_lengths[:, i] for i, name in enumerate(['anchor', 'positive', 'negative'])}
+
+    def __getitem__(self, idx):
+        group = self.groups[self.group_idx[idx]]
+        row = 3 * int(self.row_idx[idx])
+        return group[row], group[row + 1], group[row + 2]
+
+    def __len__(self):
+        return len(self.row_idx)
+
+
+class TripletCollator(object):
+    # pads the anchors, positives and negatives of a batch each to their longest sentence
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, items):
+        batch = []
+        for sentences in zip(*items):
+            input_ids, attention_mask = pad(sentences, self.pad_token_id)
+            # dummy labels for the decoder part of Pegasus, which is left untrained by the triplet loss
+            batch.append({'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': input_ids.clone()})
+        return tuple(batch)  # anchor, positive, negative
+
+
+class LengthGroupedBatchSampler(Sampler):
+    # batches of batch_size samples of similar length: with shuffle, the samples are shuffled, cut into groups
+    # of group_size batches, sorted by length within each group, and the batches of all groups shuffled again,
+    # so every epoch sees other batches in another order; without shuffle, the samples are sorted by length
+    # without a seed, each pass draws its shuffle from the torch random generator, as DataLoader(shuffle=True)
+    # does; with a seed, the shuffle of a pass is set by the seed and set_epoch(), as in DistributedSampler
+    def __init__(self, lengths, batch_size, shuffle=True, group_size=50, seed=None, drop_last=False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.group_size = group_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, seed=0):
+        if self.shuffle:
+            rng = np.random.default_rng(seed)
+            order = rng.permutation(len(self.lengths))
+            group = self.batch_size * self.group_size
+            groups = [order[i:i + group] for i in range(0, len(order), group)]
+            # stable sort, longest first, within each group
+            order = np.concatenate([g[np.argsort(-self.lengths[g], kind='stable')] for g in groups]) if groups else order
+        else:
+            order = np.argsort(-self.lengths, kind='stable')
+        batches = [order[i:i + self.batch_size].tolist() for i in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        if self.seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            seed = (self.seed, self.epoch)
+        return iter(self.batches(seed))
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class PaddingStats(object):
+    # share of padding in the batches of a loader, field by field, against padding every sample to a fixed
+    # length (the longest sample, as padding=True did, unless fixed_length is given) and against dynamic
+    # padding of randomly drawn batches
+    def __init__(self, field_lengths, batches, batch_size, fixed_length=None, seed=0):
+        self.fields = {}
+        random_order = np.random.default_rng(seed).permutation(len(next(iter(field_lengths.values()))))
+        random_batches = [random_order[i:i + batch_size] for i in range(0, len(random_order), batch_size)]
+        for name, lengths in field_lengths.items():
+            lengths = np.asarray(lengths)
+            tokens = int(lengths.sum())
+            length = fixed_length or int(lengths.max())
+            self.fields[name] = {'tokens': tokens,
+                                 'padded_tokens': sum(int(lengths[b].max()) * len(b) for b in batches),
+                                 'random_padded_tokens': sum(int(lengths[b].max()) * len(b) for b in random_batches),
+                                 'fixed_padded_tokens': length * len(lengths)}
+
+    @classmethod
+    def from_loader(cls, loader, fixed_length=None):
+        sampler = loader.batch_sampler
+        return cls(loader.dataset.field_lengths(), sampler.batches(), sampler.batch_size, fixed_length)
+
+    def summary(self):
+        summary = {}
+        for name, x in self.fields.items():
+            summary[name] = {'tokens': x['tokens'],
+                             'padding': 1 - x['tokens'] / x['padded_tokens'],
+                             'random_padding': 1 - x['tokens'] / x['random_padded_tokens'],
+                             'fixed_padding': 1 - x['tokens'] / x['fixed_padded_tokens'],
+                             'saved': 1 - x['padded_tokens'] / x['fixed_padded_tokens']}
+        return summary
+
+    def __str__(self):
+        return '\n'.join(('{}: {tokens} tokens, padding {padding:.1%} (random batches {random_padding:.1%}, fixed '
+                          'length {fixed_padding:.1%}), {saved:.1%} fewer tokens than fixed length').format(name, **x)
+                         for name, x in self.summary().items())
+
+
+def grouped_loader(dataset, collate_fn, batch_size, shuffle, group_size=50, seed=None, num_workers=0):
+    # a data loader of length-grouped batches of the dataset, padded by collate_fn
+    batch_sampler = LengthGroupedBatchSampler(dataset.lengths, batch_size, shuffle, group_size, seed)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, num_workers=num_workers)
+
+
+def make_seq2seq_loader(texts, labels, tokenizer, batch_size, shuffle, max_length=None, cache_dir=None,
+                        group_size=50, seed=None, num_workers=0):
+    dataset = Seq2SeqDataset.from_texts(texts, labels, tokenizer, max_length, cache_dir)
+    return grouped_loader(dataset, Seq2SeqCollator(tokenizer.pad_token_id), batch_size, shuffle, group_size, seed,
+                       num_workers)
+
+
+def make_triplet_loader(triplets, tokenizer, batch_size, shuffle, max_length=50, cache_dir=None,
+                        group_size=50, seed=None, num_workers=0):
+    dataset = TripletDataset.from_triplets(triplets, tokenizer, max_length, cache_dir)
+    return grouped_loader(dataset, TripletCollator(tokenizer.pad_token_id), batch_size, shuffle, group_size, seed,
+                       num_workers)
+
+
+def main(argv=None):
+    # converts JSON dataset files ahead of training
+    from transformers import PegasusTokenizerFast
+    parser = argparse.ArgumentParser(description='tokenise JSON dataset files into memory-mapped token id arrays')
+    parser.add_argument('files', nargs='+', help='i.e. ./data/masked_sent_train.json ./data/triplet_train_dataset.json')
+    parser.add_argument('--model-name', default='google/pegasus-large')
+    parser.add_argument('--lowercase', action='store_true', help='as Pegasus.ipynb and Pegasus_TML.ipynb do')
+    parser.add_argument('--max-length', type=int, help='i.e. 50 for the triplet datasets')
+    parser.add_argument('--cache-dir', default='./cache/tokenized')
+    args = parser.parse_args(argv)
+
+    tokenizer = PegasusTokenizerFast.from_pretrained(args.model_name)
+    for path in args.files:
+        store = load_tokenized(path, tokenizer, args.lowercase, args.max_length, args.cache_dir)
+        print(store.store_dir)
+        for name, field in store.meta['fields'].items():
+            print('  {}: {rows} rows of {width}, {tokens} tokens'.format(name, **field))
+
+
+if __name__ == '__main__':
+    main()
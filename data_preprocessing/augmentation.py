@@ -0,0 +1,309 @@
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import time
+from collections import Counter
+from multiprocessing import Pool
+
+# Round-trip translation augmentation of the labeled training data (see notebooks/data_augmentation.ipynb):
+# every document and summary is translated to a pivot language with top-k sampling, and each sampled
+# translation back to English, giving n_samples paraphrases per text and pivot.
+# - the same text is translated once, however often it occurs in the data (task labels and summaries recur
+#   across the BPMAI models), and texts are translated in batches of similar length
+# - translations are kept in a SQLite cache keyed by (text, model, decoding parameters), so a re-run only
+#   translates the texts (or parameters) it has not seen before
+# - each pivot (German, Russian) is translated in its own worker process
+# - with level='activity', documents are split into their activity labels (the ", " they were joined with in
+#   corpus_builder.py), each distinct activity is translated once, most frequent first, and the augmented
+#   documents are recomposed from the round-trip variants of their activities
+# The models are the WMT19 single models of the notebook (facebook/wmt19-*), as ported to transformers.
+
+PIVOT_MODELS = {'de': ('facebook/wmt19-en-de', 'facebook/wmt19-de-en'),
+                'ru': ('facebook/wmt19-en-ru', 'facebook/wmt19-ru-en')}
+
+# as en2de.generate(..., beam=10, sampling=True, sampling_topk=10) in the notebook: 10 sampled translations
+FORWARD_PARAMS = {'do_sample': True, 'top_k': 10, 'num_return_sequences': 10, 'max_new_tokens': 512}
+# as de2en.translate(...): beam search with the default beam of 5
+BACKWARD_PARAMS = {'num_beams': 5, 'max_new_tokens': 512}
+
+_connections = {}
+
+
+class TranslationCache(object):
+    # translations by (model, decoding parameters, text); a text translated with sampling has all its
+    # sampled translations in one entry
+    # one connection per process, so the pivot workers share the cache file (sqlite serialises their writes)
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        key = (os.getpid(), path)
+        if key not in _connections:
+            conn = sqlite3.connect(path, timeout=60)
+            conn.execute('''CREATE TABLE IF NOT EXISTS translations (
+                                model TEXT,
+                                params TEXT,
+                                text TEXT,
+                                translations TEXT,
+                                PRIMARY KEY (model, params, text))''')
+            _connections[key] = conn
+        self.conn = _connections[key]
+
+    @staticmethod
+    def params_key(params):
+        return json.dumps(params, sort_keys=True)
+
+    def get_many(self, model, params, texts):
+        # the cached translations of texts, as a dict of the texts found
+        params = self.params_key(params)
+        found = {}
+        texts = list(texts)
+        # in chunks, under sqlite's limit of bound parameters
+        for i in range(0, len(texts), 500):
+            chunk = texts[i:i + 500]
+            rows = self.conn.execute('SELECT text, translations FROM translations WHERE model = ? AND params = ? '
+                                     'AND text IN (' + ', '.join('?' * len(chunk)) + ')', [model, params] + chunk)
+            found.update((text, json.loads(translations)) for text, translations in rows)
+        self.hits += len(found)
+        self.misses += len(texts) - len(found)
+        return found
+
+    def put_many(self, model, params, translations):
+        params = self.params_key(params)
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)',
+                                  [(model, params, text, json.dumps(t)) for text, t in translations.items()])
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class Translator(object):
+    # a transformers translation model, translating lists of texts in batches of similar length
+
+    def __init__(self, model_name, device='cpu', batch_size=16, max_length=512):
+        from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name).to(device)
+        self.model.eval()
+        self.device = device
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def translate(self, texts, params):
+        # a list of num_return_sequences translations of each text
+        import torch
+        n = params.get('num_return_sequences', 1)
+        lengths = [len(x) for x in self.tokenizer(texts, truncation=True, max_length=self.max_length)['input_ids']]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i], reverse=True)
+        translations = [None] * len(texts)
+        for i in range(0, len(order), self.batch_size):
+            batch = order[i:i + self.batch_size]
+            inputs = self.tokenizer([texts[j] for j in batch], truncation=True, max_length=self.max_length,
+                                    padding=True, return_tensors='pt').to(self.device)
+            with torch.no_grad():
+                outputs = self.model.generate(**inputs, **params)
+            decoded = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+            for k, j in enumerate(batch):
+                translations[j] = decoded[k * n:(k + 1) * n]
+        return translations
+
+
+def cached_translate(model_name, texts, params, cache, chunk_size=256, **kwargs):
+    # translations of the unique texts, only the ones missing from the cache are translated (and the model
+    # loaded), in the order given; they are cached every chunk_size texts, so an interrupted run keeps
+    # what it translated. Returns them as a dict and the number of texts translated
+    texts = list(dict.fromkeys(texts))
+    found = cache.get_many(model_name, params, texts) if cache is not None else {}
+    missing = [x for x in texts if x not in found]
+    translator = Translator(model_name, **kwargs) if missing else None
+    for i in range(0, len(missing), chunk_size):
+        chunk = missing[i:i + chunk_size]
+        translated = dict(zip(chunk, translator.translate(chunk, params)))
+        if cache is not None:
+            cache.put_many(model_name, params, translated)
+        found.update(translated)
+    return found, len(missing)
+
+
+def round_trip(job):
+    # the round-trip translations of texts through one pivot language, in a worker process
+    texts, forward_model, backward_model, forward_params, backward_params, cache_path, options = job
+    start = time.perf_counter()
+    if options.get('threads') or options.get('seed') is not None:
+        import torch
+        if options.get('threads'):
+            torch.set_num_threads(options['threads'])
+        if options.get('seed') is not None:
+            torch.manual_seed(options['seed'])
+    cache = TranslationCache(cache_path) if cache_path else None
+    kwargs = {k: options[k] for k in ['device', 'batch_size', 'max_length'] if k in options}
+    forward, n_forward = cached_translate(forward_model, texts, forward_params, cache, **kwargs)
+    pivots = [p for x in texts for p in forward[x]]
+    backward, n_backward = cached_translate(backward_model, pivots, backward_params, cache, **kwargs)
+    # the first (best) back-translation of each sampled translation
+    results = {x: [backward[p][0] for p in forward[x]] for x in texts}
+    stats = {'translated': n_forward, 'back_translated': n_backward, 'pivot_texts': len(set(pivots)),
+             'seconds': time.perf_counter() - start}
+    if cache is not None:
+        stats.update(cache.stats())
+    return results, stats
+
+
+def split_activities(document):
+    # the activity labels of a document, as joined by ", ".join in corpus_builder.py
+    return document.split(', ')
+
+
+def frequency_schedule(texts):
+    # the distinct texts, most frequent first (ties in order of appearance), so that the texts shared by the most
+    # documents are translated (and cached) first
+    return [x for x, _ in Counter(texts).most_common()]
+
+
+def translation_words(texts):
+    # the words of the distinct texts, i.e. what translating them costs
+    return sum(len(x.split()) for x in set(texts))
+
+
+def clean_variant(activity, variant):
+    # a round-trip translation of an activity label in the form of the label: lowercase if the label is,
+    # without the full stop the translation models add, and without the ", " that joins the activities
+    variant = variant.strip().replace(', ', ' ')
+    if variant.endswith('.') and not activity.endswith('.'):
+        variant = variant[:-1]
+    if activity == activity.lower():
+        variant = variant.lower()
+    return variant
+
+
+def activity_variants(activities, results):
+    # the label and its distinct round-trip translations through all pivots, for each activity
+    variants = {}
+    for a in activities:
+        variants[a] = list(dict.fromkeys([a] + [clean_variant(a, v) for translations, _ in results
+                                                for v in translations[a] if v.strip()]))
+    return variants
+
+
+def compose(activities, variants, n_compose, rng):
+    # up to n_compose distinct documents made of a variant of each activity, other than the original document
+    choices = [variants[a] for a in activities]
+    n_compose = min(n_compose, math.prod(len(c) for c in choices) - 1)
+    seen = set()
+    documents = []
+    while len(documents) < n_compose:
+        combination = tuple(rng.randrange(len(c)) for c in choices)
+        if not any(combination) or combination in seen:
+            continue
+        seen.add(combination)
+        documents.append(', '.join(c[i] for c, i in zip(choices, combination)))
+    return documents
+
+
+def run_pivots(texts, pivots, n_samples, cache_path, n_workers, options, pivot_models):
+    # the round-trip translations of texts through each pivot, with their statistics
+    forward_params = dict(FORWARD_PARAMS, num_return_sequences=n_samples)
+    jobs = [(texts, pivot_models[p][0], pivot_models[p][1], forward_params, BACKWARD_PARAMS, cache_path, options)
+            for p in pivots]
+    n_workers = len(pivots) if n_workers is None else n_workers
+    if n_workers > 1:
+        with Pool(min(n_workers, len(jobs))) as pool:
+            results = pool.map(round_trip, jobs, chunksize=1)
+    else:
+        results = [round_trip(job) for job in jobs]
+    return results
+
+
+def augment(documents, summaries, pivots=('de', 'ru'), n_samples=10, cache_path='translations.sqlite',
+            n_workers=None, batch_size=16, max_length=512, device='cpu', threads=None, seed=0,
+            pivot_models=None, level='document', n_compose=10):
+    # the augmented training set, as aug_document_train and aug_summary_train of augmented_train_dataset.json:
+    # - level='document': for each document and summary pair, and each pivot, the n_samples pairs of their
+    #   round-trip translations
+    # - level='activity': for each pair, n_compose documents recomposed from the variants of its activities
+    #   (fewer if the activities have fewer combinations), each with one of the round-trip translations of the
+    #   summary in turn
+    # returns it and the statistics of each pivot, with the words translated at either level
+    if level not in ['document', 'activity']:
+        raise ValueError('level ' + level + ' is unknown!')
+    pivot_models = pivot_models or PIVOT_MODELS
+    options = {'batch_size': batch_size, 'max_length': max_length, 'device': device, 'threads': threads,
+               'seed': seed}
+    activities = [a for d in documents for a in split_activities(d)]
+    words = {'document_words': translation_words(list(documents) + list(summaries)),
+             'activity_words': translation_words(activities + list(summaries))}
+
+    augmented = {'aug_document_train': [], 'aug_summary_train': []}
+    if level == 'document':
+        texts = frequency_schedule(list(documents) + list(summaries))
+        results = run_pivots(texts, pivots, n_samples, cache_path, n_workers, options, pivot_models)
+        for d, s in zip(documents, summaries):
+            for translations, _ in results:
+                augmented['aug_document_train'] += translations[d]
+                augmented['aug_summary_train'] += translations[s]
+        n_texts = len(documents) + len(summaries)
+    else:
+        activity_set = set(activities)
+        texts = frequency_schedule(activities) + [s for s in frequency_schedule(summaries) if s not in activity_set]
+        results = run_pivots(texts, pivots, n_samples, cache_path, n_workers, options, pivot_models)
+        variants = activity_variants(activity_set, results)
+        rng = random.Random(seed)
+        for d, s in zip(documents, summaries):
+            summary_variants = [v for translations, _ in results for v in translations[s]] or [s]
+            for k, document in enumerate(compose(split_activities(d), variants, n_compose, rng)):
+                augmented['aug_document_train'].append(document)
+                augmented['aug_summary_train'].append(summary_variants[k % len(summary_variants)])
+        n_texts = len(activities) + len(summaries)
+
+    stats = {p: dict(stats, texts=n_texts, unique_texts=len(texts), **words) for p, (_, stats) in zip(pivots, results)}
+    return augmented, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='round-trip translation augmentation of the labeled training data')
+    parser.add_argument('data', help="labeled dataset, i.e. '../data/train_test_labeled_dataset.json'")
+    parser.add_argument('--output', default='files/augmented_train_dataset.json')
+    parser.add_argument('--pivots', nargs='+', default=['de', 'ru'], choices=sorted(PIVOT_MODELS))
+    parser.add_argument('--n-samples', type=int, default=10, help='sampled translations per text and pivot')
+    parser.add_argument('--level', default='document', choices=['document', 'activity'],
+                        help='translate whole documents, or each activity label once and recompose the documents')
+    parser.add_argument('--n-compose', type=int, default=10, help='recomposed documents per document (activity level)')
+    parser.add_argument('--cache', default='cache/translations.sqlite', help="translation cache, or '' for none")
+    parser.add_argument('--workers', type=int, help='processes, by default one per pivot')
+    parser.add_argument('--threads', type=int, help='CPU threads of each process')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--max-length', type=int, default=512)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with open(args.data, 'r') as f:
+        data = json.load(f)
+    if args.cache and os.path.dirname(args.cache):
+        os.makedirs(os.path.dirname(args.cache), exist_ok=True)
+    start = time.perf_counter()
+    augmented, stats = augment(data['document_train'], data['summary_train'], args.pivots, args.n_samples,
+                               args.cache or None, args.workers, args.batch_size, args.max_length, args.device,
+                               args.threads, args.seed, level=args.level, n_compose=args.n_compose)
+    print('pivot, texts, unique texts, translated, pivot texts, back-translated, cache hits, seconds')
+    for p, s in stats.items():
+        print('{}, {}, {}, {}, {}, {}, {}, {:.1f}'.format(p, s['texts'], s['unique_texts'], s['translated'],
+                                                          s['pivot_texts'], s['back_translated'], s.get('hits', 0),
+                                                          s['seconds']))
+    s = next(iter(stats.values()))
+    print('words to translate: {} by document, {} by activity ({:.1%} saved)'.format(
+        s['document_words'], s['activity_words'], 1 - s['activity_words'] / max(s['document_words'], 1)))
+    print('{} augmented pairs in {:.1f}s'.format(len(augmented['aug_document_train']), time.perf_counter() - start))
+    with open(args.output + '.tmp', 'w') as f:
+        json.dump(augmented, f)
+    os.replace(args.output + '.tmp', args.output)
+
+
+if __name__ == '__main__':
+    main()
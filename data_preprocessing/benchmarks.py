@@ -0,0 +1,282 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+import tempfile
+import tracemalloc
+from corpus_builder import build_corpus, extract_model
+from masking import default_strategy, masking_strategies
+from meta_index import update_index, query_models
+from processing_functions import load_JSON, reverse_follows, sort_process_flows
+from shape_parser import parse_shapes
+
+models_path = '../thesis_data/data/bpmai/models/'
+min_task = 5
+
+
+def largest_models(model_ids, n):
+    # the n biggest model files, which dominate the build time
+    sizes = {m: os.path.getsize(models_path + m + '.json') for m in model_ids}
+    return sorted(sizes, key=sizes.get, reverse=True)[:n]
+
+
+def load_graph(file_num):
+    results = load_JSON(models_path + file_num + '.json')
+    return results[0], results[1]
+
+
+def fan_in_regex(shapes, directly_follows):
+    # counting as done before: one regex match per shape and edge
+    counts = {}
+    for s in shapes:
+        count = 0
+        for f in directly_follows.values():
+            count += sum(1 if re.match(s, x) else 0 for x in f)
+        counts[s] = count
+    return counts
+
+
+def fan_in_index(shapes, directly_follows):
+    preceding = reverse_follows(directly_follows)
+    return {s: len(preceding.get(s, [])) for s in shapes}
+
+
+def benchmark_fan_in(model_ids, n_models, repeat):
+    print('model, shapes, edges, regex (ms), index (ms), speedup, miscounted shapes')
+    total_regex = 0.
+    total_index = 0.
+    for file_num in largest_models(model_ids, n_models):
+        try:
+            shapes_id, directly_follows = load_graph(file_num)
+        except Exception:
+            continue
+        # the shapes whose fan-in is counted when building the corpus
+        shapes = [s for s, stencil in shapes_id.items()
+                  if stencil.endswith('Gateway') or stencil in ['Task', 'CollapsedSubprocess', 'Subprocess']
+                  or stencil.startswith('End')]
+        edges = sum(len(f) for f in directly_follows.values())
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            old = fan_in_regex(shapes, directly_follows)
+        time_regex = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        for _ in range(repeat):
+            new = fan_in_index(shapes, directly_follows)
+        time_index = (time.perf_counter() - start) / repeat
+
+        # prefix matches of one resource id on another are counted by the regex, not the index
+        miscounted = sum(1 for s in shapes if old[s] != new[s])
+        total_regex += time_regex
+        total_index += time_index
+        print('{}, {}, {}, {:.2f}, {:.2f}, {:.0f}x, {}'.format(file_num, len(shapes), edges, time_regex * 1000,
+                                                            time_index * 1000, time_regex / max(time_index, 1e-9), miscounted))
+    print('total: regex {:.1f} ms, index {:.1f} ms'.format(total_regex * 1000, total_index * 1000))
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def recursive_sort_process_flows(budget):
+    # the former recursive sort_process_flows, aborted after budget calls instead of exploding on loops
+    calls = [0]
+
+    def sort(flow, directly_follows, shapes_wanted, gateways_count, temp_closing_count, preceding=None):
+        calls[0] += 1
+        if calls[0] > budget:
+            raise BudgetExceeded()
+        process_flow = []
+
+        for flow_object in flow:
+            if flow_object in shapes_wanted and flow_object not in temp_closing_count.keys():
+                process_flow.append(flow_object)
+
+            if flow_object in gateways_count.keys() and flow_object not in temp_closing_count.keys():
+                process_flow.append(flow_object)
+
+            if flow_object in temp_closing_count.keys():
+                count = temp_closing_count[flow_object]-1
+                temp_closing_count.update({flow_object: count})
+                if temp_closing_count[flow_object] == 0:
+                    process_flow.append(flow_object)
+                else:
+                    continue
+
+            if flow_object in directly_follows.keys() and directly_follows[flow_object]:
+                flow = directly_follows[flow_object]
+                result = sort(flow, directly_follows, shapes_wanted, gateways_count, temp_closing_count)
+                process_flow = process_flow + result
+
+        return process_flow
+
+    return sort
+
+
+def timed(sort_flows, timings):
+    def sort(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return sort_flows(*args, **kwargs)
+        finally:
+            timings[-1] += time.perf_counter() - start
+    return sort
+
+
+def benchmark_sort(model_ids, n_models, budget):
+    recovered = []
+    mismatched = []
+    time_recursive = []
+    time_iterative = []
+    flow_length = {}
+    for file_num in model_ids:
+        time_recursive.append(0.)
+        time_iterative.append(0.)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            old, old_skipped = extract_model(file_num, models_path, timed(recursive_sort_process_flows(budget), time_recursive))[:2]
+            new, new_skipped = extract_model(file_num, models_path, timed(sort_process_flows, time_iterative))[:2]
+        if old_skipped and not new_skipped:
+            recovered.append((file_num, out.getvalue().splitlines()[0].split(' skipped: ')[-1]))
+        elif not old_skipped and old != new:
+            mismatched.append(file_num)
+        flow_length[file_num] = sum(len(data) for data, label in new[default_strategy])
+
+    print('models: ' + str(len(model_ids)))
+    print('recovered (skipped by the recursive sort): ' + str(len(recovered)))
+    for file_num, error in recovered:
+        print('    ' + file_num + ': ' + error)
+    # only loops can change the output: the recursive sort went round a loop again until a closing
+    # gateway count ran out, the iterative sort stops where the loop returns to the path
+    print('different output where the recursive sort succeeded (models with loops): ' + str(len(mismatched)))
+
+    print('deepest models - model, flow objects, recursive (ms), iterative (ms)')
+    timings = {m: (r, i) for m, r, i in zip(model_ids, time_recursive, time_iterative)}
+    for file_num in sorted(flow_length, key=flow_length.get, reverse=True)[:n_models]:
+        recursive = 'skipped' if file_num in dict(recovered) else '{:.2f}'.format(timings[file_num][0] * 1000)
+        print('{}, {}, {}, {:.2f}'.format(file_num, flow_length[file_num], recursive, timings[file_num][1] * 1000))
+    print('total: recursive {:.1f} ms, iterative {:.1f} ms'.format(sum(time_recursive) * 1000, sum(time_iterative) * 1000))
+
+
+def parse_model(file, mode):
+    if mode == 'json':
+        # the former load_JSON: raw string and full dict tree
+        with open(file, 'r') as f:
+            data = f.read()
+            return json.loads(data)
+    return parse_shapes(file)
+
+
+# run in a fresh interpreter that imports nothing else, so its peak RSS is the one of the parse mode
+PEAK_RSS_SCRIPT = """
+import json, resource, sys, time
+from shape_parser import parse_shapes
+mode, files = sys.argv[1], sys.argv[2:]
+start = time.perf_counter()
+for file in files:
+    if mode == 'json':
+        with open(file, 'r') as f:
+            shapes = json.loads(f.read())
+    elif mode == 'records':
+        shapes = parse_shapes(file)
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+try:
+    # ru_maxrss survives the exec of this interpreter on Linux, VmHWM does not
+    with open('/proc/self/status') as f:
+        peak = [int(x.split()[1]) for x in f if x.startswith('VmHWM')][0]
+except OSError:
+    pass
+print(time.perf_counter() - start, peak)
+"""
+
+
+def benchmark_parse(model_ids, n_models, repeat):
+    files = [models_path + m + '.json' for m in largest_models(model_ids, n_models)]
+    modes = ['json', 'records']
+    print('model, size (kB), ' + ', '.join(m + ' (ms), ' + m + ' peak (kB)' for m in modes))
+    for file in files:
+        row = [os.path.basename(file), '{:.0f}'.format(os.path.getsize(file) / 1024)]
+        for mode in modes:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                parse_model(file, mode)
+            elapsed = (time.perf_counter() - start) / repeat
+            tracemalloc.start()
+            parse_model(file, mode)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            row += ['{:.2f}'.format(elapsed * 1000), '{:.0f}'.format(peak / 1024)]
+        print(', '.join(row))
+
+    # peak RSS of parsing all the models in one process, as the corpus builder does
+    for mode in ['none'] + modes:
+        out = subprocess.run([sys.executable, '-c', PEAK_RSS_SCRIPT, mode] + files,
+                             capture_output=True, text=True, check=True).stdout.split()
+        print('{}: {:.1f} ms, peak RSS {} kB'.format(mode, float(out[0]) * 1000, out[1]))
+
+
+def benchmark_cache(model_ids, repeat):
+    # rebuilds of the corpus as after a change of the masking: without checkpoints, so every model is extracted
+    cache_dir = tempfile.mkdtemp(prefix='model_cache_')
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = build_corpus(model_ids, models_path)
+        print('no cache: {:.2f} s'.format(time.perf_counter() - start))
+        for run in ['cold'] + ['warm'] * repeat:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                corpus = build_corpus(model_ids, models_path, cache_dir=cache_dir)
+            stats = out.getvalue().splitlines()[-1]
+            print('{} cache: {:.2f} s, {}, same output: {}'.format(run, time.perf_counter() - start, stats, corpus == expected))
+        size = sum(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir))
+        print('cache size: {:.1f} MB for {} models'.format(size / 1024 ** 2, len(os.listdir(cache_dir))))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def benchmark_masking(model_ids):
+    # all masking strategies in one pass over the corpus, against one corpus build per strategy
+    strategies = list(masking_strategies)
+    separate = {}
+    start = time.perf_counter()
+    for name in strategies:
+        with contextlib.redirect_stdout(io.StringIO()):
+            separate.update(build_corpus(model_ids, models_path, strategies=[name])[0])
+    time_separate = time.perf_counter() - start
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        together = build_corpus(model_ids, models_path, strategies=strategies)[0]
+    time_together = time.perf_counter() - start
+    for name in strategies:
+        print('{}: {} flows, {} gap sentences'.format(name, len(together[name]['document']),
+                                                    sum(len(x.split(', ')) for x in together[name]['summary'])))
+    print('{} strategies: one build each {:.2f} s, one pass {:.2f} s, same output: {}'.format(
+        len(strategies), time_separate, time_together, separate == together))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks of the BPMAI preprocessing steps')
+    parser.add_argument('benchmark', choices=['fan_in', 'sort', 'parse', 'cache', 'masking'])
+    parser.add_argument('--models', type=int, default=20, help='number of the largest models to benchmark on')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--budget', type=int, default=10 ** 6, help='calls after which the recursive sort is given up')
+    args = parser.parse_args()
+
+    index_path = update_index(models_path)
+    model_ids = query_models(index_path, natural_language='en', modeling_language='bpmn20', min_task=min_task)
+    if args.benchmark == 'fan_in':
+        benchmark_fan_in(model_ids, args.models, args.repeat)
+    if args.benchmark == 'sort':
+        benchmark_sort(model_ids, args.models, args.budget)
+    if args.benchmark == 'parse':
+        benchmark_parse(model_ids, args.models, args.repeat)
+    if args.benchmark == 'cache':
+        benchmark_cache(model_ids, args.repeat)
+    if args.benchmark == 'masking':
+        benchmark_masking(model_ids)
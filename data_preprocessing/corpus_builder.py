@@ -0,0 +1,253 @@
+import json
+import os
+import re
+from multiprocessing import Pool
+from masking import FlowContext, default_strategy, masking_strategies
+from model_cache import ModelCache
+from processing_functions import load_model, reverse_follows, sort_process_flows, walk_model
+from shape_parser import loads_shapes
+
+# bump whenever the extraction changes, so stale checkpointed shards are rebuilt instead of reused
+EXTRACTION_VERSION = 5
+
+
+def extract_model(file_num, models_path, sort_flows=sort_process_flows, cache=None, strategies=(default_strategy,)):
+    # function that extracts both datasets of one model from a single parse and walk of its shapes:
+    # the masked flows with their gap sentences, per masking strategy, and the task labels of its subprocesses
+    # returns what was extracted and whether the model had to be skipped, per dataset
+    masked_flows = {name: [] for name in strategies}
+    subprocesses = []
+    file = models_path + file_num + '.json'
+    try:
+        results, errors = load_model(file, cache)
+    except Exception as e:
+        print(file_num + ' skipped: ' + repr(e))
+        return masked_flows, True, subprocesses, True
+
+    flows_skipped = False
+    try:
+        if 'flow' in errors:
+            raise errors['flow']
+        extract_masked_flows(results.get('flow', {}), masked_flows, sort_flows, strategies)
+    except Exception as e:
+        # print('file skipped - error occurred')
+        print(file_num + ' skipped: ' + repr(e))
+        flows_skipped = True
+
+    subprocesses_skipped = False
+    if 'subprocess' in errors:
+        print(file_num + ' subprocesses skipped: ' + repr(errors['subprocess']))
+        subprocesses_skipped = True
+    else:
+        subprocesses = list(results.get('subprocess', {}).items())
+
+    return masked_flows, flows_skipped, subprocesses, subprocesses_skipped
+
+
+def extract_fragments(model_json, sort_flows=sort_process_flows):
+    # function that returns the process text of each start event's sorted flow, unmasked, of a model
+    # given as a BPMAI JSON string, i.e. the fragments to be labeled by a trained model
+    shapes = loads_shapes(model_json)
+    if not shapes:
+        return []
+    flow_output = 'pools_and_lanes' if any(s.stencil == 'Pool' for s in shapes) else 'flow'
+    results, errors = walk_model(shapes, flow_output)
+    if 'flow' in errors:
+        raise errors['flow']
+    masked_flows = {'unmasked': []}
+    extract_masked_flows(results['flow'], masked_flows, sort_flows, ['unmasked'])
+    return [", ".join(data) for data, label in masked_flows['unmasked']]
+
+
+def extract_masked_flows(results, masked_flows, sort_flows=sort_process_flows, strategies=(default_strategy,)):
+    # function that appends the masked flows (document) and gap sentences (summary) of one model
+    # to masked_flows[name] for each masking strategy, from the flow results of load_model
+    # (same layout as the output of load_JSON); the flows are sorted once for all strategies
+    pools_and_lanes = False
+    if len(results) == 4:
+        pools_and_lanes = True
+        shapes_id = results[0]
+        directly_follows = results[1]
+        lanes = results[2]
+        pools = results[3]
+    else:
+        shapes_id = results[0]
+        directly_follows = results[1]
+        flows = results[2]
+
+    stencils = set()
+    tasks_subprocesses_id = set()
+    # pools_lanes_id = set()
+    start_events_id = set()
+    end_events_id = set()
+    int_events_id = set()
+    gateways_count = {}
+    closing_gateways_id = set()
+    shapes_unwanted_id = set()
+    tasks_subprocesses = ['Task', 'CollapsedSubprocess', 'Subprocess']
+    gateways = ['Exclusive_Databased_Gateway', 'InclusiveGateway', 'ParallelGateway']
+    shapes_unwanted = ['DataObject', 'ITSystem', 'TextAnnotation',
+                    'Association_Undirected', 'Association_Unidirectional', 'MessageFlow']
+
+    for s in shapes_id.keys():
+        stencils.add(shapes_id[s])
+        if re.match('(Start.)', shapes_id[s]):
+            start_events_id.add(s)
+        if re.match('(End.)', shapes_id[s]):
+            end_events_id.add(s)
+        if re.match('(Intermediate.)', shapes_id[s]):
+            int_events_id.add(s)
+        if shapes_id[s] in gateways:
+            gateways_count.update({s: len(directly_follows[s])})
+            if len(directly_follows[s]) == 1:
+                closing_gateways_id.add(s)
+        if shapes_id[s] in tasks_subprocesses:
+            tasks_subprocesses_id.add(s)
+        if shapes_id[s] in shapes_unwanted:
+            shapes_unwanted_id.add(s)
+
+    for f in directly_follows.copy():
+        if f in shapes_unwanted_id:
+            directly_follows.pop(f)
+        if f in directly_follows.keys() and directly_follows[f]:
+            for r in directly_follows[f]:
+                if r in shapes_unwanted_id:
+                    directly_follows[f].remove(r)
+
+    # fan-in of the closing gateways, tasks and end events, from the reverse adjacency of the flows
+    preceding = reverse_follows(directly_follows)
+    closing_gateways_tasks_count = {}
+    for g in closing_gateways_id:
+        closing_gateways_tasks_count[g] = len(preceding.get(g, []))
+
+    for t in tasks_subprocesses_id:
+        count = len(preceding.get(t, []))
+        if count > 1:
+            closing_gateways_tasks_count[t] = count
+
+    for e in end_events_id:
+        count = len(preceding.get(e, []))
+        if count > 1:
+            closing_gateways_tasks_count[e] = count
+
+    shapes_wanted = set.union(tasks_subprocesses_id, start_events_id, end_events_id, int_events_id)
+    temp_closing_count = closing_gateways_tasks_count.copy()
+    context = FlowContext(start_events_id, int_events_id, end_events_id, tasks_subprocesses_id, gateways_count,
+                          closing_gateways_id, lanes=lanes) if pools_and_lanes else \
+        FlowContext(start_events_id, int_events_id, end_events_id, tasks_subprocesses_id, gateways_count,
+                    closing_gateways_id, flows=flows)
+    masking = [(name, masking_strategies[name](context)) for name in strategies]
+    # walk the start events in model order, so the output does not depend on set (hash) ordering
+    for s in [x for x in shapes_id.keys() if x in start_events_id]:
+        flow = directly_follows[s]
+        # the reverse index of the model is shared by the sorts of all its start events
+        result = sort_flows(flow, directly_follows, shapes_wanted, gateways_count, temp_closing_count,
+                            preceding=preceding)
+        result.insert(0,s)
+        # every strategy masks the same sorted flow
+        for name, strategy in masking:
+            masked = strategy.mask(result)
+            if masked is not None:
+                masked_flows[name].append(masked)
+
+
+def new_dataset():
+    return {'document': [], 'summary': [], 'flows_extracted': [], 'models_skipped': []}
+
+
+def process_shard(shard):
+    # function that extracts all models of one shard and checkpoints the result to disk
+    # returns the extracted datasets and the hit/miss counts of the model cache
+    shard_num, model_ids, models_path, checkpoint_dir, cache_dir, cache_size, strategies = shard
+    if checkpoint_dir:
+        checkpoint = load_shard(checkpoint_dir, shard_num, model_ids, strategies)
+        if checkpoint is not None:
+            return checkpoint, None
+    cache = ModelCache(cache_dir, cache_size) if cache_dir else None
+
+    result = {'version': EXTRACTION_VERSION, 'model_ids': list(model_ids), 'strategies': list(strategies),
+              'masked': {name: new_dataset() for name in strategies}, 'subprocess': new_dataset()}
+    for file_num in model_ids:
+        masked_flows, flows_skipped, subprocesses, subprocesses_skipped = extract_model(
+            file_num, models_path, cache=cache, strategies=strategies)
+        for name in strategies:
+            dataset = result['masked'][name]
+            for data, label in masked_flows[name]:
+                dataset['document'].append(", ".join(data))
+                dataset['summary'].append(", ".join(label))
+                dataset['flows_extracted'].append(file_num)
+            if flows_skipped:
+                dataset['models_skipped'].append(file_num)
+        dataset = result['subprocess']
+        for name, labels in subprocesses:
+            dataset['document'].append(", ".join(labels))
+            dataset['summary'].append(name)
+            dataset['flows_extracted'].append(file_num)
+        if subprocesses_skipped:
+            dataset['models_skipped'].append(file_num)
+
+    if checkpoint_dir:
+        save_shard(checkpoint_dir, shard_num, result)
+    return result, cache.stats() if cache else None
+
+
+def shard_path(checkpoint_dir, shard_num):
+    return os.path.join(checkpoint_dir, 'shard_{:05d}.json'.format(shard_num))
+
+
+def save_shard(checkpoint_dir, shard_num, result):
+    # write to a temporary file first, so an interrupted run never leaves a half-written shard behind
+    path = shard_path(checkpoint_dir, shard_num)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(path + '.tmp', path)
+
+
+def load_shard(checkpoint_dir, shard_num, model_ids, strategies):
+    # return the checkpointed shard, or None if it is missing or was built from other model ids,
+    # masking strategies or code
+    path = shard_path(checkpoint_dir, shard_num)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        result = json.load(f)
+    if result.get('version') != EXTRACTION_VERSION or result['model_ids'] != list(model_ids) \
+            or result['strategies'] != list(strategies):
+        return None
+    return result
+
+
+def build_corpus(model_ids, models_path, n_workers=1, shard_size=200, checkpoint_dir=None,
+                 cache_dir=None, cache_size=2 * 1024 ** 3, strategies=(default_strategy,)):
+    # function that builds the masked sentences and the subprocess corpus, optionally in parallel and resumable
+    # shards are merged in model id order, so the output is the same for any number of workers
+    # with a cache_dir, the parsed models are cached, so a rebuild after a change of the masking
+    # (a new EXTRACTION_VERSION) only walks the flows again instead of decoding every model
+    # returns the masked sentences dataset of each masking strategy (see masking.masking_strategies)
+    # and the subprocess dataset; all of them come from one parse and sort of every model
+    model_ids = [str(x) for x in model_ids]
+    strategies = list(strategies)
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    shards = [(n, model_ids[i:i + shard_size], models_path, checkpoint_dir, cache_dir, cache_size, strategies)
+              for n, i in enumerate(range(0, len(model_ids), shard_size))]
+
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            results = pool.map(process_shard, shards, chunksize=1)
+    else:
+        results = [process_shard(shard) for shard in shards]
+
+    masked_datasets = {name: new_dataset() for name in strategies}
+    train_subprocess = new_dataset()
+    cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+    for result, stats in results:
+        for k in train_subprocess.keys():
+            for name in strategies:
+                masked_datasets[name][k] += result['masked'][name][k]
+            train_subprocess[k] += result['subprocess'][k]
+        for k in (stats or {}).keys():
+            cache_stats[k] += stats[k]
+    if cache_dir:
+        print('model cache: {hits} hits, {misses} misses, {evictions} evictions'.format(**cache_stats))
+    return masked_datasets, train_subprocess
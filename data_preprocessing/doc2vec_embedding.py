@@ -0,0 +1,297 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+# Doc2Vec embedding and 2-d projection of process fragments, for the distribution analysis of
+# human_evaluation/process_model_distribution/doc2vec_labeled_data.ipynb (training, test and augmented data),
+# as a stage that is run once rather than per data variant:
+# - the model is trained once, on the distinct documents of the given variants, in one call of gensim with
+#   corpus_file (one document per line), in which the workers do not share the GIL, and with the learning rate
+#   decayed linearly from alpha to min_alpha over all epochs, as the notebook's epoch loop intended
+# - the vectors of each variant are cached as a memory-mapped .npy file, with the keys of its documents:
+#   documents the model was trained on take their trained vector, any other (i.e. new augmented samples) is
+#   inferred with infer_vector in worker processes, and a variant that grew only infers its new documents
+# - the projection is Barnes-Hut t-SNE on the k nearest neighbours of each document (3 x perplexity, found by
+#   chunked matrix products after a PCA to 50 dimensions) instead of on all pairs, so it takes the full corpus
+#
+# Variants are given as name=file:key[,key...], the documents being texts or label lists (joined with ", ").
+# python doc2vec_embedding.py --workers 8 train train=../human_evaluation/process_model_distribution/files/new_train_test_labeled_dataset.json:document_train test=../human_evaluation/process_model_distribution/files/new_train_test_labeled_dataset.json:document_test
+# python doc2vec_embedding.py embed augmented=../human_evaluation/process_model_distribution/files/augmented_train_dataset_after_val.json:aug_document_train corpus=../data/masked_sent_train.json:document
+# python doc2vec_embedding.py project train test augmented
+
+# bump whenever the training or the caching changes, so stale models and vectors are not reused
+STAGE_VERSION = 1
+
+
+def linearise(document):
+    return document if isinstance(document, str) else ', '.join(document)
+
+
+def document_words(document):
+    # the words of a document as in the notebook: simple_preprocess of its text
+    from gensim.utils import simple_preprocess
+    return simple_preprocess(linearise(document))
+
+
+def document_keys(words):
+    # a 64-bit key of each document's words, documents with the same words sharing their vector
+    return np.array([int.from_bytes(hashlib.blake2b(' '.join(x).encode(), digest_size=8).digest(), 'little')
+                     for x in words], dtype=np.uint64)
+
+
+def read_variant(spec):
+    # (name, documents) of a variant given as name=file:key[,key...], the documents of the keys concatenated
+    name, source = spec.split('=', 1)
+    path, keys = source.rsplit(':', 1)
+    with open(path, 'r') as f:
+        data = json.load(f)
+    documents = []
+    for key in keys.split(','):
+        if key not in data:
+            raise ValueError('key ' + key + ' is not in ' + path + '!')
+        documents += data[key]
+    return name, [linearise(x) for x in documents]
+
+
+_worker_model = None
+
+
+def _load_worker_model(model_path):
+    # each inference worker maps the arrays of the saved model rather than receive a copy of them
+    global _worker_model
+    from gensim.models.doc2vec import Doc2Vec
+    _worker_model = Doc2Vec.load(model_path, mmap='r')
+
+
+def _infer_chunk(args):
+    words, epochs = args
+    return np.array([_worker_model.infer_vector(x, epochs=epochs) for x in words], dtype=np.float32).reshape(
+        len(words), _worker_model.vector_size)
+
+
+class Doc2VecStage(object):
+    # the model, corpus and cached vectors in directory:
+    # doc2vec.model, corpus.txt, meta.json, trained_keys.npy and vectors/<variant>.{npy,keys.npy,json}
+    def __init__(self, directory='./files/doc2vec'):
+        self.directory = directory
+        self.model_path = os.path.join(directory, 'doc2vec.model')
+        self.meta_path = os.path.join(directory, 'meta.json')
+        self.vectors_dir = os.path.join(directory, 'vectors')
+        self._model = None
+
+    @property
+    def meta(self):
+        if not os.path.exists(self.meta_path):
+            raise ValueError('no Doc2Vec model in ' + self.directory + ', run train first!')
+        with open(self.meta_path, 'r') as f:
+            return json.load(f)
+
+    @property
+    def model(self):
+        if self._model is None:
+            from gensim.models.doc2vec import Doc2Vec
+            self._model = Doc2Vec.load(self.model_path, mmap='r')
+        return self._model
+
+    def train(self, documents, vector_size=100, epochs=100, workers=None, dm=1, min_count=1, alpha=0.025,
+              min_alpha=0.00025, seed=41):
+        # trains the model on the distinct (non-empty) documents; the vectors cached for an earlier model are
+        # recomputed when next embedded
+        from gensim.models.doc2vec import Doc2Vec
+        words = [x for x in dict.fromkeys(tuple(document_words(x)) for x in documents) if x]
+        keys = document_keys(words)
+        params = {'vector_size': vector_size, 'epochs': epochs, 'dm': dm, 'min_count': min_count, 'alpha': alpha,
+                  'min_alpha': min_alpha, 'seed': seed}
+        model_key = hashlib.blake2b(repr((STAGE_VERSION, sorted(params.items()))).encode() + keys.tobytes(),
+                                    digest_size=16).hexdigest()
+
+        os.makedirs(self.directory, exist_ok=True)
+        corpus_path = os.path.join(self.directory, 'corpus.txt')
+        with open(corpus_path + '.tmp', 'w') as f:
+            f.write(''.join(' '.join(x) + '\n' for x in words))
+        os.replace(corpus_path + '.tmp', corpus_path)
+
+        start = time.perf_counter()
+        # with corpus_file, the tag of a document is its line number
+        model = Doc2Vec(corpus_file=corpus_path, workers=workers or os.cpu_count(), **params)
+        seconds = time.perf_counter() - start
+        # the model files are replaced before the meta, so an interrupted run is not mistaken for a trained model
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        model.save(self.model_path)
+        np.save(os.path.join(self.directory, 'trained_keys.npy'), keys)
+        with open(self.meta_path + '.tmp', 'w') as f:
+            json.dump({'version': STAGE_VERSION, 'model_key': model_key, 'documents': len(words),
+                       'seconds': seconds, **params}, f, indent=1)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+        self._model = None
+        return seconds
+
+    def embed(self, name, documents, workers=None, epochs=None, chunk_size=256):
+        # the vectors of the documents of a variant, memory-mapped from its cache; a document is looked up in the
+        # cache of the variant, else among the trained documents, else inferred
+        meta = self.meta
+        words = [document_words(x) for x in documents]
+        keys = document_keys(words)
+        path = os.path.join(self.vectors_dir, name)
+        vectors = np.zeros((len(documents), meta['vector_size']), dtype=np.float32)
+        todo = np.ones(len(documents), dtype=bool)
+        counts = {'cached': 0, 'trained': 0, 'inferred': 0}
+
+        if os.path.exists(path + '.json'):
+            with open(path + '.json', 'r') as f:
+                cached_meta = json.load(f)
+            if cached_meta['model_key'] == meta['model_key']:
+                counts['cached'] = self._copy_known(keys, np.load(path + '.keys.npy'), np.load(path + '.npy', mmap_mode='r'),
+                                                    vectors, todo)
+        trained_keys = np.load(os.path.join(self.directory, 'trained_keys.npy'))
+        counts['trained'] = self._copy_known(keys, trained_keys, self.model.dv.vectors, vectors, todo)
+
+        missing = np.flatnonzero(todo)
+        if len(missing):
+            chunks = [([words[i] for i in missing[j:j + chunk_size]], epochs)
+                      for j in range(0, len(missing), chunk_size)]
+            workers = min(workers or os.cpu_count(), len(chunks))
+            if workers > 1:
+                with Pool(workers, initializer=_load_worker_model, initargs=(self.model_path,)) as pool:
+                    inferred = pool.map(_infer_chunk, chunks)
+            else:
+                _load_worker_model(self.model_path)
+                inferred = [_infer_chunk(x) for x in chunks]
+            vectors[missing] = np.concatenate(inferred)
+            counts['inferred'] = len(missing)
+
+        # the keys and vectors are replaced before the meta that validates them
+        os.makedirs(self.vectors_dir, exist_ok=True)
+        if os.path.exists(path + '.json'):
+            os.remove(path + '.json')
+        for suffix, array in [('.npy', vectors), ('.keys.npy', keys)]:
+            with open(path + suffix + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(path + suffix + '.tmp', path + suffix)
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump({'model_key': meta['model_key'], 'documents': len(documents), **counts}, f)
+        os.replace(path + '.json.tmp', path + '.json')
+        return self.vectors(name), counts
+
+    @staticmethod
+    def _copy_known(keys, known_keys, known_vectors, vectors, todo):
+        # copies the vectors of the documents still to do whose key is known, by a sorted search of the keys
+        if not len(known_keys) or not todo.any():
+            return 0
+        order = np.argsort(known_keys)
+        pos = np.minimum(np.searchsorted(known_keys[order], keys), len(known_keys) - 1)
+        found = todo & (known_keys[order][pos] == keys)
+        vectors[found] = np.asarray(known_vectors)[order[pos[found]]]
+        todo[found] = False
+        return int(found.sum())
+
+    def vectors(self, name):
+        return np.load(os.path.join(self.vectors_dir, name + '.npy'), mmap_mode='r')
+
+
+def pca(x, dims=50):
+    # the first dims principal components of x (or x centred, if it has no more dimensions)
+    x = x - x.mean(axis=0)
+    if x.shape[1] <= dims:
+        return x
+    _, _, vt = np.linalg.svd(x[np.random.RandomState(0).permutation(len(x))[:20000]], full_matrices=False)
+    return x @ vt[:dims].T
+
+
+def knn_graph(x, k, chunk_size=2048):
+    # the squared euclidean distances to the k nearest other points of each point, as a sparse matrix holding
+    # the point itself too, as KNeighborsTransformer; the distances of a chunk of points to all points are one
+    # matrix product, and their k + 1 smallest one torch.topk
+    from scipy.sparse import csr_matrix
+    points = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+    norms = (points * points).sum(1)
+    distances = np.zeros((len(x), k + 1), dtype=np.float32)
+    indices = np.zeros((len(x), k + 1), dtype=np.int64)
+    for i in range(0, len(x), chunk_size):
+        chunk = points[i:i + chunk_size]
+        d = norms[i:i + chunk_size, None] - 2 * chunk @ points.T + norms[None]
+        d[torch.arange(len(chunk)), torch.arange(i, i + len(chunk))] = 0
+        top = torch.topk(d, k + 1, dim=1, largest=False)
+        distances[i:i + chunk_size] = top.values.clamp(min=0).numpy()
+        indices[i:i + chunk_size] = top.indices.numpy()
+    indptr = np.arange(0, len(x) * (k + 1) + 1, k + 1)
+    return csr_matrix((distances.ravel(), indices.ravel(), indptr), shape=(len(x), len(x)))
+
+
+def project(x, perplexity=30., pca_dims=50, seed=41, chunk_size=2048):
+    # 2-d Barnes-Hut t-SNE of the rows of x, on their 3 x perplexity nearest neighbours
+    from sklearn.manifold import TSNE
+    x = pca(np.asarray(x, dtype=np.float32), pca_dims)
+    perplexity = min(perplexity, (len(x) - 1) / 3)
+    graph = knn_graph(x, min(len(x) - 1, int(3 * perplexity + 1)), chunk_size)
+    # initialised with the first two principal components, scaled as TSNE(init='pca') does
+    init = pca(x, 2)[:, :2]
+    init = init / np.std(init[:, 0]) * 1e-4
+    tsne = TSNE(n_components=2, perplexity=perplexity, metric='precomputed', init=init.astype(np.float32),
+                learning_rate='auto', method='barnes_hut', random_state=seed)
+    return tsne.fit_transform(graph)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Doc2Vec vectors and t-SNE projection of data variants')
+    parser.add_argument('--directory', default='./files/doc2vec', help='the model and the cached vectors')
+    parser.add_argument('--workers', type=int, help='processes for training and inference, by default the CPUs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help='train the model on the variants, and embed them')
+    train_parser.add_argument('variants', nargs='+', help='name=file:key[,key...]')
+    train_parser.add_argument('--vector-size', type=int, default=100)
+    train_parser.add_argument('--epochs', type=int, default=100)
+    train_parser.add_argument('--dm', type=int, default=1, help='1 for PV-DM, 0 for PV-DBOW')
+    train_parser.add_argument('--min-count', type=int, default=1)
+    train_parser.add_argument('--alpha', type=float, default=0.025)
+    train_parser.add_argument('--min-alpha', type=float, default=0.00025)
+    train_parser.add_argument('--seed', type=int, default=41)
+
+    embed_parser = subparsers.add_parser('embed', help='vectors of (new or grown) variants, inferring unseen documents')
+    embed_parser.add_argument('variants', nargs='+', help='name=file:key[,key...]')
+    embed_parser.add_argument('--infer-epochs', type=int, help='by default the epochs of the model')
+
+    project_parser = subparsers.add_parser('project', help='t-SNE of embedded variants, projected together')
+    project_parser.add_argument('names', nargs='+', help='names of embedded variants')
+    project_parser.add_argument('--perplexity', type=float, default=30.)
+    project_parser.add_argument('--seed', type=int, default=41)
+    project_parser.add_argument('--output', help='.npy file of the coordinates of the variants in the order given, '
+                                                 'by default projection_<names>.npy in the directory')
+    args = parser.parse_args(argv)
+
+    stage = Doc2VecStage(args.directory)
+    if args.command in ('train', 'embed'):
+        variants = [read_variant(x) for x in args.variants]
+        if args.command == 'train':
+            seconds = stage.train([x for _, documents in variants for x in documents], args.vector_size, args.epochs,
+                                  args.workers, args.dm, args.min_count, args.alpha, args.min_alpha, args.seed)
+            print('{} distinct documents trained in {:.1f} s'.format(stage.meta['documents'], seconds))
+        print('variant, documents, cached, trained, inferred, seconds')
+        for name, documents in variants:
+            start = time.perf_counter()
+            _, counts = stage.embed(name, documents, args.workers, getattr(args, 'infer_epochs', None))
+            print('{}, {}, {cached}, {trained}, {inferred}, {:.2f}'.format(name, len(documents),
+                                                                          time.perf_counter() - start, **counts))
+    else:
+        vectors = [stage.vectors(name) for name in args.names]
+        start = time.perf_counter()
+        coords = project(np.concatenate(vectors), args.perplexity, seed=args.seed)
+        output = args.output or os.path.join(args.directory, 'projection_' + '_'.join(args.names) + '.npy')
+        with open(output + '.tmp', 'wb') as f:
+            np.save(f, coords.astype(np.float32))
+        os.replace(output + '.tmp', output)
+        print('{} documents of {} projected in {:.1f} s, written to {}'.format(
+            len(coords), ', '.join('{} ({})'.format(n, len(v)) for n, v in zip(args.names, vectors)),
+            time.perf_counter() - start, output))
+
+
+if __name__ == '__main__':
+    main()
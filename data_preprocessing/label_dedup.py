@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import re
+import time
+from collections import Counter
+from difflib import SequenceMatcher
+
+import numpy as np
+
+# Near-duplicate detection of labels (and labeled documents), as done by hand in
+# notebooks/postprocess_labeled_data.ipynb with fuzzywuzzy's token_sort_ratio: labels are taken in order, and
+# every later label scoring at least threshold against a kept label is discarded.
+# Instead of scoring every pair, candidate pairs are found with an inverted index of character q-grams
+# (prefix filtering): a pair can only reach the threshold if it shares enough q-grams, which bounds which
+# q-grams of each label need to be indexed, rarest first. The shared q-grams of the labels of each index
+# entry are counted at once as a matrix product, and only the pairs passing the length and q-gram count
+# bounds are scored exactly. The bounds never drop a pair reaching the threshold, so the keep/discard
+# decisions are the same as scoring all pairs.
+
+_non_word = re.compile(r'(?ui)\W')
+_non_ascii = dict((i, None) for i in range(128, 256))
+
+
+def sort_tokens(label):
+    # the processed, token-sorted string token_sort_ratio compares (fuzzywuzzy's full_process with force_ascii)
+    processed = _non_word.sub(' ', label.translate(_non_ascii)).lower().strip()
+    return ' '.join(sorted(processed.split()))
+
+
+def ratio(s1, s2):
+    # fuzzywuzzy's fuzz.ratio without python-Levenshtein, of two processed strings
+    if not s1 or not s2:
+        return 0
+    return int(round(100 * SequenceMatcher(None, s1, s2).ratio()))
+
+
+def token_sort_ratio(label1, label2):
+    return ratio(sort_tokens(label1), sort_tokens(label2))
+
+
+def qgram_elements(s, q):
+    # the q-grams of s as set elements: the k-th occurrence of a q-gram is its own element, so that the
+    # overlap of two element sets is the overlap of the q-gram multisets
+    seen = Counter()
+    elements = []
+    for i in range(len(s) - q + 1):
+        gram = s[i:i + q]
+        elements.append((gram, seen[gram]))
+        seen[gram] += 1
+    return elements
+
+
+class QGramIndex(object):
+    # candidate pairs of strings whose ratio can reach threshold (a score of 0-100)
+    # a ratio r of two strings of lengths l1, l2 means at most d = (1 - r)(l1 + l2) insertions and deletions
+    # between them, each of which changes at most q q-grams, so they share at least
+    # max(|Q1|, |Q2|) - q d q-grams (|Q| = l - q + 1); and the ratio is at most 2 min(l1, l2) / (l1 + l2)
+
+    def __init__(self, strings, threshold=90, q=None, block_size=2048):
+        self.strings = list(strings)
+        self.block_size = block_size
+        # the lowest ratio rounding to threshold
+        self.t = max(threshold - 0.5, 0) / 100
+        # by default the longest q-grams (up to 3) of which a pair of similar strings still shares some:
+        # the bound above is positive while q (1 - t) 2 l < l
+        self.q = q or int(max(1, min(3, np.ceil(1 / max(2 * (1 - self.t), 1e-9)) - 1)))
+        q = self.q
+        self.lengths = np.array([len(s) for s in self.strings], dtype=np.int64)
+        self.sizes = np.maximum(self.lengths - q + 1, 0)
+        element_lists = [qgram_elements(s, q) for s in self.strings]
+        # elements ordered rarest first, the same order for all strings
+        frequency = Counter(e for elements in element_lists for e in set(elements))
+        order = {e: i for i, (e, _) in enumerate(sorted(frequency.items(), key=lambda x: (x[1], x[0])))}
+        self.elements = [np.sort(np.array([order[e] for e in elements], dtype=np.int64)) for elements in element_lists]
+        self.n_elements = len(order)
+        self.stats = {'strings': len(self.strings), 'blocks': 0, 'scored': 0}
+
+    def max_distance(self, l1, l2):
+        return np.floor((1 - self.t) * (l1 + l2) + 1e-9).astype(np.int64)
+
+    def required_overlap(self, l1, l2):
+        return np.maximum(np.maximum(l1, l2) - self.q + 1, 0) - self.q * self.max_distance(l1, l2)
+
+    def length_window(self, lengths):
+        # the lengths of the strings that can reach the threshold with strings of these lengths
+        t = max(self.t, 1e-9)
+        return np.ceil(lengths * t / (2 - t) - 1e-9).astype(np.int64), np.floor(lengths * (2 - t) / t + 1e-9).astype(np.int64)
+
+    def min_overlap(self):
+        # the least q-grams each string shares with any string that can reach the threshold with it
+        low, high = self.length_window(self.lengths)
+        bound = np.empty(len(self.strings), dtype=np.int64)
+        for length in np.unique(self.lengths):
+            mask = self.lengths == length
+            partners = np.arange(low[mask][0], high[mask][0] + 1)
+            bound[mask] = self.required_overlap(length, partners).min() if len(partners) else 0
+        return bound
+
+    def candidate_pairs(self):
+        # pairs (i, j), i < j, that may reach the threshold
+        min_overlap = self.min_overlap()
+        # strings sharing no q-gram with some partner that may reach the threshold are compared by length only
+        unindexed = np.flatnonzero(min_overlap <= 0)
+        pairs = set()
+        if len(unindexed):
+            order = np.argsort(self.lengths, kind='stable')
+            sorted_lengths = self.lengths[order]
+            low, high = self.length_window(self.lengths[unindexed])
+            for i, lo, hi in zip(unindexed, low, high):
+                window = order[np.searchsorted(sorted_lengths, lo):np.searchsorted(sorted_lengths, hi, side='right')]
+                pairs.update((min(i, j), max(i, j)) for j in window.tolist() if j != i)
+
+        # inverted index of the prefix elements of the other strings
+        postings = {}
+        for i in np.flatnonzero(min_overlap > 0):
+            prefix = self.sizes[i] - min_overlap[i] + 1
+            for e in self.elements[i][:prefix].tolist():
+                postings.setdefault(e, []).append(i)
+        blocks = [np.array(members) for members in postings.values() if len(members) > 1]
+        self.stats['blocks'] = len(blocks)
+        for members in blocks:
+            pairs.update(self.block_pairs(members))
+        return pairs
+
+    def block_pairs(self, members):
+        # the pairs of a block sharing enough q-grams, counted for all pairs at once as B B^T of the 0/1
+        # element matrix B of the block
+        elements = np.unique(np.concatenate([self.elements[i] for i in members]))
+        B = np.zeros((len(members), len(elements)), dtype=np.float32)
+        for row, i in enumerate(members):
+            B[row, np.searchsorted(elements, self.elements[i])] = 1
+        lengths = self.lengths[members]
+        pairs = []
+        for start in range(0, len(members), self.block_size):
+            rows = slice(start, start + self.block_size)
+            overlap = B[rows] @ B.T
+            l1 = lengths[rows][:, None]
+            l2 = lengths[None, :]
+            ok = (overlap >= self.required_overlap(l1, l2)) & (2 * np.minimum(l1, l2) >= self.t * (l1 + l2) - 1e-9)
+            rows_idx, cols_idx = np.nonzero(ok)
+            i = members[rows_idx + start]
+            j = members[cols_idx]
+            keep = i < j
+            pairs.extend(zip(i[keep].tolist(), j[keep].tolist()))
+        return pairs
+
+
+
+def greedy_decisions(n, similar):
+    # keep/discard of labels taken in order: a kept label discards every later label similar to it that is not
+    # discarded yet; returns, for each label, None if kept or the index of the label that discarded it
+    neighbours = {}
+    for i, j in similar:
+        neighbours.setdefault(i, []).append(j)
+    discarded_by = [None] * n
+    for i in range(n):
+        if discarded_by[i] is not None:
+            continue
+        for j in sorted(neighbours.get(i, [])):
+            if discarded_by[j] is None:
+                discarded_by[j] = i
+    return discarded_by
+
+
+def dedup(labels, threshold=90, q=None):
+    # the keep/discard decisions of the labels (see greedy_decisions) at a token_sort_ratio threshold, and the
+    # score of each discarded label against the label that discarded it, with the statistics of the search
+    strings = [sort_tokens(x) for x in labels]
+    # labels of the same processed string score 100 against each other: only the first of them is compared to
+    # the other labels, the later ones are discarded by it, or by the label discarding it (at the same score)
+    first = {}
+    for i, s in enumerate(strings):
+        if s:
+            first.setdefault(s, i)
+    representatives = sorted(set(first.values()) | {i for i, s in enumerate(strings) if not s})
+    index = QGramIndex([strings[i] for i in representatives], threshold, q)
+    similar = {}
+    for u, v in sorted(index.candidate_pairs()):
+        i, j = representatives[u], representatives[v]
+        # SequenceMatcher is not symmetric: the earlier label is compared to the later one, as the notebook
+        # compared each kept label to the remaining ones
+        score = ratio(strings[i], strings[j])
+        index.stats['scored'] += 1
+        if score >= threshold:
+            similar[(i, j)] = score
+    rank = {i: k for k, i in enumerate(representatives)}
+    decisions = greedy_decisions(len(representatives), {(rank[i], rank[j]): score for (i, j), score in similar.items()})
+    discarded_by = [None] * len(labels)
+    scores = [None] * len(labels)
+    for k, d in enumerate(decisions):
+        if d is not None:
+            i, j = representatives[d], representatives[k]
+            discarded_by[j], scores[j] = i, similar[(i, j)]
+    for i, s in enumerate(strings):
+        if s and first[s] != i:
+            r = first[s]
+            discarded_by[i], scores[i] = (r, 100) if discarded_by[r] is None else (discarded_by[r], scores[r])
+    return discarded_by, scores, index.stats
+
+
+def dedup_bruteforce(labels, threshold=90):
+    # the same decisions and scores by scoring every pair, as the notebook does
+    strings = [sort_tokens(x) for x in labels]
+    similar = {}
+    for i in range(len(strings)):
+        for j in range(i + 1, len(strings)):
+            score = ratio(strings[i], strings[j])
+            if score >= threshold:
+                similar[(i, j)] = score
+    discarded_by = greedy_decisions(len(labels), similar)
+    return discarded_by, [None if k is None else similar[(k, i)] for i, k in enumerate(discarded_by)]
+
+
+def read_labels(path, key=None):
+    # ids and labels of a {id: label} file (filtered_labels.json), or of the texts of a dataset field
+    # (key, i.e. 'document'; lists of activity labels are joined as in corpus_builder.py)
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if key is None and isinstance(data, dict) and all(isinstance(v, str) for v in data.values()):
+        return list(data.keys()), list(data.values())
+    texts = data[key] if key is not None else data
+    texts = [', '.join(x) if isinstance(x, list) else x for x in texts]
+    return [str(i) for i in range(len(texts))], texts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='near-duplicate labels by token_sort_ratio')
+    parser.add_argument('path', help="{id: label} file, i.e. 'files/filtered_labels.json', or a dataset with --key")
+    parser.add_argument('--key', help="field of the texts in a dataset file, i.e. 'document'")
+    parser.add_argument('--threshold', type=int, default=90, help='token_sort_ratio (0-100) to discard at')
+    parser.add_argument('--q', type=int, help='length of the indexed character q-grams, by default from the threshold')
+    parser.add_argument('--output', help='writes {"keep": [ids], "discard": {id: id of the kept label}}')
+    parser.add_argument('--check', action='store_true', help='compare with scoring every pair')
+    args = parser.parse_args(argv)
+
+    ids, labels = read_labels(args.path, args.key)
+    start = time.perf_counter()
+    discarded_by, scores, stats = dedup(labels, args.threshold, args.q)
+    elapsed = time.perf_counter() - start
+    n_pairs = len(labels) * (len(labels) - 1) // 2
+    print('{} labels, {} kept, {} discarded in {:.2f}s'.format(len(labels), discarded_by.count(None),
+                                                               len(labels) - discarded_by.count(None), elapsed))
+    print('{} pairs scored of {} ({:.2%}), {} index blocks'.format(stats['scored'], n_pairs,
+                                                                stats['scored'] / max(n_pairs, 1), stats['blocks']))
+    for i, k in enumerate(discarded_by):
+        if k is not None:
+            print('discard {} ({!r}), similar to {} ({!r}): {}'.format(ids[i], labels[i], ids[k], labels[k],
+                                                                     scores[i]))
+    if args.check:
+        start = time.perf_counter()
+        expected, expected_scores = dedup_bruteforce(labels, args.threshold)
+        print('all pairs: {:.2f}s, same decisions: {}, same scores: {}'.format(
+            time.perf_counter() - start, expected == discarded_by, expected_scores == scores))
+    if args.output:
+        result = {'keep': [ids[i] for i, k in enumerate(discarded_by) if k is None],
+                  'discard': {ids[i]: ids[k] for i, k in enumerate(discarded_by) if k is not None}}
+        with open(args.output + '.tmp', 'w') as f:
+            json.dump(result, f)
+        os.replace(args.output + '.tmp', args.output)
+
+
+if __name__ == '__main__':
+    main()
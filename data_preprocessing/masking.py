@@ -0,0 +1,128 @@
+import re
+
+MASK = '<mask_1>'
+
+
+class FlowContext(object):
+    # the shapes of one model, sorted out once by extract_masked_flows and shared by all masking strategies
+    def __init__(self, start_events_id, int_events_id, end_events_id, tasks_subprocesses_id,
+                 gateways_count, closing_gateways_id, flows=None, lanes=None):
+        self.start_events_id = start_events_id
+        self.int_events_id = int_events_id
+        self.end_events_id = end_events_id
+        self.tasks_subprocesses_id = tasks_subprocesses_id
+        self.tasks_int_events_id = set.union(tasks_subprocesses_id, int_events_id)
+        self.gateways_count = gateways_count
+        self.closing_gateways_id = closing_gateways_id
+        self.flows = flows
+        self.lanes = lanes
+
+
+class MaskingStrategy(object):
+    # a masking strategy picks the gap sentences of the sorted flows of a model, one flow per start event
+    # masking rewrites the names of the masked flow objects, and of the events, so every strategy keeps
+    # its own copy of them: the strategies of one model see the same sorted flows, but not each other's masks
+    min_length = 5
+
+    def __init__(self, context):
+        self.context = context
+        if context.lanes is None:
+            # without pools, names are kept over the flows of all start events, as before
+            self.names = dict(context.flows)
+
+    def flow_names(self):
+        if self.context.lanes is None:
+            return self.names
+        names = {}
+        for x in self.context.lanes.values():
+            names.update(x)
+        return names
+
+    def mask_in_flow(self, obj, next_obj):
+        # whether the task or intermediate event obj, followed by next_obj in the sorted flow, is masked
+        return False
+
+    def mask_ends(self, data, label):
+        # masks sentences at the ends of the flow, once the masks in the flow are placed
+        pass
+
+    def mask(self, result):
+        # returns the masked flow (document) and its gap sentences (summary), or None if the flow is too short
+        context = self.context
+        names = self.flow_names()
+        data = []
+        label = []
+        result = list(result)
+        result_copy = result.copy()
+        for n, obj in enumerate(result_copy):
+            if (obj in context.start_events_id) or (obj in context.int_events_id) or (obj in context.end_events_id):
+                if obj in names:
+                    res = re.findall(r'\(.*?\)', names[obj])
+                    if res:
+                        names[obj] = res[0][1:-1]
+                    else:
+                        result.remove(obj)
+            if obj in context.gateways_count:
+                result.remove(obj)
+            if (obj in context.tasks_int_events_id) and (n < (len(result_copy)-1)):
+                if self.mask_in_flow(obj, result_copy[n+1]):
+                    if (obj in names) and (obj in result) and (names[obj] != MASK):
+                        label.append(names[obj])
+                        names[obj] = MASK
+
+        for r in result:
+            if r in names:
+                data.append(names[r])
+
+        if len(data) < self.min_length:
+            return None
+        self.mask_ends(data, label)
+        return data, label
+
+
+class OptimizedMasking(MaskingStrategy):
+    # masks the tasks before a splitting gateway, falling back on the first and last sentences
+    # of flows without such tasks, or of long flows with a single one
+    def mask_in_flow(self, obj, next_obj):
+        return next_obj in self.context.gateways_count and next_obj not in self.context.closing_gateways_id
+
+    def mask_ends(self, data, label):
+        if label:
+            if len(data) >= 10 and len(label) < 2:
+                if data[0] != MASK:
+                    sent = data.pop(0)
+                    label.append(sent)
+                    data.insert(0, MASK)
+                else:
+                    if data[-1] != MASK:
+                        sent = data.pop()
+                        label.append(sent)
+                        data.append(MASK)
+        else:
+            mask_first_and_last(data, label)
+
+
+class NotOptimizedMasking(MaskingStrategy):
+    # masks the first sentence of every flow, and the last one of long flows
+    def mask_ends(self, data, label):
+        mask_first_and_last(data, label)
+
+
+class NoMasking(MaskingStrategy):
+    # the sorted flows as they are, i.e. as fragments to be labeled by a trained model
+    min_length = 1
+
+
+def mask_first_and_last(data, label):
+    if data[0] != MASK:
+        sent = data.pop(0)
+        data.insert(0, MASK)
+        label.append(sent)
+    if len(data) >= 10 and data[-1] != MASK:
+        sent = data.pop()
+        label.append(sent)
+        data.append(MASK)
+
+
+masking_strategies = {'optimized': OptimizedMasking, 'not_optimized': NotOptimizedMasking, 'unmasked': NoMasking}
+default_strategy = 'optimized'
@@ -0,0 +1,91 @@
+import glob
+import json
+import os
+import sqlite3
+
+META_INDEX_FILE = 'meta_index.sqlite'
+
+_connections = {}
+
+
+def index_path_for(models_path):
+    return os.path.join(models_path, META_INDEX_FILE)
+
+
+def connect(index_path):
+    # one connection per process, since sqlite connections must not be shared across forked workers
+    key = (os.getpid(), index_path)
+    if key not in _connections:
+        conn = sqlite3.connect(index_path)
+        conn.execute('''CREATE TABLE IF NOT EXISTS models (
+                            meta_file TEXT PRIMARY KEY,
+                            mtime REAL,
+                            model_id TEXT,
+                            model_name_is_digit INTEGER,
+                            natural_language TEXT,
+                            modeling_language TEXT,
+                            task_count INTEGER,
+                            has_pool INTEGER,
+                            element_counts TEXT)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS models_model_id ON models (model_id)')
+        _connections[key] = conn
+    return _connections[key]
+
+
+def update_index(models_path, index_path=None):
+    # function that (re)indexes every *.meta.json file that is new or changed since the last update
+    if index_path is None:
+        index_path = index_path_for(models_path)
+    conn = connect(index_path)
+    indexed = dict(conn.execute('SELECT meta_file, mtime FROM models'))
+
+    rows = []
+    meta_files = set()
+    for f in glob.glob(os.path.join(models_path, '*.meta.json')):
+        meta_file = os.path.basename(f)
+        meta_files.add(meta_file)
+        mtime = os.stat(f).st_mtime
+        if indexed.get(meta_file) == mtime:
+            continue
+        with open(f) as jsonFiles:
+            data = json.load(jsonFiles)
+        element_counts = data['revision']['elementCounts']
+        rows.append((meta_file, mtime, data['model']['modelId'],
+                     int(data['model']['modelName'].isdigit()),
+                     data['model']['naturalLanguage'],
+                     data['model']['modelingLanguage'],
+                     element_counts.get('Task'),
+                     int('Pool' in element_counts.keys()),
+                     json.dumps(element_counts)))
+
+    removed = [(x,) for x in indexed.keys() if x not in meta_files]
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.executemany('DELETE FROM models WHERE meta_file = ?', removed)
+    print('meta index: ' + str(len(rows)) + ' updated, ' + str(len(removed)) + ' removed, ' + str(len(meta_files)) + ' models')
+    return index_path
+
+
+def query_models(index_path, natural_language='en', modeling_language='bpmn20', min_task=None, max_task=None):
+    # function that returns the sorted, unique ids of the models passing the filters
+    # models named by digits only are left out, as in the original filtering
+    query = 'SELECT DISTINCT model_id FROM models WHERE natural_language = ? AND model_name_is_digit = 0'
+    params = [natural_language]
+    if modeling_language is not None:
+        query += ' AND modeling_language = ?'
+        params.append(modeling_language)
+    if min_task is not None:
+        query += ' AND task_count >= ?'
+        params.append(min_task)
+    if max_task is not None:
+        query += ' AND task_count <= ?'
+        params.append(max_task)
+    return sorted(x[0] for x in connect(index_path).execute(query, params))
+
+
+def has_pool(index_path, meta_file):
+    # True or False if the meta file is indexed, None otherwise
+    row = connect(index_path).execute('SELECT has_pool FROM models WHERE meta_file = ?', (meta_file,)).fetchone()
+    if row is None:
+        return None
+    return bool(row[0])
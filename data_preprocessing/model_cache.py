@@ -0,0 +1,94 @@
+import hashlib
+import os
+import pickle
+
+# bump whenever the parsed outputs of load_model change, so stale cache entries are never read
+PARSER_VERSION = 1
+
+
+class ModelCache(object):
+    # on-disk cache of the parsed models, keyed by the content hash of the model file and the parser version
+    # entries are pickled, and once the cache grows over max_bytes the least recently used ones are evicted
+    # down to a fraction of it, so that the cache directory is not scanned again at every write
+    # several processes may share one cache directory: entries are written atomically, and an entry evicted
+    # by another process is just a miss
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, low_water=0.9):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(os.path.getsize(p) for p in self.entries())
+
+    def entries(self):
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.pkl')]
+
+    def key(self, path_to_json, *extra):
+        # the model's content, not its path or mtime, so copies and touched files still hit
+        h = hashlib.blake2b(digest_size=20)
+        with open(path_to_json, 'rb') as f:
+            h.update(f.read())
+        h.update(repr((PARSER_VERSION,) + extra).encode())
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        # returns the cached value, or None on a miss
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        try:
+            # the mtime is the last use of the entry, for the LRU eviction
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self.entry_path(key)
+        tmp = path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # e.g. an exception of the walk that cannot be pickled, the model is just parsed again next time
+            os.remove(tmp)
+            return
+        self.size += os.path.getsize(tmp)
+        os.replace(tmp, path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # drop the least recently used entries until the cache is back under low_water * max_bytes
+        entries = []
+        for p in self.entries():
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        self.size = sum(e[1] for e in entries)
+        for mtime, size, p in entries:
+            if self.size <= self.low_water * self.max_bytes:
+                break
+            try:
+                os.remove(p)
+                self.evictions += 1
+            except OSError:
+                pass
+            self.size -= size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -1,30 +1,77 @@
+import functools
 import glob
 import json
 import os
 import re
 import numpy as np
+import meta_index
+from shape_parser import parse_shapes
 
 def load_JSON(path_to_json, extract_subprocess = False):
     # function that gets all labels, tasks, pools and lanes
-    with open(path_to_json, 'r') as f:
-        data = f.read()
-        json_data = json.loads(data)
-        if 'childShapes' not in json_data.keys():
-            print('no elements in '+path_to_json)
-            return {}
-        elif extract_subprocess:
-                (shapes_id, follows, flow), subprocess_name = process_subprocess_no_label(json_data['childShapes'])
-                return shapes_id, follows, flow, subprocess_name
-        elif pool_exist(path_to_json):
-            (shapes_id, follows, lanes), pools = process_pools_and_lanes(json_data['childShapes'])
-            return shapes_id, follows, lanes, pools
-        else:
-            shapes_id, follows, flow = process_flow(json_data['childShapes'])
-            return shapes_id, follows, flow
+    # the model is parsed into compact shape records, see shape_parser
+    shapes = parse_shapes(path_to_json)
+    if shapes is None:
+        print('no elements in '+path_to_json)
+        return {}
+    elif extract_subprocess:
+        (shapes_id, follows, flow), subprocess_name = process_subprocess_no_label(shapes)
+        return shapes_id, follows, flow, subprocess_name
+    elif pool_exist(path_to_json):
+        (shapes_id, follows, lanes), pools = process_pools_and_lanes(shapes)
+        return shapes_id, follows, lanes, pools
+    else:
+        shapes_id, follows, flow = process_flow(shapes)
+        return shapes_id, follows, flow
             
 
+def load_model(path_to_json, cache=None):
+    # function that gets the flow (or pools and lanes) and the subprocesses of a model in one parse and one walk
+    # returns the outputs as load_JSON and process_subprocess give them, and the errors of the outputs that failed
+    # with a ModelCache, a model parsed before (same content, same parser version) is read back from the cache
+    flow_output = 'pools_and_lanes' if pool_exist(path_to_json) else 'flow'
+    if cache is not None:
+        key = cache.key(path_to_json, flow_output)
+        cached = cache.get(key)
+        if cached is None:
+            cached = parse_model(path_to_json, flow_output)
+            cache.put(key, cached)
+        results, errors = cached
+    else:
+        results, errors = parse_model(path_to_json, flow_output)
+    if not results and not errors:
+        print('no elements in '+path_to_json)
+    return results, errors
+
+
+def parse_model(path_to_json, flow_output):
+    return walk_model(parse_shapes(path_to_json), flow_output)
+
+
+def walk_model(shapes, flow_output):
+    # the outputs of load_model from the shape records of a model, flow_output is 'flow' or 'pools_and_lanes'
+    if shapes is None:
+        return {}, {}
+    results, errors = walk_shapes(shapes, [flow_output, 'subprocess'])
+    if flow_output in errors:
+        errors['flow'] = errors.pop(flow_output)
+    elif flow_output == 'pools_and_lanes':
+        (shapes_id, follows, lanes), pools = results.pop(flow_output)
+        results['flow'] = shapes_id, follows, lanes, pools
+    else:
+        shapes_id, follows, flow = results.pop(flow_output)
+        results['flow'] = shapes_id, follows, flow
+    return results, errors
+
+
 def pool_exist(path_to_json):
     meta_file = path_to_json.replace('.json', '.meta.json')
+    # look the model up in the meta index first, if one was built next to the models
+    index_path = meta_index.index_path_for(os.path.dirname(path_to_json))
+    if os.path.exists(index_path):
+        pool = meta_index.has_pool(index_path, os.path.basename(meta_file))
+        if pool is not None:
+            return pool
     with open(meta_file, 'r') as f:
         meta_data = f.read()
         json_meta_data = json.loads(meta_data)
@@ -34,190 +81,265 @@ def pool_exist(path_to_json):
             return False     
 
 
+tasks_subprocesses = ['Task', 'CollapsedSubprocess', 'Subprocess']
+# ' Association_Undirected' (with the space) never matches, so undirected associations are kept, as before
+shapes_unwanted = ['DataObject', 'ITSystem', 'TextAnnotation', 
+                  ' Association_Undirected', 'Association_Unidirectional', 'MessageFlow']
+
+
+@functools.lru_cache(maxsize=65536)
+def normalise_name(name):
+    # names recur across shapes and models, so each distinct name is only normalised once
+    return name.replace('\n', ' ').replace('\r', '').replace('  ', ' ')
+
+
+def has_name(shape):
+    return shape.name is not None and not shape.name == ""
+
+
+def flow_label(shape):
+    # label of a flow object: the name of tasks and subprocesses, the stencil (and name) of anything else
+    if shape.stencil in tasks_subprocesses:
+        if not shape.name == "":
+            return normalise_name(shape.name)
+        return 'Task or Subprocess'
+    if has_name(shape):
+        return shape.stencil + " (" + normalise_name(shape.name) + ")"
+    return shape.stencil
+
+
+class ShapeVisitor(object):
+    # visitors collect one output during the single walk over a model's shapes (see walk_shapes)
+    # parents are the shapes enclosing shape, in_pools_and_lanes tells whether all of them are pools or lanes
+    def enter(self, shape, parents, in_pools_and_lanes):
+        pass
+
+    def leave(self, shape, parents, in_pools_and_lanes):
+        pass
+
+    def result(self):
+        raise NotImplementedError
+
+
+class FlowVisitor(ShapeVisitor):
+    # flow objects on the top level of the model, formerly process_flow
+    def __init__(self):
+        self.shapes_id = {}
+        self.follows = {}
+        self.flow = {}
+
+    def enter(self, shape, parents, in_pools_and_lanes):
+        if not parents and shape.stencil not in shapes_unwanted:
+            add_flow_object(shape, self.shapes_id, self.follows, self.flow)
+
+    def result(self):
+        return [self.shapes_id, self.follows, self.flow]
+
+
+class PoolsAndLanesVisitor(ShapeVisitor):
+    # flow objects in pools and lanes, labeled per lane name, formerly process_pools_and_lanes
+    def __init__(self):
+        self.shapes_id = {}
+        self.follows = {}
+        self.lanes = {}
+        self.pools = {}
+        self.lane_labels = {}
+        self.pool_lanes = None
+
+    def enter(self, shape, parents, in_pools_and_lanes):
+        if not in_pools_and_lanes or shape.stencil in shapes_unwanted:
+            return
+        shape_ID = shape.resource_id
+        self.shapes_id.update({shape_ID: shape.stencil})
+        if shape_ID not in self.follows.keys():
+            self.follows[shape_ID] = list(shape.outgoing)
+
+        if not parents and shape.stencil == 'Pool':
+            self.pool_lanes = {}
+        if parents and parents[-1].stencil == 'Lane' and shape.stencil != 'Lane':
+            lane_shape = parents[-1]
+            if lane_shape.resource_id not in self.lane_labels:
+                self.lane_labels[lane_shape.resource_id] = {}
+            lane_labels = self.lane_labels[lane_shape.resource_id]
+            lane_labels[shape_ID] = flow_label(shape)
+            lane = normalise_name(lane_shape.name) if has_name(lane_shape) else lane_shape.resource_id
+            self.lanes.update({lane: lane_labels})
+            if self.pool_lanes is not None:
+                self.pool_lanes.update({lane: lane_labels})
+
+    def leave(self, shape, parents, in_pools_and_lanes):
+        if not parents and shape.stencil == 'Pool':
+            pool = normalise_name(shape.name) if has_name(shape) else shape.resource_id
+            if len(self.pool_lanes):
+                self.pools.update({pool: self.pool_lanes})
+            self.pool_lanes = None
+
+    def result(self):
+        return [self.shapes_id, self.follows, self.lanes], self.pools
+
+
+class SubprocessFlowVisitor(ShapeVisitor):
+    # sequence flows in pools and lanes, flow objects in subprocesses and the subprocess names,
+    # formerly process_subprocess_no_label
+    def __init__(self):
+        self.shapes_id = {}
+        self.follows = {}
+        self.flow = {}
+        self.subprocess_name = []
+
+    def enter(self, shape, parents, in_pools_and_lanes):
+        if in_pools_and_lanes:
+            if shape.stencil == 'SequenceFlow' and shape.resource_id not in self.follows.keys():
+                self.follows[shape.resource_id] = list(shape.outgoing)
+            if shape.stencil == 'Subprocess' and has_name(shape):
+                self.subprocess_name.append(normalise_name(shape.name))
+        elif parents[-1].stencil == 'Subprocess' and shape.stencil not in shapes_unwanted:
+            if all(p.stencil in ['Pool', 'Lane'] for p in parents[:-1]):
+                add_flow_object(shape, self.shapes_id, self.follows, self.flow)
+
+    def result(self):
+        return [self.shapes_id, self.follows, self.flow], self.subprocess_name
+
+
+class SubprocessVisitor(ShapeVisitor):
+    # task labels of the named subprocesses with at least 3 tasks, formerly process_subprocess
+    def __init__(self):
+        self.subprocess = {}
+
+    def enter(self, shape, parents, in_pools_and_lanes):
+        if in_pools_and_lanes and shape.stencil == 'Subprocess' and has_name(shape):
+            labels = [normalise_name(c.name) for c in shape.child_shapes if c.stencil == 'Task']
+            if len(labels) >= 3:
+                self.subprocess.update({normalise_name(shape.name): labels})
+
+    def result(self):
+        return self.subprocess
+
+
+def add_flow_object(shape, shapes_id, follows, flow):
+    shape_ID = shape.resource_id
+    shapes_id.update({shape_ID: shape.stencil})
+    if shape_ID not in follows.keys():
+        follows[shape_ID] = list(shape.outgoing)
+    flow[shape_ID] = flow_label(shape)
+
+
+shape_visitors = {'flow': FlowVisitor, 'pools_and_lanes': PoolsAndLanesVisitor,
+                  'subprocess_flow': SubprocessFlowVisitor, 'subprocess': SubprocessVisitor}
+
+
+def walk_shapes(shapes, outputs):
+    # function that walks all shapes of a model once and collects every requested output
+    # (keys of shape_visitors); a visitor that fails is dropped, and its error returned instead,
+    # so the other outputs of the model are still collected
+    visitors = {name: shape_visitors[name]() for name in outputs}
+    errors = {}
+
+    def visit(method, shape, parents, in_pools_and_lanes):
+        for name, visitor in list(visitors.items()):
+            try:
+                getattr(visitor, method)(shape, parents, in_pools_and_lanes)
+            except Exception as e:
+                errors[name] = e
+                visitors.pop(name)
+
+    def walk(shapes, parents, in_pools_and_lanes):
+        for shape in shapes:
+            visit('enter', shape, parents, in_pools_and_lanes)
+            if shape.child_shapes:
+                walk(shape.child_shapes, parents + (shape,),
+                     in_pools_and_lanes and shape.stencil in ['Pool', 'Lane'])
+            visit('leave', shape, parents, in_pools_and_lanes)
+
+    walk(shapes, (), True)
+    return {name: visitor.result() for name, visitor in visitors.items()}, errors
+
+
+def collect(shapes, output):
+    results, errors = walk_shapes(shapes, [output])
+    if output in errors:
+        raise errors[output]
+    return results[output]
+
+
 def process_subprocess_no_label(shapes):
-    shapes_id = {}
-    follows = {}
-    flow = {}
-    subprocess_name = []
-    outputs = [shapes_id, follows, flow]
-    for shape in shapes:
-        shape_stencil = shape['stencil']['id']
-        shape_ID = shape['resourceId']
-        if shape_stencil == 'SequenceFlow':
-            outgoingShapes = [s['resourceId'] for s in shape['outgoing']]
-            if shape_ID not in follows.keys():
-                follows[shape_ID] = outgoingShapes
-            
-        if shape_stencil in ['Pool', 'Lane']:
-            results, names = process_subprocess_no_label(shape['childShapes'])
-            for o, r in zip(outputs, results):
-                o.update(r)
-            subprocess_name += names
-
-        if shape_stencil == 'Subprocess':
-            results = process_flow(shape['childShapes'])
-            for o, r in zip(outputs, results):
-                o.update(r)
-            if 'name' in shape['properties'] and not shape['properties']['name'] == "":
-                name = shape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ')
-                subprocess_name.append(name)
-
-    return outputs, subprocess_name
+    return collect(shapes, 'subprocess_flow')
+
 
 def process_subprocess(shapes):
-    subprocess = {}
-    
-    for shape in shapes:
-        if shape['stencil']['id'] in ['Pool', 'Lane']:
-            result = process_subprocess(shape['childShapes'])
-            subprocess.update(result)
-            
-        if shape['stencil']['id'] == 'Subprocess' and 'name' in shape['properties'] and not shape['properties']['name'] == "":
-            subprocess_name = shape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ')
-            task_count = 0
-            labels = []
-            for childShape in shape['childShapes']:
-                if childShape['stencil']['id'] == 'Task':
-                    task_count += 1
-                    label = childShape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ')
-                    labels.append(label)
-            if task_count >= 3:
-                subprocess.update({subprocess_name: labels})
-            
-    return subprocess
-    
-    
+    return collect(shapes, 'subprocess')
+
+
 def process_flow(shapes):
-    shapes_id = {}
-    follows = {}
-    flow = {}
-    tasks_subprocesses = ['Task', 'CollapsedSubprocess', 'Subprocess']
-    shapes_unwanted = ['DataObject', 'ITSystem', 'TextAnnotation', 
-                      ' Association_Undirected', 'Association_Unidirectional', 'MessageFlow']
-    outputs = [shapes_id, follows, flow]
-
-    for shape in shapes:
-        shape_stencil = shape['stencil']['id']
-        shape_ID = shape['resourceId']
-        if shape_stencil in shapes_unwanted:
-            continue
-        shapes_id.update({shape_ID: shape_stencil})
-        
-        outgoingShapes = [s['resourceId'] for s in shape['outgoing']]
-        if shape_ID not in follows.keys():
-            follows[shape_ID] = outgoingShapes
-    
-        if shape_stencil in tasks_subprocesses:
-            if not shape['properties']['name'] == "":
-                flow[shape_ID] = shape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ')
-            else:
-                flow[shape_ID] = 'Task or Subprocess'
-        else:
-            if 'name' in shape['properties'] and not shape['properties']['name'] == "":
-                flow[shape_ID] = shape_stencil + " (" + shape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ') + ")"
-            else:
-                flow[shape_ID] = shape_stencil
+    return collect(shapes, 'flow')
 
-    return outputs
-    
 
 def process_pools_and_lanes(shapes):
-    shapes_id = {}
-    follows = {}
-    lanes = {}
-    pools = {}
-    tasks_subprocesses = ['Task', 'CollapsedSubprocess', 'Subprocess']
-    shapes_unwanted = ['DataObject', 'ITSystem', 'TextAnnotation', 
-                      ' Association_Undirected', 'Association_Unidirectional', 'MessageFlow']
-    outputs = [shapes_id, follows, lanes]
-
-    for shape in shapes:
-        shape_stencil = shape['stencil']['id']
-        shape_ID = shape['resourceId']
-        if shape_stencil in shapes_unwanted:
-            continue
-        shapes_id.update({shape_ID: shape_stencil})
-        outgoingShapes = [s['resourceId'] for s in shape['outgoing']]
-        if shape_ID not in follows.keys():
-            follows[shape_ID] = outgoingShapes
-        
-        if shape_stencil == 'Pool':
-            if 'name' in shape['properties'] and not shape['properties']['name'] == "":
-                pool = shape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ')
-            else:
-                pool = shape_ID
-            results = process_pools_and_lanes(shape['childShapes'])
-            for r, o in zip(results[0], outputs):
-                o.update(r)
-            if len(results[0][2]): #lanes
-                pools.update({pool: results[0][2]})
-        
-        if shape_stencil == 'Lane':
-            if shape['childShapes'] != []:
-                lane_labels = {}
-                for childShape in shape['childShapes']:
-                    c_stencil = childShape['stencil']['id']
-                    c_shape_ID = childShape['resourceId']
-                    if c_stencil == 'Lane':
-                        if 'name' in shape['properties'] and not shape['properties']['name'] == "":
-                            lane = shape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ')
-                        else:
-                            lane = shape_ID
-                        results = process_pools_and_lanes(shape['childShapes'])
-                        for r, o in zip(results[0], outputs):
-                            o.update(r)
-
-                    else:
-                        if c_stencil in shapes_unwanted:
-                            continue
-                        shapes_id.update({c_shape_ID: c_stencil})
-
-                        outgoingShapes = [s['resourceId'] for s in childShape['outgoing']]
-                        if c_shape_ID not in follows.keys():
-                            follows[c_shape_ID] = outgoingShapes
-
-                        if c_stencil in tasks_subprocesses:
-                            if not childShape['properties']['name'] == "":
-                                lane_labels[c_shape_ID] = childShape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ')
-                            else:
-                                lane_labels[c_shape_ID] = 'Task or Subprocess'
-                        else:
-                            if 'name' in childShape['properties'] and not childShape['properties']['name'] == "":
-                                lane_labels[c_shape_ID] = c_stencil + " (" + childShape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ') + ")"
-                            else:
-                                lane_labels[c_shape_ID] = c_stencil
-
-                        if 'name' in shape['properties'] and not shape['properties']['name'] == "":
-                            lane = shape['properties']['name'].replace('\n', ' ').replace('\r', '').replace('  ', ' ')
-                        else:
-                            lane = shape_ID
-                        lanes.update({lane: lane_labels})
-                
-    return outputs, pools
-
-def sort_process_flows(flow, directly_follows, shapes_wanted, gateways_count, temp_closing_count):
+    return collect(shapes, 'pools_and_lanes')
+
+
+def reverse_follows(follows):
+    # function that maps each shape to the shapes directly preceding it (reverse adjacency)
+    # the fan-in of a shape is then len(preceding[shape]), without scanning all edges per shape
+    preceding = {}
+    for shape_ID, outgoingShapes in follows.items():
+        for o in outgoingShapes:
+            if o not in preceding:
+                preceding[o] = []
+            preceding[o].append(shape_ID)
+    return preceding
+
+
+def sort_process_flows(flow, directly_follows, shapes_wanted, gateways_count, temp_closing_count, preceding=None):
+    # function that linearises the flow objects following flow, depth first
+    # an explicit stack replaces the recursion, so deep models no longer hit the recursion limit, and a
+    # flow object is not expanded again while it is still being expanded further up the stack, so
+    # loops end where they return to the path instead of recursing forever
+    # the expansion of a merging flow object (fan-in > 1) is reused whenever it did not depend on
+    # temp_closing_count or a loop, since it then always produces the same flow objects
+    if preceding is None:
+        preceding = reverse_follows(directly_follows)
     process_flow = []
+    expanding = set()
+    expanded = {}
+    state_changes = 0
+    stack = [(None, iter(flow), 0, 0)]
+
+    while stack:
+        parent, successors, start, changes = stack[-1]
+        flow_object = next(successors, stack)
+        if flow_object is stack:
+            # all successors of parent are done
+            stack.pop()
+            if parent is not None:
+                expanding.discard(parent)
+                if state_changes == changes and len(preceding.get(parent, [])) > 1:
+                    expanded[parent] = process_flow[start:]
+            continue
 
-    for flow_object in flow:
         if flow_object in shapes_wanted and flow_object not in temp_closing_count.keys():
             process_flow.append(flow_object)
-        
+
         if flow_object in gateways_count.keys() and flow_object not in temp_closing_count.keys():
             process_flow.append(flow_object)
-            
+
         if flow_object in temp_closing_count.keys():
+            state_changes += 1
             count = temp_closing_count[flow_object]-1
             temp_closing_count.update({flow_object: count})
             if temp_closing_count[flow_object] == 0:
                 process_flow.append(flow_object)
             else:
                 continue
-                    
-        if flow_object in directly_follows.keys() and directly_follows[flow_object]: 
-            flow = directly_follows[flow_object]
-            result = sort_process_flows(flow, directly_follows, shapes_wanted, gateways_count, temp_closing_count)
-            process_flow = process_flow + result
-            
-    return process_flow
 
-    
\ No newline at end of file
+        if flow_object in directly_follows.keys() and directly_follows[flow_object]:
+            if flow_object in expanding:
+                # loop back to a flow object on the current path
+                state_changes += 1
+            elif flow_object in expanded:
+                process_flow += expanded[flow_object]
+            else:
+                expanding.add(flow_object)
+                stack.append((flow_object, iter(directly_follows[flow_object]), len(process_flow), state_changes))
+
+    return process_flow
@@ -0,0 +1,46 @@
+import json
+
+
+class Shape(object):
+    # compact record of the only shape fields used when extracting flows, pools/lanes and subprocesses
+    # name is None if the shape has no name property, outgoing holds the resource ids of the outgoing shapes
+    __slots__ = ('resource_id', 'stencil', 'name', 'outgoing', 'child_shapes')
+
+    def __init__(self, resource_id=None, stencil=None, name=None, outgoing=None, child_shapes=None):
+        self.resource_id = resource_id
+        self.stencil = stencil
+        self.name = name
+        self.outgoing = outgoing
+        self.child_shapes = child_shapes
+
+
+def shape_record(obj):
+    # called by the json decoder for every object, innermost first: shapes are turned into records
+    # as soon as they are decoded, so bounds, dockers and style properties are freed right away
+    # instead of being kept in the dict tree until the whole model is parsed
+    if 'stencil' in obj and 'resourceId' in obj:
+        outgoing = obj.get('outgoing')
+        if outgoing is not None:
+            outgoing = [s['resourceId'] for s in outgoing]
+        return Shape(obj['resourceId'], obj['stencil'].get('id'), obj.get('properties', {}).get('name'),
+                     outgoing, obj.get('childShapes'))
+    return obj
+
+
+def parse_shapes(path_to_json):
+    # function that returns the childShapes of a model as shape records, or None if it has none
+    with open(path_to_json, 'r') as f:
+        model = json.load(f, object_hook=shape_record)
+    return child_shapes(model)
+
+
+def loads_shapes(model_json):
+    # as parse_shapes, for a model given as a JSON string
+    return child_shapes(json.loads(model_json, object_hook=shape_record))
+
+
+def child_shapes(model):
+    if isinstance(model, Shape):
+        # the diagram itself has a stencil and resource id as well
+        return model.child_shapes
+    return model.get('childShapes')
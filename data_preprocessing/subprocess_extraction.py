@@ -1,60 +1,34 @@
-import glob
 import json
-import numpy as np
-from processing_functions import load_JSON, sort_process_flows 
+from corpus_builder import build_corpus
+from meta_index import update_index, query_models
 
-filtered_id = []
-filtered_data = []
+models_path = '../thesis_data/data/bpmai/models/'
 min_task = 5
 # max_task = 10
-flows_extracted = []
-models_skipped = []
-
-for f in glob.glob('../thesis_data/data/bpmai/models/*.meta.json'):
-    with open(f) as jsonFiles:
-        data = json.load(jsonFiles)
-        if data['model']['naturalLanguage'] == 'en' and not data['model']['modelName'].isdigit():
-            filtered_id.append(data['model']['modelId'])
-            filtered_data.append(data)
-
-bpmn20 = [x for x in filtered_data if x['model']['modelingLanguage'] == 'bpmn20']
-bpmn20_filtered = [x for x in bpmn20 if ('Task' in x['revision']['elementCounts'].keys()) and x['revision']['elementCounts']['Task'] >= min_task]
-# bpmn20_filtered = [x for x in bpmn20 if ('Task' in x['revision']['elementCounts'].keys()) and x['revision']['elementCounts']['Task'] >= min_task and x['revision']['elementCounts']['Task'] <= max_task]
-
-bpmn20_filtered_id = [x['model']['modelId'] for x in bpmn20_filtered]
-bpmn20_filtered_id = np.unique(bpmn20_filtered_id)
-print('num of bpmn20: ' + str(len(bpmn20_filtered_id)))
-
-temp_training_data = []
-training_label = []
-# bpmn20_filtered_id = ['69285564', '159373', '448828966', '1536606145']
-for file_num in bpmn20_filtered_id:
-    pools_and_lanes = False
-    file = '../thesis_data/data/bpmai/models/' + file_num + '.json'
-    try:
-        subprocess = load_JSON(file, extract_subprocess=True)
-        if subprocess:
-            print(subprocess)
-            for k, v in subprocess.items():
-                temp_training_data.append(v)
-                training_label.append(k)
-                flows_extracted.append(file_num)
-    except:
-        # print('file skipped - error occurred')
-        print(file_num)
-        models_skipped.append(file_num)
-
-training_data = []
-for td in temp_training_data:
-    td = ", ".join(td)
-    training_data.append(td)
-
-
-train_subprocess = {'document': training_data, 'summary': training_label, 
-                'flows_extracted': flows_extracted, 'models_skipped': models_skipped}
-with open('train_subprocess.json', 'w') as f:
-    json.dump(train_subprocess, f)
-
-
-    
-    
+# workers and shard size of the corpus builder, the output does not depend on them
+n_workers = 1
+shard_size = 200
+# extracted shards are checkpointed here, so an interrupted run resumes where it stopped
+checkpoint_dir = 'checkpoints/train_dataset'
+# parsed models are cached here by content hash, the least recently used are evicted beyond cache_size bytes
+cache_dir = 'cache/models'
+cache_size = 2 * 1024 ** 3
+# same masking strategies as data_processing.py, so that the checkpointed shards match
+strategies = ['optimized', 'not_optimized']
+
+if __name__ == '__main__':
+    # filter the models on the meta index, which only re-reads the meta files changed since the last run
+    index_path = update_index(models_path)
+    bpmn20_filtered_id = query_models(index_path, natural_language='en', modeling_language='bpmn20', min_task=min_task)
+    # bpmn20_filtered_id = query_models(index_path, natural_language='en', modeling_language='bpmn20', min_task=min_task, max_task=max_task)
+    print('num of bpmn20: ' + str(len(bpmn20_filtered_id)))
+
+    # the subprocesses are extracted in the same walk as the masked flows, so the checkpointed
+    # shards of data_processing.py are reused here and the other way round
+    masked_datasets, train_subprocess = build_corpus(bpmn20_filtered_id, models_path, n_workers=n_workers,
+                                                     shard_size=shard_size, checkpoint_dir=checkpoint_dir,
+                                                     cache_dir=cache_dir, cache_size=cache_size,
+                                                     strategies=strategies)
+
+    with open('train_subprocess.json', 'w') as f:
+        json.dump(train_subprocess, f)
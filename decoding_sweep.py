@@ -0,0 +1,161 @@
+import argparse
+import copy
+import itertools
+import json
+import os
+import time
+
+import torch
+
+from bert_scoring import get_scorer
+from inference import InferenceEngine, load_model, make_batches, read_fragments, set_threads
+from inference_backends import BACKENDS
+
+# Labels of the test fragments under every combination of the generation settings (num_beams, length_penalty,
+# max_new_tokens), to choose them as the beam5 and greedy labels of human_evaluation were compared, without
+# running the whole generation again for every setting:
+# - the fragments are batched as by InferenceEngine, each batch is encoded once and its encoder_outputs are
+#   decoded with every setting
+# - the labels of all settings are scored with BERTScore in one call, a label generated by several settings is
+#   embedded once, and the references once (and cached on disk by bert_scoring.py)
+#
+# python decoding_sweep.py ./data/train_test_labeled_dataset.json --input-model ./model_summarization/summarization_7_epoch.pth --num-beams 1 5 8 --length-penalty 0.6 0.8 1.0
+
+
+def sweep_configs(num_beams, length_penalties=(None,), max_new_tokens=(None,)):
+    # the distinct settings of the grid, the length penalty only applies to beam search
+    configs = []
+    for beams, length_penalty, max_new in itertools.product(num_beams, length_penalties, max_new_tokens):
+        config = {'num_beams': beams}
+        if beams > 1 and length_penalty is not None:
+            config['length_penalty'] = length_penalty
+        if max_new is not None:
+            config['max_new_tokens'] = max_new
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def config_name(config):
+    # i.e. greedy, beam5, beam5_lp0.8_max32
+    name = 'greedy' if config['num_beams'] == 1 else 'beam{}'.format(config['num_beams'])
+    if 'length_penalty' in config:
+        name += '_lp{:g}'.format(config['length_penalty'])
+    if 'max_new_tokens' in config:
+        name += '_max{}'.format(config['max_new_tokens'])
+    return name
+
+
+def encode(model, input_ids, attention_mask):
+    # the encoder_outputs of a batch for model.generate, of the model or of an exported backend
+    if hasattr(model, 'encode'):
+        return model.encode(input_ids, attention_mask)
+    return model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask)
+
+
+class DecodingSweep(InferenceEngine):
+    # the labels of the fragments under each of the configs (keyword arguments of model.generate)
+    def __init__(self, model, tokenizer, configs, device='cpu', max_tokens=4096, max_batch_size=64,
+                 max_padding=0.25, max_length=512):
+        super().__init__(model, tokenizer, device, max_tokens, max_batch_size, max_padding, max_length)
+        self.configs = configs
+
+    def sweep(self, fragments):
+        # the labels of each config, in the order of the fragments, and the seconds spent on encoding (shared by
+        # all configs) and on decoding with each config
+        names = [config_name(c) for c in self.configs]
+        labels = {name: [None] * len(fragments) for name in names}
+        seconds = dict.fromkeys(['encoder'] + names, 0.)
+        encodings = self.tokenizer(list(fragments), truncation=True, max_length=self.max_length)['input_ids']
+        lengths = [len(x) for x in encodings]
+        with torch.no_grad():
+            for batch in make_batches(lengths, self.max_tokens, self.max_batch_size, self.max_padding):
+                inputs = self.tokenizer.pad({'input_ids': [encodings[i] for i in batch]}, padding='longest',
+                                            return_tensors='pt').to(self.device)
+                start = time.perf_counter()
+                encoder_outputs = encode(self.model, inputs['input_ids'], inputs['attention_mask'])
+                seconds['encoder'] += time.perf_counter() - start
+                for name, config in zip(names, self.configs):
+                    start = time.perf_counter()
+                    # generate expands the encoder_outputs for beam search in place, so each config gets a copy
+                    generated = self.model.generate(**inputs, encoder_outputs=copy.copy(encoder_outputs), **config)
+                    for i, label in zip(batch, self.tokenizer.batch_decode(generated, skip_special_tokens=True)):
+                        labels[name][i] = label
+                    seconds[name] += time.perf_counter() - start
+        return labels, seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='BERTScore of the labels of every decoding setting, encoding once')
+    parser.add_argument('input', help="JSON dataset of fragments and reference labels, i.e. ./data/train_test_labeled_dataset.json")
+    parser.add_argument('--key', default='document_test')
+    parser.add_argument('--reference-key', default='summary_test')
+    parser.add_argument('--model-name', default='google/pegasus-large')
+    parser.add_argument('--input-model', help='checkpoint saved by save() in the notebooks, i.e. ./model_summarization/summarization_7_epoch.pth')
+    parser.add_argument('--backend', default='fp32', choices=BACKENDS, help='see inference_backends.py')
+    parser.add_argument('--num-beams', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--length-penalty', type=float, nargs='+', default=[None],
+                        help='by default the one of the generation config of the model')
+    parser.add_argument('--max-new-tokens', type=int, nargs='+', default=[None])
+    parser.add_argument('--max-tokens', type=int, default=4096, help='token budget of a batch, padding included')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--threads', type=int, help='CPU threads, i.e. the number of physical cores')
+    parser.add_argument('--output-dir', help='labels of each setting written to <setting>.txt, one per line, as read by bert_scoring.py')
+    parser.add_argument('--check', action='store_true',
+                        help='also run model.generate on the fragments for every setting, and compare time and labels')
+    parser.add_argument('--cache-dir', default='.bert_score_cache')
+    parser.add_argument('--scorer-model-type', help='BERTScore model, by default the one of lang en')
+    parser.add_argument('--scorer-num-layers', type=int)
+    parser.add_argument('--scorer-baseline-path')
+    args = parser.parse_args(argv)
+
+    set_threads(args.threads)
+    model, tokenizer = load_model(args.model_name, args.input_model, 'cpu', args.backend)
+    with open(args.input, 'r') as f:
+        refs = json.load(f)[args.reference_key]
+    fragments = read_fragments(args.input, args.key)
+    configs = sweep_configs(args.num_beams, args.length_penalty, args.max_new_tokens)
+    engine = DecodingSweep(model, tokenizer, configs, max_tokens=args.max_tokens, max_batch_size=args.max_batch_size)
+    start = time.perf_counter()
+    labels, seconds = engine.sweep(fragments)
+    sweep_seconds = time.perf_counter() - start
+
+    # all settings scored at once
+    scorer_kwargs = {k: v for k, v in [('model_type', args.scorer_model_type), ('num_layers', args.scorer_num_layers),
+                                       ('baseline_path', args.scorer_baseline_path)] if v is not None}
+    scorer = get_scorer(lang='en', rescale_with_baseline=True, cache_dir=args.cache_dir, **scorer_kwargs)
+    names = list(labels)
+    start = time.perf_counter()
+    P, R, F1 = scorer.score([x for name in names for x in labels[name]], refs * len(names))
+    score_seconds = time.perf_counter() - start
+
+    print('setting, decoder s, mean label words, P, R, F1')
+    n = len(refs)
+    for k, name in enumerate(names):
+        words = sum(len(x.split()) for x in labels[name]) / max(n, 1)
+        print('{}, {:.2f}, {:.2f}, {:.3f}, {:.3f}, {:.3f}'.format(name, seconds[name], words, P[k * n:(k + 1) * n].mean(),
+                                                                  R[k * n:(k + 1) * n].mean(), F1[k * n:(k + 1) * n].mean()))
+    print('{} settings on {} fragments: encoder {:.2f} s (once), sweep {:.2f} s, scoring {:.2f} s'.format(
+        len(names), n, seconds['encoder'], sweep_seconds, score_seconds))
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for name in names:
+            with open(os.path.join(args.output_dir, name + '.txt'), 'w') as f:
+                f.write(''.join(x.replace('\n', ' ') + '\n' for x in labels[name]))
+
+    if args.check:
+        # the same labels by model.generate, one run over the fragments per setting
+        start = time.perf_counter()
+        same = []
+        for name, config in zip(names, configs):
+            separate = InferenceEngine(model, tokenizer, max_tokens=args.max_tokens, max_batch_size=args.max_batch_size,
+                                       **config).generate(fragments)
+            same.append(separate == labels[name])
+        separate_seconds = time.perf_counter() - start
+        print('separate generate runs {:.2f} s, sweep {:.2f} s ({:.2f}x), same labels: {}'.format(
+            separate_seconds, sweep_seconds, separate_seconds / sweep_seconds, all(same)))
+
+
+if __name__ == '__main__':
+    main()
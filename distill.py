@@ -0,0 +1,409 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers import PegasusForConditionalGeneration
+from transformers.optimization import Adafactor
+
+from bert_scoring import generate_and_score, get_scorer
+from data_module import (LABEL_PAD_TOKEN_ID, Seq2SeqCollator, Seq2SeqDataset, TokenArray, grouped_loader, pad,
+                         tokenizer_fingerprint)
+from inference import InferenceEngine, InferenceStats, load_model, make_batches, read_fragments, set_threads
+from inference_backends import BACKENDS, prepare_backend
+from trainer import EarlyStopping, Trainer
+
+# Knowledge distillation of the fine-tuned labeler (Pegasus_Finetuned_and_Automatic_Evaluation.ipynb) into a small
+# encoder-decoder student with the same tokenizer, after fine-tuning:
+#   targets  the teacher labels the unlabeled fragments (the flows of masked_sent_train.json without their masked
+#            sentences, the subprocesses) by beam search; along each label, and along the reference labels of the
+#            labeled training data, its top-k next-token log probabilities at temperature T are stored as soft
+#            targets, memory-mapped as the tokenized datasets of data_module.py
+#   train    the student starts from evenly spaced layers of the teacher (its embeddings, first and last layers
+#            included) and is trained on the soft targets (KL divergence, x T^2) and on the labels (cross
+#            entropy), validated by the BERTScore F1 of its labels on the validation split, as fine-tuning
+#   compare  teacher and student on the test fragments: fragments/s, latency, and BERTScore F1 against
+#            summary_test, i.e. the speedup against the F1 lost
+#
+# python distill.py targets --input-model ./model_summarization/summarization_7_epoch.pth --output ./distill/targets
+# python distill.py train --input-model ./model_summarization/summarization_7_epoch.pth --targets ./distill/targets --output-dir ./model_student
+# python distill.py compare ./data/train_test_labeled_dataset.json --input-model ./model_summarization/summarization_7_epoch.pth --student ./model_student
+
+TARGETS_VERSION = 1
+# the gap sentence token of data_preprocessing/masking.py
+MASK = '<mask_1>'
+
+
+def strip_masks(document):
+    # a masked flow without its masked sentences, i.e. a shorter fragment of the same flow
+    return ', '.join(x for x in document.split(', ') if x != MASK)
+
+
+def unlabeled_fragments(paths):
+    # the distinct fragments of the unlabeled files: the 'document' of the masked sentences (with the masked
+    # sentences left out) or of the subprocesses, or any file read by inference.read_fragments
+    fragments = []
+    for path in paths:
+        fragments += [strip_masks(x) for x in read_fragments(path, 'document' if path.endswith('.json') else None)]
+    return [x for x in dict.fromkeys(fragments) if x]
+
+
+def label_ids(sequence, eos_token_id, pad_token_id):
+    # the tokens of a generated sequence after the decoder start token, up to and including eos
+    ids = sequence[1:].tolist()
+    if eos_token_id in ids:
+        return ids[:ids.index(eos_token_id) + 1]
+    while ids and ids[-1] == pad_token_id:
+        ids.pop()
+    return ids
+
+
+def teacher_targets(model, tokenizer, documents, labels=None, top_k=8, temperature=2.0, max_tokens=4096,
+                    max_batch_size=64, max_length=512, **generate_kwargs):
+    # yields (index, input ids, label ids, top-k ids, top-k log probabilities) per document, batch by batch;
+    # the label is generated by the model unless given
+    encodings = tokenizer(list(documents), truncation=True, max_length=max_length)['input_ids']
+    references = tokenizer(list(labels), truncation=True, max_length=max_length)['input_ids'] if labels else None
+    lengths = [len(x) for x in encodings]
+    with torch.no_grad():
+        for batch in make_batches(lengths, max_tokens, max_batch_size):
+            input_ids, attention_mask = pad([encodings[i] for i in batch], tokenizer.pad_token_id)
+            if references is not None:
+                targets = [references[i] for i in batch]
+            else:
+                generated = model.generate(input_ids=input_ids, attention_mask=attention_mask, **generate_kwargs)
+                targets = [label_ids(x, tokenizer.eos_token_id, tokenizer.pad_token_id) for x in generated]
+            padded, _ = pad(targets, LABEL_PAD_TOKEN_ID)
+            logits = model(input_ids=input_ids, attention_mask=attention_mask, labels=padded).logits
+            log_probs, ids = F.log_softmax(logits.float() / temperature, dim=-1).topk(top_k, dim=-1)
+            for row, i in enumerate(batch):
+                n = len(targets[row])
+                yield i, encodings[i], targets[row], ids[row, :n].numpy(), log_probs[row, :n].numpy()
+
+
+def build_targets(model, tokenizer, output, unlabeled, labeled=None, top_k=8, temperature=2.0, **kwargs):
+    # writes the soft targets of the unlabeled fragments and of the labeled (document, summary) pairs to the
+    # directory output, replaced at once when complete; returns the number of samples
+    # the samples in the order of the fragments, then of the labeled pairs
+    samples = [None] * len(unlabeled)
+    start = time.perf_counter()
+    for n, (i, input_ids, target, ids, log_probs) in enumerate(teacher_targets(model, tokenizer, unlabeled, None, top_k,
+                                                                               temperature, **kwargs)):
+        samples[i] = (input_ids, target, ids, log_probs)
+        if (n + 1) % 500 == 0:
+            print('{} of {} fragments labeled, {:.1f} fragments/s'.format(n + 1, len(unlabeled),
+                                                                        (n + 1) / (time.perf_counter() - start)))
+    pseudo_labels = [tokenizer.decode(x[1], skip_special_tokens=True) for x in samples]
+    if labeled:
+        documents, summaries = labeled
+        labeled_samples = [None] * len(documents)
+        for i, input_ids, target, ids, log_probs in teacher_targets(model, tokenizer, documents, summaries, top_k,
+                                                                    temperature, **kwargs):
+            labeled_samples[i] = (input_ids, target, ids, log_probs)
+        samples += labeled_samples
+
+    tmp_dir = output + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    TokenArray.from_sequences([x[0] for x in samples]).save(os.path.join(tmp_dir, 'input_ids'))
+    TokenArray.from_sequences([x[1] for x in samples]).save(os.path.join(tmp_dir, 'labels'))
+    np.save(os.path.join(tmp_dir, 'soft_ids.npy'), np.concatenate([x[2] for x in samples]).astype(np.int32))
+    np.save(os.path.join(tmp_dir, 'soft_log_probs.npy'), np.concatenate([x[3] for x in samples]).astype(np.float16))
+    with open(os.path.join(tmp_dir, 'pseudo_labels.json'), 'w') as f:
+        json.dump({'document': list(unlabeled), 'summary': pseudo_labels}, f)
+    meta = {'version': TARGETS_VERSION, 'tokenizer': tokenizer_fingerprint(tokenizer), 'top_k': top_k,
+            'temperature': temperature, 'unlabeled': len(unlabeled), 'labeled': len(samples) - len(unlabeled)}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp_dir, output)
+    return len(samples)
+
+
+class DistillationDataset(Seq2SeqDataset):
+    # the samples of a directory of build_targets: input ids, label ids and the soft targets along the label,
+    # all memory-mapped
+    def __init__(self, targets_dir, tokenizer=None):
+        with open(os.path.join(targets_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != TARGETS_VERSION:
+            raise ValueError(targets_dir + ' was written by version ' + str(self.meta['version']) + ', not '
+                             + str(TARGETS_VERSION))
+        if tokenizer is not None and self.meta['tokenizer'] != tokenizer_fingerprint(tokenizer):
+            raise ValueError(targets_dir + ' holds the targets of another tokenizer')
+        super().__init__(TokenArray.load(os.path.join(targets_dir, 'input_ids')),
+                         TokenArray.load(os.path.join(targets_dir, 'labels')))
+        self.soft_ids = np.load(os.path.join(targets_dir, 'soft_ids.npy'), mmap_mode='r')
+        self.soft_log_probs = np.load(os.path.join(targets_dir, 'soft_log_probs.npy'), mmap_mode='r')
+
+    def __getitem__(self, idx):
+        start, end = self.labels.offsets[idx], self.labels.offsets[idx + 1]
+        return {'input_ids': self.input_ids[idx], 'labels': self.labels[idx],
+                'soft_ids': torch.from_numpy(np.array(self.soft_ids[start:end], dtype=np.int64)),
+                'soft_log_probs': torch.from_numpy(np.array(self.soft_log_probs[start:end], dtype=np.float32))}
+
+
+class DistillationCollator(Seq2SeqCollator):
+    # pads the soft targets of a batch to its longest label, as the labels
+    def __call__(self, items):
+        batch = super().__call__(items)
+        length = batch['labels'].size(1)
+        top_k = items[0]['soft_ids'].size(1)
+        batch['soft_ids'] = torch.zeros((len(items), length, top_k), dtype=torch.long)
+        batch['soft_log_probs'] = torch.zeros((len(items), length, top_k))
+        for i, x in enumerate(items):
+            batch['soft_ids'][i, :len(x['soft_ids'])] = x['soft_ids']
+            batch['soft_log_probs'][i, :len(x['soft_log_probs'])] = x['soft_log_probs']
+        return batch
+
+
+class DistillationLoss(nn.Module):
+    # alpha x the KL divergence of the student's next-token distribution at temperature T from the teacher's
+    # (renormalised over its top-k tokens), scaled by T^2, plus (1 - alpha) x the cross entropy of the labels
+    def __init__(self, model, alpha=0.5, temperature=2.0):
+        super().__init__()
+        self.model = model
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def forward(self, batch):
+        out = self.model(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'], labels=batch['labels'])
+        if self.alpha == 0:
+            return out.loss
+        log_probs = F.log_softmax(out.logits.float() / self.temperature, dim=-1).gather(-1, batch['soft_ids'])
+        teacher_log_probs = F.log_softmax(batch['soft_log_probs'], dim=-1)
+        kl = (teacher_log_probs.exp() * (teacher_log_probs - log_probs)).sum(dim=-1)
+        mask = batch['labels'] != LABEL_PAD_TOKEN_ID
+        kd = kl[mask].mean() * self.temperature ** 2
+        return self.alpha * kd + (1 - self.alpha) * out.loss
+
+
+def layer_map(n_teacher, n_student):
+    # evenly spaced layers of the teacher, the first and the last one included
+    return [int(round(x)) for x in np.linspace(0, n_teacher - 1, n_student)]
+
+
+def make_student(teacher, encoder_layers=4, decoder_layers=2):
+    # the teacher with encoder_layers and decoder_layers of its layers (embeddings and layer norms shared)
+    config = teacher.config.to_dict()
+    config.update(encoder_layers=encoder_layers, decoder_layers=decoder_layers)
+    student = PegasusForConditionalGeneration(type(teacher.config).from_dict(config))
+    student.generation_config = teacher.generation_config
+    layers = {'encoder': layer_map(teacher.config.encoder_layers, encoder_layers),
+              'decoder': layer_map(teacher.config.decoder_layers, decoder_layers)}
+    state_dict = {}
+    for name, value in teacher.state_dict().items():
+        parts = name.split('.')
+        if len(parts) > 3 and parts[2] == 'layers':
+            if int(parts[3]) not in layers[parts[1]]:
+                continue
+            parts[3] = str(layers[parts[1]].index(int(parts[3])))
+        state_dict['.'.join(parts)] = value
+    student.load_state_dict(state_dict)
+    return student
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def save_student(student, tokenizer, output_dir):
+    # a model directory, loaded with load_model(output_dir); replaced at once
+    tmp_dir = output_dir.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    student.save_pretrained(tmp_dir)
+    tokenizer.save_pretrained(tmp_dir)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+
+
+def read_labeled_split(path):
+    # the training and validation split of the fine-tuning notebook
+    from train_ddp import read_labeled
+    return read_labeled(path)
+
+
+def scorer_from_args(args):
+    kwargs = {k: v for k, v in [('model_type', args.scorer_model_type), ('num_layers', args.scorer_num_layers),
+                                ('baseline_path', args.scorer_baseline_path)] if v is not None}
+    return get_scorer(lang='en', rescale_with_baseline=True, cache_dir=args.cache_dir, **kwargs)
+
+
+class GenerateWith(object):
+    # the forward pass of model, and the generate() of generator (the same model in a faster backend)
+    def __init__(self, model, generator):
+        self.model = model
+        self.generator = generator
+
+    def __call__(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        return self.generator.generate(*args, **kwargs)
+
+
+def targets(args):
+    set_threads(args.threads)
+    model, tokenizer = load_model(args.model_name, args.input_model, 'cpu')
+    unlabeled = unlabeled_fragments(args.unlabeled)
+    labeled = None
+    if args.labeled:
+        doc_train, sum_train, _, _ = read_labeled_split(args.labeled)
+        labeled = (doc_train, sum_train)
+    generate_kwargs = {k: v for k, v in [('num_beams', args.num_beams), ('max_new_tokens', args.max_new_tokens)]
+                       if v is not None}
+    # the soft targets are computed by the fp32 forward pass of the model, also when labeling with another backend
+    teacher = GenerateWith(model, prepare_backend(model, args.backend))
+    start = time.perf_counter()
+    n = build_targets(teacher, tokenizer, args.output, unlabeled, labeled, args.top_k,
+                      args.temperature, max_tokens=args.max_tokens, **generate_kwargs)
+    print('{} samples ({} unlabeled fragments) in {:.0f} s, written to {}'.format(
+        n, len(unlabeled), time.perf_counter() - start, args.output))
+
+
+def train(args):
+    set_threads(args.threads)
+    torch.manual_seed(args.seed)
+    teacher, tokenizer = load_model(args.model_name, args.input_model, 'cpu')
+    student = make_student(teacher, args.encoder_layers, args.decoder_layers)
+    print('teacher {:.1f}M parameters, student {:.1f}M parameters'.format(count_parameters(teacher) / 1e6,
+                                                                          count_parameters(student) / 1e6))
+    del teacher
+    dataset = DistillationDataset(args.targets, tokenizer)
+    loader = grouped_loader(dataset, DistillationCollator(tokenizer.pad_token_id), args.batch_size, True,
+                            seed=args.seed)
+    _, _, doc_val, sum_val = read_labeled_split(args.labeled)
+    scorer = scorer_from_args(args)
+    optimizer = Adafactor(student.parameters(), scale_parameter=True, relative_step=True, warmup_init=True, lr=None)
+    es = EarlyStopping(mode='max', patience=args.es_patience)
+
+    def train_log(loss, batch_num, epoch, throughput):
+        print(f"Loss after " + str(batch_num).zfill(5) + f" steps: {loss:.3f}, "
+              f"{throughput['samples_per_s']:.1f} samples/s")
+
+    trainer = Trainer(student, optimizer, DistillationLoss(student, args.alpha, dataset.meta['temperature']), 'cpu',
+                      accumulation_steps=args.accumulation_steps, precision=args.precision, log_fn=train_log,
+                      log_every=args.log_every, checkpoint_path=args.checkpoint, early_stopping=es)
+    if args.resume:
+        trainer.load_checkpoint()
+    for epoch in range(trainer.epoch, args.epochs):
+        trainer.train_epoch(loader, epoch)
+        student.eval()
+        engine = InferenceEngine(student, tokenizer, 'cpu', max_tokens=args.max_tokens)
+        _, (P, R, F1) = generate_and_score(engine, doc_val, sum_val, scorer)
+        metric = F1.mean()
+        print(f"bert_score_P: {P.mean():.3f}, bert_score_R, {R.mean():.3f}, bert_score_F1, {metric:.3f}")
+        # the student of the best epoch so far is kept, also across a resumed run
+        if es.best is None or metric > es.best:
+            save_student(student, tokenizer, args.output_dir)
+        stop = es.step(metric)
+        trainer.end_epoch()
+        if stop:
+            break
+    print('best validation F1 {:.3f}, student saved to {}'.format(float(es.best), args.output_dir))
+
+
+def compare(args):
+    # the teacher and each student on the test fragments, with the same backend and generation settings
+    set_threads(args.threads)
+    with open(args.input, 'r') as f:
+        refs = json.load(f)[args.reference_key]
+    fragments = read_fragments(args.input, args.key)
+    generate_kwargs = {k: v for k, v in [('num_beams', args.num_beams), ('max_new_tokens', args.max_new_tokens)]
+                       if v is not None}
+    scorer = scorer_from_args(args)
+    results = []
+    for name, model_name, input_model in [('teacher', args.model_name, args.input_model)] + \
+                                         [(path, path, None) for path in args.student]:
+        model, tokenizer = load_model(model_name, input_model, 'cpu')
+        parameters = count_parameters(model)
+        model = prepare_backend(model, args.backend)
+        engine = InferenceEngine(model, tokenizer, 'cpu', max_tokens=args.max_tokens, **generate_kwargs)
+        stats = InferenceStats()
+        labels = engine.generate(fragments, stats)
+        _, _, F1 = scorer.score(labels, refs)
+        results.append((name, parameters, stats.summary(), float(F1.mean())))
+
+    print('model, parameters (M), fragments/s, speedup, p50 ms, p99 ms, F1, F1 - teacher F1, F1 retained')
+    teacher = results[0]
+    for name, parameters, summary, f1 in results:
+        print('{}, {:.1f}, {:.2f}, {:.2f}x, {:.0f}, {:.0f}, {:.4f}, {:+.4f}, {:.1%}'.format(
+            name, parameters / 1e6, summary['fragments_per_s'],
+            summary['fragments_per_s'] / teacher[2]['fragments_per_s'], summary['p50_latency_ms'],
+            summary['p99_latency_ms'], f1, f1 - teacher[3], f1 / teacher[3] if teacher[3] else 0.))
+
+
+def add_teacher_arguments(parser):
+    parser.add_argument('--model-name', default='google/pegasus-large')
+    parser.add_argument('--input-model', help='checkpoint of the fine-tuned teacher saved by save() in the notebooks')
+    parser.add_argument('--max-tokens', type=int, default=4096, help='token budget of a generation batch')
+    parser.add_argument('--threads', type=int, help='CPU threads, i.e. the number of physical cores')
+
+
+def add_scorer_arguments(parser):
+    parser.add_argument('--cache-dir', default='.bert_score_cache')
+    parser.add_argument('--scorer-model-type', help='BERTScore model, by default the one of lang en')
+    parser.add_argument('--scorer-num-layers', type=int)
+    parser.add_argument('--scorer-baseline-path')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='distillation of the fine-tuned labeler into a small student')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    targets_parser = subparsers.add_parser('targets', help='pseudo-labels and soft targets of the teacher')
+    add_teacher_arguments(targets_parser)
+    targets_parser.add_argument('--unlabeled', nargs='+', default=['./data/masked_sent_train.json'],
+                                help='i.e. ./data/masked_sent_train.json data_preprocessing/train_subprocess.json')
+    targets_parser.add_argument('--labeled', default='./data/train_test_labeled_dataset.json',
+                                help="soft targets along the reference labels of its training split too ('' for none)")
+    targets_parser.add_argument('--output', default='./distill/targets')
+    targets_parser.add_argument('--top-k', type=int, default=8, help='teacher probabilities kept per label token')
+    targets_parser.add_argument('--temperature', type=float, default=2.0)
+    targets_parser.add_argument('--backend', default='fp32', choices=BACKENDS,
+                                help='backend generating the pseudo-labels, see inference_backends.py')
+    targets_parser.add_argument('--num-beams', type=int)
+    targets_parser.add_argument('--max-new-tokens', type=int)
+
+    train_parser = subparsers.add_parser('train', help='train the student on the targets')
+    add_teacher_arguments(train_parser)
+    add_scorer_arguments(train_parser)
+    train_parser.add_argument('--targets', default='./distill/targets')
+    train_parser.add_argument('--labeled', default='./data/train_test_labeled_dataset.json',
+                              help='dataset of the validation split')
+    train_parser.add_argument('--output-dir', default='./model_student')
+    train_parser.add_argument('--encoder-layers', type=int, default=4)
+    train_parser.add_argument('--decoder-layers', type=int, default=2)
+    train_parser.add_argument('--alpha', type=float, default=0.5, help='weight of the soft targets in the loss')
+    train_parser.add_argument('--epochs', type=int, default=10)
+    train_parser.add_argument('--es-patience', type=int, default=3, help='0 to never stop early')
+    train_parser.add_argument('--batch-size', type=int, default=16)
+    train_parser.add_argument('--accumulation-steps', type=int, default=1)
+    train_parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'])
+    train_parser.add_argument('--checkpoint', help='path of the checkpoint written while training, and resumed from')
+    train_parser.add_argument('--resume', action='store_true')
+    train_parser.add_argument('--log-every', type=int, default=25, help='batches')
+    train_parser.add_argument('--seed', type=int, default=0)
+
+    compare_parser = subparsers.add_parser('compare', help='speedup and F1 of the students against the teacher')
+    compare_parser.add_argument('input', help="JSON dataset of fragments and reference labels, i.e. ./data/train_test_labeled_dataset.json")
+    add_teacher_arguments(compare_parser)
+    add_scorer_arguments(compare_parser)
+    compare_parser.add_argument('--student', nargs='+', required=True, help='model directories saved by train')
+    compare_parser.add_argument('--key', default='document_test')
+    compare_parser.add_argument('--reference-key', default='summary_test')
+    compare_parser.add_argument('--backend', default='fp32', choices=BACKENDS)
+    compare_parser.add_argument('--num-beams', type=int)
+    compare_parser.add_argument('--max-new-tokens', type=int)
+
+    args = parser.parse_args(argv)
+    {'targets': targets, 'train': train, 'compare': compare}[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
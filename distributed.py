@@ -0,0 +1,105 @@
+import contextlib
+import math
+import os
+
+import torch
+import torch.distributed as dist
+
+from data_module import LengthGroupedBatchSampler
+
+# Data-parallel training across CPU processes (and machines) with the gloo backend, see train_ddp.py:
+# every process trains a replica of the model on its own shard of the batches, and DistributedDataParallel
+# averages the gradients of the replicas before each optimizer step. Without an initialised process group,
+# all functions here behave as for a single process, so the same code runs in the notebooks.
+
+
+def init_distributed(backend='gloo'):
+    # joins the process group of a launch by torchrun (RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT are set);
+    # returns the rank of this process and the number of processes
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ and not dist.is_initialized():
+        dist.init_process_group(backend)
+    return get_rank(), get_world_size()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    # the process that logs and writes checkpoints
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def local_main_process_first():
+    # the first process of each machine runs the block (i.e. writes the tokenized caches) before the others,
+    # which then find its results
+    local_main = int(os.environ.get('LOCAL_RANK', get_rank())) == 0
+    if not local_main:
+        barrier()
+    yield
+    if local_main:
+        barrier()
+
+
+def all_reduce_sum(values):
+    # element-wise sums of the values (numbers) over all processes
+    tensor = torch.tensor(values, dtype=torch.float64)
+    if is_distributed():
+        dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def gather_object(obj):
+    # the objects of all processes, by rank
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+class DistributedLengthGroupedBatchSampler(LengthGroupedBatchSampler):
+    # the batches of LengthGroupedBatchSampler, drawn alike by every process (from seed and set_epoch), and dealt
+    # out in turn: process rank takes batches rank, rank + num_replicas, ...; with even, the first batches are
+    # repeated so that every process has as many batches, as DistributedDataParallel needs the same number of
+    # steps on every process (for validation, even=False leaves each batch to exactly one process)
+    def __init__(self, lengths, batch_size, shuffle=True, group_size=50, seed=0, drop_last=False, num_replicas=None,
+                 rank=None, even=True):
+        super().__init__(lengths, batch_size, shuffle, group_size, seed, drop_last)
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+        self.even = even
+
+    def shard(self, batches):
+        if self.even and batches:
+            total = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+            batches = (batches * math.ceil(total / len(batches)))[:total]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.shard(self.batches((self.seed, self.epoch))))
+
+    def __len__(self):
+        n_batches = super().__len__()
+        if self.even:
+            return math.ceil(n_batches / self.num_replicas)
+        return len(range(self.rank, n_batches, self.num_replicas))
@@ -0,0 +1,209 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import torch
+from transformers import PegasusForConditionalGeneration, PegasusTokenizerFast
+
+# Generate activity labels for process fragments with a (fine-tuned) Pegasus model.
+# Fragments are the linearised process text the model is trained on, i.e. the task labels of a flow
+# sorted by sort_process_flows, joined with ", ".
+# Fragments are sorted by token length and cut into batches under a token budget, so a batch holds
+# many short fragments or few long ones, and little padding is generated; the labels are yielded
+# batch by batch as they complete, in the order of the batches, with the index of their fragment.
+
+
+def set_threads(num_threads=None, num_interop_threads=None):
+    # number of CPU threads used within (and across) ops, i.e. the physical cores of the machine
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work has started
+            pass
+
+
+def load_model(model_name='google/pegasus-large', input_model=None, device='cpu', backend='fp32', export_dir=None):
+    # load tokenizer and model, and the weights of a checkpoint saved by save() in the notebooks;
+    # backend 'int8' or 'exported' (CPU only) returns the model to generate with in it, see inference_backends.py
+    tokenizer = PegasusTokenizerFast.from_pretrained(model_name)
+    model = PegasusForConditionalGeneration.from_pretrained(model_name, return_dict=True)
+    if input_model:
+        checkpoint = torch.load(input_model, map_location='cpu')
+        state_dict = checkpoint.get('model_state_dict', checkpoint)
+        # checkpoints of a model wrapped in nn.DataParallel have their keys prefixed with 'module.'
+        state_dict = {(k[len('module.'):] if k.startswith('module.') else k): v for k, v in state_dict.items()}
+        model.load_state_dict(state_dict)
+    model.to(device)
+    model.eval()
+    if backend != 'fp32':
+        from inference_backends import prepare_backend
+        model = prepare_backend(model, backend, export_dir)
+    return model, tokenizer
+
+
+def linearise(labels):
+    # a sorted flow (list of labels) as the process text the model is trained on
+    return ", ".join(labels)
+
+
+def read_fragments(path, key=None):
+    # fragments from a JSON file: a list of fragments (or of label lists), or a dict holding one,
+    # i.e. 'document_test' of the labeled dataset or 'document' of the masked sentences;
+    # any other file is read as one fragment per line
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            if key is None:
+                key = next(k for k in ['document_test', 'document'] if k in data)
+            data = data[key]
+        return [x if isinstance(x, str) else linearise(x) for x in data]
+    with open(path, 'r') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def make_batches(lengths, max_tokens=4096, max_batch_size=64, max_padding=0.25):
+    # indices of the fragments, sorted by length and cut into batches of at most max_tokens
+    # (padded length x batch size) and max_batch_size fragments, in which no fragment is padded by
+    # more than max_padding of its batch's length; the longest batches come first, so that running
+    # out of memory shows at once
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    batch = []
+    for i in order:
+        # the first fragment of a batch is its longest one
+        padded_length = lengths[batch[0]] if batch else lengths[i]
+        if batch and ((len(batch) + 1) * padded_length > max_tokens or len(batch) == max_batch_size
+                      or lengths[i] < (1 - max_padding) * padded_length):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class InferenceStats(object):
+    # throughput and latency of a generation run; the latency of a fragment is the time its batch took
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.latencies = []
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def add_batch(self, batch_size, tokens, padded_tokens, latency):
+        self.latencies += [latency] * batch_size
+        self.tokens += tokens
+        self.padded_tokens += padded_tokens
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {'fragments': len(self.latencies),
+                'seconds': elapsed,
+                'fragments_per_s': len(self.latencies) / elapsed if elapsed > 0 else 0.,
+                'p50_latency_ms': float(np.percentile(latencies, 50) * 1000),
+                'p99_latency_ms': float(np.percentile(latencies, 99) * 1000),
+                'padding': 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.}
+
+    def __str__(self):
+        return ('{fragments} fragments in {seconds:.2f} s: {fragments_per_s:.1f} fragments/s, '
+                'latency p50 {p50_latency_ms:.0f} ms, p99 {p99_latency_ms:.0f} ms, padding {padding:.1%}').format(
+            **self.summary())
+
+
+class InferenceEngine(object):
+    # batched label generation for process fragments, see the top of this file
+    def __init__(self, model, tokenizer, device='cpu', max_tokens=4096, max_batch_size=64, max_padding=0.25,
+                 max_length=512, **generate_kwargs):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_padding = max_padding
+        # fragments longer than max_length tokens are truncated, as in training
+        self.max_length = max_length
+        # passed on to model.generate, i.e. num_beams or max_new_tokens
+        self.generate_kwargs = generate_kwargs
+
+    def stream_batches(self, fragments, stats=None):
+        # generate the labels of the fragments, yielding (indices, labels) per batch as it completes
+        if stats is None:
+            stats = InferenceStats()
+        encodings = self.tokenizer(list(fragments), truncation=True, max_length=self.max_length)['input_ids']
+        lengths = [len(x) for x in encodings]
+        with torch.no_grad():
+            for batch in make_batches(lengths, self.max_tokens, self.max_batch_size, self.max_padding):
+                start = time.perf_counter()
+                inputs = self.tokenizer.pad({'input_ids': [encodings[i] for i in batch]}, padding='longest',
+                                            return_tensors='pt').to(self.device)
+                generated = self.model.generate(**inputs, **self.generate_kwargs)
+                labels = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+                stats.add_batch(len(batch), sum(lengths[i] for i in batch), inputs['input_ids'].numel(),
+                                time.perf_counter() - start)
+                yield batch, labels
+
+    def stream(self, fragments, stats=None):
+        # generate the labels of the fragments, yielding (index, label) per fragment as each batch completes
+        for batch, labels in self.stream_batches(fragments, stats):
+            for i, label in zip(batch, labels):
+                yield i, label
+
+    def generate(self, fragments, stats=None):
+        # the labels of the fragments, in the order of the fragments
+        labels = [None] * len(fragments)
+        for i, label in self.stream(fragments, stats):
+            labels[i] = label
+        return labels
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='generate activity labels for process fragments with Pegasus')
+    parser.add_argument('input', help='JSON file of fragments (or label lists), or a text file of one fragment per line')
+    parser.add_argument('--key', help="key of the fragments in a JSON dict, by default 'document_test' or 'document'")
+    parser.add_argument('--model-name', default='google/pegasus-large')
+    parser.add_argument('--input-model', help='checkpoint saved by save() in the notebooks, i.e. ./model_summarization/summarization_7_epoch.pth')
+    parser.add_argument('--backend', default='fp32', choices=['fp32', 'int8', 'exported'],
+                        help='int8 quantised or exported graphs on CPU, see inference_backends.py')
+    parser.add_argument('--export-dir', help='directory the exported graphs are saved to, and loaded from if present')
+    parser.add_argument('--output', help='JSON lines file of the labels, written as they complete (default: stdout)')
+    parser.add_argument('--max-tokens', type=int, default=4096, help='token budget of a batch, padding included')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-padding', type=float, default=0.25, help='largest share of a fragment that is padding')
+    parser.add_argument('--max-length', type=int, default=512, help='fragments are truncated to max-length tokens')
+    # the generation config of the model is used for anything not given here
+    parser.add_argument('--num-beams', type=int)
+    parser.add_argument('--max-new-tokens', type=int)
+    parser.add_argument('--threads', type=int, help='CPU threads, i.e. the number of physical cores')
+    parser.add_argument('--interop-threads', type=int)
+    args = parser.parse_args(argv)
+
+    set_threads(args.threads, args.interop_threads)
+    device = 'cuda:0' if torch.cuda.is_available() and args.backend == 'fp32' else 'cpu'
+    model, tokenizer = load_model(args.model_name, args.input_model, device, args.backend, args.export_dir)
+    fragments = read_fragments(args.input, args.key)
+    generate_kwargs = {k: v for k, v in [('num_beams', args.num_beams), ('max_new_tokens', args.max_new_tokens)]
+                       if v is not None}
+    engine = InferenceEngine(model, tokenizer, device, max_tokens=args.max_tokens, max_batch_size=args.max_batch_size,
+                             max_padding=args.max_padding, max_length=args.max_length, **generate_kwargs)
+
+    stats = InferenceStats()
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for i, label in engine.stream(fragments, stats):
+            out.write(json.dumps({'index': i, 'fragment': fragments[i], 'label': label}) + '\n')
+            out.flush()
+    finally:
+        if args.output:
+            out.close()
+    print(stats, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+import argparse
+import copy
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.export import Dim, export
+
+from inference import InferenceEngine, InferenceStats, load_model, read_fragments, set_threads
+
+# CPU inference backends of the fine-tuned Pegasus labeler, for InferenceEngine and label_server.py:
+# - 'fp32': PegasusForConditionalGeneration.generate, as in the evaluation notebook
+# - 'int8': the same model with its linear layers quantised to int8 weights, the activations are quantised on the
+#   fly per batch (dynamic quantisation)
+# - 'exported': the encoder and one decoder step with its KV cache exported as graphs (torch.export) and run by the
+#   CPU runtime of torch; the encoder runs once per batch and computes the keys and values of the cross-attention
+#   of all layers, the decoder step runs once per generated token on the last token only, and greedy or beam
+#   search around it follows model.generate
+# main() compares the backends on the test fragments: throughput, latency, and the BERTScore F1 of their labels
+# against summary_test, which should stay within a tolerance of the F1 of fp32.
+
+BACKENDS = ['fp32', 'int8', 'exported']
+
+
+def quantize(model):
+    # a copy of the model with int8 dynamically quantised linear layers (the lm_head included)
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+
+
+def activation(name):
+    if name == 'relu':
+        return F.relu
+    if name == 'gelu':
+        return F.gelu
+    if name in ['gelu_new', 'gelu_pytorch_tanh']:
+        return lambda x: F.gelu(x, approximate='tanh')
+    raise ValueError('activation_function ' + name + ' is unknown!')
+
+
+def split_heads(x, num_heads):
+    # (batch, length, d_model) -> (batch, heads, length, head_dim)
+    return x.view(x.size(0), x.size(1), num_heads, -1).transpose(1, 2)
+
+
+def attend(q, k, v, scaling, mask=None):
+    # scaled dot-product attention of (batch, heads, length, head_dim) tensors, mask is added to the weights
+    weights = torch.matmul(q, k.transpose(2, 3)) * scaling
+    if mask is not None:
+        weights = weights + mask
+    out = torch.matmul(F.softmax(weights, dim=-1), v)
+    return out.transpose(1, 2).reshape(out.size(0), out.size(2), -1)
+
+
+class EncoderGraph(nn.Module):
+    # the encoder of the model, returning the keys and values of the cross-attention of every decoder layer,
+    # stacked as (layers, batch, heads, source length, head_dim), and the additive mask of the padding
+    def __init__(self, model):
+        super().__init__()
+        encoder = model.get_encoder()
+        self.embed_tokens = encoder.embed_tokens
+        self.embed_scale = encoder.embed_scale
+        self.register_buffer('positions', encoder.embed_positions.weight.detach().clone(), persistent=False)
+        self.layers = encoder.layers
+        self.layer_norm = encoder.layer_norm
+        self.cross_attn = nn.ModuleList([layer.encoder_attn for layer in model.get_decoder().layers])
+        self.num_heads = model.config.encoder_attention_heads
+        self.num_decoder_heads = model.config.decoder_attention_heads
+        self.act = activation(model.config.activation_function)
+
+    def forward(self, input_ids, attention_mask):
+        h = self.embed_tokens(input_ids) * self.embed_scale + self.positions[:input_ids.size(1)]
+        mask = (1.0 - attention_mask[:, None, None, :].to(h.dtype)) * torch.finfo(h.dtype).min
+        for layer in self.layers:
+            attn = layer.self_attn
+            x = layer.self_attn_layer_norm(h)
+            h = h + attn.out_proj(attend(split_heads(attn.q_proj(x), self.num_heads),
+                                         split_heads(attn.k_proj(x), self.num_heads),
+                                         split_heads(attn.v_proj(x), self.num_heads), attn.scaling, mask))
+            x = layer.final_layer_norm(h)
+            h = h + layer.fc2(self.act(layer.fc1(x)))
+        h = self.layer_norm(h)
+        cross_k = torch.stack([split_heads(attn.k_proj(h), self.num_decoder_heads) for attn in self.cross_attn])
+        cross_v = torch.stack([split_heads(attn.v_proj(h), self.num_decoder_heads) for attn in self.cross_attn])
+        return cross_k, cross_v, mask
+
+
+class DecoderStepGraph(nn.Module):
+    # one step of the decoder on the last token of each sequence: the keys and values of the self-attention of
+    # the tokens before are the cache, (layers, batch, heads, tokens so far, head_dim), which may be empty;
+    # returns the logits of the next token and the cache with the last token appended
+    def __init__(self, model):
+        super().__init__()
+        decoder = model.get_decoder()
+        self.embed_tokens = decoder.embed_tokens
+        self.embed_scale = decoder.embed_scale
+        self.register_buffer('positions', decoder.embed_positions.weight.detach().clone(), persistent=False)
+        self.layers = decoder.layers
+        self.layer_norm = decoder.layer_norm
+        self.lm_head = model.lm_head
+        self.register_buffer('final_logits_bias', model.final_logits_bias.detach().clone(), persistent=False)
+        self.num_heads = model.config.decoder_attention_heads
+        self.act = activation(model.config.activation_function)
+
+    def forward(self, input_ids, self_k, self_v, cross_k, cross_v, encoder_mask):
+        position = self_k.size(3)
+        h = self.embed_tokens(input_ids) * self.embed_scale + torch.narrow(self.positions, 0, position, 1)
+        keys = []
+        values = []
+        for i, layer in enumerate(self.layers):
+            # the last token attends to all tokens so far, no causal mask is needed
+            attn = layer.self_attn
+            x = layer.self_attn_layer_norm(h)
+            k = torch.cat([self_k[i], split_heads(attn.k_proj(x), self.num_heads)], dim=2)
+            v = torch.cat([self_v[i], split_heads(attn.v_proj(x), self.num_heads)], dim=2)
+            keys.append(k)
+            values.append(v)
+            h = h + attn.out_proj(attend(split_heads(attn.q_proj(x), self.num_heads), k, v, attn.scaling))
+            attn = layer.encoder_attn
+            x = layer.encoder_attn_layer_norm(h)
+            h = h + attn.out_proj(attend(split_heads(attn.q_proj(x), self.num_heads), cross_k[i], cross_v[i],
+                                         attn.scaling, encoder_mask))
+            x = layer.final_layer_norm(h)
+            h = h + layer.fc2(self.act(layer.fc1(x)))
+        h = self.layer_norm(h)
+        logits = self.lm_head(h[:, 0]) + self.final_logits_bias
+        return logits, torch.stack(keys), torch.stack(values)
+
+
+def export_graphs(model, max_batch_size=1024):
+    # the exported programs of the encoder and the decoder step, with dynamic batch and lengths
+    config = model.config
+    max_positions = config.max_position_embeddings
+    layers, heads = config.decoder_layers, config.decoder_attention_heads
+    head_dim = config.d_model // heads
+    batch = Dim('batch', min=1, max=max_batch_size)
+    source = Dim('source', min=1, max=max_positions)
+    target = Dim('target', min=0, max=max_positions - 1)
+    with torch.no_grad():
+        input_ids = torch.full((2, 8), config.eos_token_id, dtype=torch.long)
+        attention_mask = torch.ones((2, 8), dtype=torch.long)
+        encoder = export(EncoderGraph(model).eval(), (input_ids, attention_mask),
+                         dynamic_shapes=({0: batch, 1: source}, {0: batch, 1: source}))
+        cross_k, cross_v, mask = encoder.module()(input_ids, attention_mask)
+        # distinct example tensors for the keys and the values, the same one twice would be traced as one input
+        self_k = torch.zeros((layers, 2, heads, 3, head_dim))
+        self_v = torch.zeros((layers, 2, heads, 3, head_dim))
+        decoder = export(DecoderStepGraph(model).eval(),
+                         (input_ids[:, :1], self_k, self_v, cross_k, cross_v, mask),
+                         dynamic_shapes=({0: batch}, {1: batch, 3: target}, {1: batch, 3: target},
+                                         {1: batch, 3: source}, {1: batch, 3: source}, {0: batch, 3: source}))
+    return encoder, decoder
+
+
+def generation_defaults(model):
+    # the settings of model.generate that the exported backend follows, from the generation config of the model
+    config = model.generation_config
+    # unset values fall back to the defaults of model.generate
+    return {'num_beams': config.num_beams or 1, 'max_length': config.max_length or 20,
+            'length_penalty': 1.0 if config.length_penalty is None else config.length_penalty,
+            'early_stopping': config.early_stopping or False,
+            'decoder_start_token_id': config.decoder_start_token_id, 'eos_token_id': config.eos_token_id,
+            'pad_token_id': config.pad_token_id, 'forced_eos_token_id': config.forced_eos_token_id}
+
+
+class ExportedPegasus(object):
+    # the 'exported' backend: generate() takes the batches of InferenceEngine as model.generate does, and returns
+    # the sequences, starting with the decoder start token and padded with pad_token_id
+    def __init__(self, encoder, decoder, config):
+        self.encoder_program = encoder
+        self.decoder_program = decoder
+        self.encoder = encoder.module()
+        self.decoder = decoder.module()
+        self.config = config
+        # the graphs take at most max_batch_size rows (graphs saved before it was recorded were exported with 1024),
+        # larger batches, i.e. a batch expanded to batch x num_beams rows for beam search, are run in chunks
+        self.max_batch_size = config.get('max_batch_size', 1024)
+
+    @classmethod
+    def from_model(cls, model, max_batch_size=1024):
+        encoder, decoder = export_graphs(model, max_batch_size)
+        return cls(encoder, decoder, dict(generation_defaults(model), max_batch_size=max_batch_size))
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        torch.export.save(self.encoder_program, os.path.join(directory, 'encoder.pt2'))
+        torch.export.save(self.decoder_program, os.path.join(directory, 'decoder.pt2'))
+        with open(os.path.join(directory, 'generation.json'), 'w') as f:
+            json.dump(self.config, f, indent=2)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'generation.json'), 'r') as f:
+            config = json.load(f)
+        return cls(torch.export.load(os.path.join(directory, 'encoder.pt2')),
+                   torch.export.load(os.path.join(directory, 'decoder.pt2')), config)
+
+    def eval(self):
+        return self
+
+    def encode(self, input_ids, attention_mask=None):
+        # the keys and values of the cross-attention and the padding mask of a batch, to be passed to generate()
+        # as encoder_outputs, i.e. to decode the same batch with several settings
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        n = self.max_batch_size
+        with torch.no_grad():
+            if input_ids.size(0) <= n:
+                return self.encoder(input_ids, attention_mask)
+            chunks = [self.encoder(input_ids[i:i + n], attention_mask[i:i + n]) for i in range(0, input_ids.size(0), n)]
+            return (torch.cat([x[0] for x in chunks], dim=1), torch.cat([x[1] for x in chunks], dim=1),
+                    torch.cat([x[2] for x in chunks], dim=0))
+
+    def decode(self, input_ids, self_k, self_v, cross_k, cross_v, mask):
+        # a step of the decoder graph, in chunks of at most max_batch_size rows
+        n = self.max_batch_size
+        if input_ids.size(0) <= n:
+            return self.decoder(input_ids, self_k, self_v, cross_k, cross_v, mask)
+        chunks = [self.decoder(input_ids[i:i + n], self_k[:, i:i + n], self_v[:, i:i + n], cross_k[:, i:i + n],
+                               cross_v[:, i:i + n], mask[i:i + n]) for i in range(0, input_ids.size(0), n)]
+        return (torch.cat([x[0] for x in chunks], dim=0), torch.cat([x[1] for x in chunks], dim=1),
+                torch.cat([x[2] for x in chunks], dim=1))
+
+    def generate(self, input_ids=None, attention_mask=None, num_beams=None, max_new_tokens=None, max_length=None,
+                 length_penalty=None, early_stopping=None, encoder_outputs=None):
+        num_beams = num_beams or self.config['num_beams']
+        if max_new_tokens is not None:
+            # the decoder start token is the prompt of the decoder
+            max_length = max_new_tokens + 1
+        max_length = max_length or self.config['max_length']
+        length_penalty = self.config['length_penalty'] if length_penalty is None else length_penalty
+        early_stopping = self.config['early_stopping'] if early_stopping is None else early_stopping
+        if encoder_outputs is None:
+            encoder_outputs = self.encode(input_ids, attention_mask)
+        cross_k, cross_v, mask = encoder_outputs
+        with torch.no_grad():
+            if num_beams == 1:
+                return self.greedy_search(cross_k, cross_v, mask, max_length)
+            return self.beam_search(cross_k, cross_v, mask, num_beams, max_length, length_penalty, early_stopping)
+
+    def empty_cache(self, cross_k, batch_size):
+        layers, _, heads, _, head_dim = cross_k.shape
+        return cross_k.new_zeros((layers, batch_size, heads, 0, head_dim))
+
+    def log_probs(self, logits, cur_len, max_length):
+        # the logits processors of model.generate: the eos token is forced as the last token
+        log_probs = F.log_softmax(logits.float(), dim=-1)
+        forced_eos = self.config['forced_eos_token_id']
+        if forced_eos is not None and cur_len == max_length - 1:
+            log_probs = torch.full_like(log_probs, -float('inf'))
+            log_probs[:, forced_eos] = 0
+        return log_probs
+
+    def greedy_search(self, cross_k, cross_v, mask, max_length):
+        eos, pad = self.config['eos_token_id'], self.config['pad_token_id']
+        batch_size = cross_k.size(1)
+        sequences = torch.full((batch_size, 1), self.config['decoder_start_token_id'], dtype=torch.long)
+        self_k = self_v = self.empty_cache(cross_k, batch_size)
+        unfinished = torch.ones(batch_size, dtype=torch.bool)
+        for cur_len in range(1, max_length):
+            logits, self_k, self_v = self.decode(sequences[:, -1:], self_k, self_v, cross_k, cross_v, mask)
+            tokens = self.log_probs(logits, cur_len, max_length).argmax(dim=-1)
+            tokens = torch.where(unfinished, tokens, torch.full_like(tokens, pad))
+            sequences = torch.cat([sequences, tokens[:, None]], dim=1)
+            unfinished &= tokens != eos
+            if not unfinished.any():
+                break
+        return sequences
+
+    def beam_search(self, cross_k, cross_v, mask, num_beams, max_length, length_penalty, early_stopping):
+        # the beam search of model.generate: the 2 x num_beams best continuations of all beams of a fragment are
+        # drawn, the ones ending in eos (or at max_length) are finished hypotheses scored by their log probability
+        # over their length ** length_penalty, the best num_beams others continue
+        eos, pad = self.config['eos_token_id'], self.config['pad_token_id']
+        batch_size = cross_k.size(1)
+        cross_k = cross_k.repeat_interleave(num_beams, dim=1)
+        cross_v = cross_v.repeat_interleave(num_beams, dim=1)
+        mask = mask.repeat_interleave(num_beams, dim=0)
+        self_k = self_v = self.empty_cache(cross_k, batch_size * num_beams)
+        keep = 2 * num_beams
+        offsets = torch.arange(batch_size)[:, None] * num_beams
+        # the running beams and the finished hypotheses, (batch, num_beams, max_length)
+        running = torch.full((batch_size, num_beams, max_length), pad, dtype=torch.long)
+        running[:, :, 0] = self.config['decoder_start_token_id']
+        running_scores = torch.zeros((batch_size, num_beams))
+        running_scores[:, 1:] = -1e9
+        finished = torch.full((batch_size, num_beams, max_length), pad, dtype=torch.long)
+        finished_scores = torch.full((batch_size, num_beams), -1e9)
+        finished_lengths = torch.ones((batch_size, num_beams), dtype=torch.long)
+        is_finished = torch.zeros((batch_size, num_beams), dtype=torch.bool)
+        improvable = torch.ones((batch_size, 1), dtype=torch.bool)
+        top_beams = torch.arange(keep) < num_beams
+        for cur_len in range(1, max_length):
+            logits, self_k, self_v = self.decode(running[:, :, cur_len - 1].reshape(-1, 1), self_k, self_v,
+                                                 cross_k, cross_v, mask)
+            log_probs = self.log_probs(logits, cur_len, max_length)
+            vocab_size = log_probs.size(-1)
+            log_probs = (log_probs.view(batch_size, num_beams, -1) + running_scores[:, :, None]).view(batch_size, -1)
+            top_scores, top_indices = log_probs.topk(keep, dim=1)
+            beams = top_indices // vocab_size
+            tokens = top_indices % vocab_size
+            candidates = running.gather(1, beams[:, :, None].expand(-1, -1, max_length)).clone()
+            candidates[:, :, cur_len] = tokens
+            done = (tokens == eos) | (cur_len + 1 >= max_length)
+
+            # the best num_beams unfinished continuations run on
+            next_beams = (top_scores - done.float() * 1e9).topk(num_beams, dim=1)[1]
+            running = candidates.gather(1, next_beams[:, :, None].expand(-1, -1, max_length))
+            running_scores = (top_scores - done.float() * 1e9).gather(1, next_beams)
+            source = (beams.gather(1, next_beams) + offsets).view(-1)
+
+            # the finished continuations among the top num_beams replace worse hypotheses
+            scores = top_scores / (cur_len ** length_penalty)
+            if early_stopping is True:
+                scores = scores - (is_finished.all(dim=1, keepdim=True)).float() * 1e9
+            scores = scores - (~improvable).float() * 1e9 - (~(done & top_beams)).float() * 1e9
+            merged = torch.cat([finished_scores, scores], dim=1).topk(num_beams, dim=1)[1]
+            finished = torch.cat([finished, candidates], dim=1).gather(1, merged[:, :, None].expand(-1, -1, max_length))
+            finished_scores = torch.cat([finished_scores, scores], dim=1).gather(1, merged)
+            finished_lengths = torch.cat([finished_lengths, torch.full_like(tokens, cur_len + 1)],
+                                         dim=1).gather(1, merged)
+            is_finished = torch.cat([is_finished, done & top_beams], dim=1).gather(1, merged)
+
+            self_k = self_k.index_select(1, source)
+            self_v = self_v.index_select(1, source)
+
+            # whether the best running beam could still beat the worst hypothesis, as estimated by model.generate
+            if early_stopping == 'never' and length_penalty > 0.0:
+                best_length = max_length - 1
+            else:
+                best_length = cur_len
+            best_running = running_scores[:, :1] / (best_length ** length_penalty)
+            worst_finished = torch.where(is_finished, finished_scores.min(dim=1, keepdim=True)[0],
+                                         torch.full_like(finished_scores, -1e9))
+            improvable = improvable & (best_running > worst_finished).any(dim=1, keepdim=True)
+            if (not improvable.any() or (early_stopping is True and is_finished.all())) or done.all():
+                break
+        return finished[:, 0, :int(finished_lengths[:, 0].max())]
+
+
+def prepare_backend(model, backend='fp32', export_dir=None):
+    # the model to generate with in the backend; the exported graphs are loaded from export_dir if saved there
+    # (they hold the weights of the checkpoint they were exported from, a new checkpoint needs a new export_dir)
+    if backend == 'fp32':
+        return model
+    if backend == 'int8':
+        return quantize(model)
+    if backend == 'exported':
+        if export_dir and os.path.exists(os.path.join(export_dir, 'generation.json')):
+            return ExportedPegasus.load(export_dir)
+        exported = ExportedPegasus.from_model(model)
+        if export_dir:
+            exported.save(export_dir)
+        return exported
+    raise ValueError('backend ' + backend + ' is unknown!')
+
+
+def main(argv=None):
+    # labels of the test fragments by each backend: throughput, latency and BERTScore F1 against the references
+    parser = argparse.ArgumentParser(description='compare the CPU inference backends of the Pegasus labeler')
+    parser.add_argument('input', help="JSON dataset of fragments and reference labels, i.e. ./data/train_test_labeled_dataset.json")
+    parser.add_argument('--key', default='document_test')
+    parser.add_argument('--reference-key', default='summary_test')
+    parser.add_argument('--model-name', default='google/pegasus-large')
+    parser.add_argument('--input-model', help='checkpoint saved by save() in the notebooks, i.e. ./model_summarization/summarization_7_epoch.pth')
+    parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS)
+    parser.add_argument('--export-dir', help='directory the exported graphs are saved to, and loaded from if present')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='largest drop of the mean BERTScore F1 against fp32')
+    parser.add_argument('--max-tokens', type=int, default=4096)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--num-beams', type=int)
+    parser.add_argument('--max-new-tokens', type=int)
+    parser.add_argument('--threads', type=int, help='CPU threads, i.e. the number of physical cores')
+    parser.add_argument('--output', help='JSON file of the labels of each backend')
+    parser.add_argument('--cache-dir', default='.bert_score_cache')
+    parser.add_argument('--scorer-model-type', help='BERTScore model, by default the one of lang en')
+    parser.add_argument('--scorer-num-layers', type=int)
+    parser.add_argument('--scorer-baseline-path')
+    args = parser.parse_args(argv)
+
+    from bert_scoring import get_scorer
+
+    set_threads(args.threads)
+    model, tokenizer = load_model(args.model_name, args.input_model, 'cpu')
+    with open(args.input, 'r') as f:
+        refs = json.load(f)[args.reference_key]
+    fragments = read_fragments(args.input, args.key)
+    generate_kwargs = {k: v for k, v in [('num_beams', args.num_beams), ('max_new_tokens', args.max_new_tokens)]
+                       if v is not None}
+    scorer_kwargs = {k: v for k, v in [('model_type', args.scorer_model_type), ('num_layers', args.scorer_num_layers),
+                                       ('baseline_path', args.scorer_baseline_path)] if v is not None}
+    scorer = get_scorer(lang='en', rescale_with_baseline=True, cache_dir=args.cache_dir, **scorer_kwargs)
+
+    results = {}
+    labels = {}
+    # fp32 first, the reference of the parity check
+    for backend in sorted(set(args.backends) | {'fp32'}, key=BACKENDS.index):
+        start = time.perf_counter()
+        backend_model = prepare_backend(model, backend, args.export_dir)
+        prepare_seconds = time.perf_counter() - start
+        engine = InferenceEngine(backend_model, tokenizer, 'cpu', max_tokens=args.max_tokens,
+                                 max_batch_size=args.max_batch_size, **generate_kwargs)
+        stats = InferenceStats()
+        labels[backend] = engine.generate(fragments, stats)
+        _, _, F1 = scorer.score(labels[backend], refs)
+        results[backend] = dict(stats.summary(), prepare_seconds=prepare_seconds, f1=float(F1.mean()))
+
+    print('backend, prepare s, fragments/s, speedup, p50 ms, p99 ms, F1, F1 - fp32 F1, same labels as fp32, parity')
+    reference = results['fp32']
+    for backend, result in results.items():
+        same = sum(a == b for a, b in zip(labels[backend], labels['fp32'])) / max(len(fragments), 1)
+        delta = result['f1'] - reference['f1']
+        print('{}, {:.1f}, {:.2f}, {:.2f}x, {:.0f}, {:.0f}, {:.4f}, {:+.4f}, {:.1%}, {}'.format(
+            backend, result['prepare_seconds'], result['fragments_per_s'],
+            result['fragments_per_s'] / reference['fragments_per_s'], result['p50_latency_ms'],
+            result['p99_latency_ms'], result['f1'], delta, same, 'ok' if delta >= -args.tolerance else 'FAILED'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results, 'labels': labels}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
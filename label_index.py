@@ -0,0 +1,361 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+import numpy as np
+import torch
+
+from inference import InferenceEngine, InferenceStats, linearise, load_model, make_batches, read_fragments, set_threads
+from inference_backends import BACKENDS
+from pegasus_tml import get_eos_idx
+
+# Labels of already labeled fragments, looked up before generating: many BPMAI fragments are (near) copies of the
+# documents of the labeled datasets (final_labeled_dataset.json, the training split of the labeled dataset).
+# - LabelIndex holds the labeled documents, normalised (lowercased, whitespace collapsed) in a dict for exact
+#   lookups, and their L2-normalised embeddings in one matrix for nearest neighbour lookups: the similarities of
+#   a batch of fragments to all documents are one matrix product, and their top k one torch.topk
+# - embeddings are the encoder's last hidden state at </s>, as PegasusTMLModel represents a sentence
+#   (EncoderEmbedder), or the inferred vectors of a Doc2Vec model as in doc2vec_labeled_data.ipynb
+#   (Doc2VecEmbedder)
+# - RetrievalLabeler returns the stored label of an exact match, or of the nearest document if its cosine
+#   similarity is at least the threshold, and generates the labels of the other fragments, optionally with the
+#   labels of their nearest documents in the input (context)
+#
+# python label_index.py build human_evaluation/process_model_distribution/files/final_labeled_dataset.json --input-model ./model_summarization/summarization_7_epoch.pth --output ./label_index
+# python label_index.py label data/train_test_labeled_dataset.json --index ./label_index --input-model ./model_summarization/summarization_7_epoch.pth --threshold 0.95
+
+
+def normalise(text):
+    return re.sub(r'\s+', ' ', text.lower()).strip()
+
+
+def read_pairs(path, document_key=None, summary_key=None):
+    # (document, label) pairs of a labeled JSON dataset: 'document' and 'summary' (documents may be label lists),
+    # or 'document_train' and 'summary_train' of the train/test datasets
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if document_key is None:
+        document_key, summary_key = next((d, s) for d, s in [('document', 'summary'), ('document_train', 'summary_train')]
+                                         if d in data and s in data)
+    documents = [x if isinstance(x, str) else linearise(x) for x in data[document_key]]
+    return documents, list(data[summary_key])
+
+
+def file_fingerprint(path):
+    # size and modification time of a model file, a checkpoint being too large to hash on every run
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return {'path': os.path.basename(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class EncoderEmbedder(object):
+    # the </s> state of the encoder of a (fine-tuned or TML trained) Pegasus model, batched by length;
+    # model_name and input_model (as passed to load_model) identify the model in the index
+    name = 'encoder'
+
+    def __init__(self, model, tokenizer, model_name=None, input_model=None, max_tokens=8192, max_batch_size=128,
+                 max_length=512):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.fingerprint = {'model_name': model_name, 'input_model': file_fingerprint(input_model),
+                            'max_length': max_length}
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_length = max_length
+
+    def __call__(self, texts):
+        encodings = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)['input_ids']
+        embeddings = np.zeros((len(texts), self.model.config.d_model), dtype=np.float32)
+        encoder = self.model.get_encoder()
+        with torch.no_grad():
+            for batch in make_batches([len(x) for x in encodings], self.max_tokens, self.max_batch_size):
+                inputs = self.tokenizer.pad({'input_ids': [encodings[i] for i in batch]}, padding='longest',
+                                            return_tensors='pt')
+                hidden = encoder(**inputs).last_hidden_state
+                eos = get_eos_idx(inputs, self.tokenizer.eos_token_id)
+                embeddings[batch] = hidden[torch.arange(hidden.size(0)), eos].float().numpy()
+        return embeddings
+
+
+class Doc2VecEmbedder(object):
+    # the inferred vectors of a gensim Doc2Vec model, on the words of simple_preprocess as in the notebook
+    name = 'doc2vec'
+
+    def __init__(self, path, epochs=None):
+        from gensim.models.doc2vec import Doc2Vec
+        self.model = Doc2Vec.load(path)
+        self.epochs = epochs
+        self.fingerprint = {'doc2vec_model': file_fingerprint(path), 'epochs': epochs}
+
+    def __call__(self, texts):
+        from gensim.utils import simple_preprocess
+        return np.array([self.model.infer_vector(simple_preprocess(x), epochs=self.epochs) for x in texts],
+                        dtype=np.float32).reshape(len(texts), self.model.vector_size)
+
+
+def unit_rows(x):
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+class LabelIndex(object):
+    # the labeled documents: exact lookups by their normalised text, nearest neighbours by cosine similarity
+    def __init__(self, documents, labels, embeddings, meta=None):
+        self.documents = documents
+        self.labels = labels
+        self.embeddings = torch.from_numpy(np.ascontiguousarray(embeddings, dtype=np.float32))
+        self.meta = meta or {}
+        # the first label of a document labeled more than once
+        self.exact = {}
+        for i, document in enumerate(documents):
+            self.exact.setdefault(normalise(document), i)
+
+    @classmethod
+    def build(cls, documents, labels, embedder):
+        # one entry per distinct normalised document, labeled with its first label
+        first = {}
+        for document, label in zip(documents, labels):
+            first.setdefault(normalise(document), (document, label))
+        documents = [x[0] for x in first.values()]
+        labels = [x[1] for x in first.values()]
+        embeddings = unit_rows(embedder([normalise(x) for x in documents]))
+        return cls(documents, labels, embeddings, {'embedder': embedder.name, 'embedding_model': embedder.fingerprint})
+
+    def save(self, directory):
+        # replaced at once when complete
+        tmp_dir = directory.rstrip('/') + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'embeddings.npy'), self.embeddings.numpy())
+        with open(os.path.join(tmp_dir, 'entries.json'), 'w') as f:
+            json.dump({'document': self.documents, 'summary': self.labels}, f)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_dir, directory)
+
+    @classmethod
+    def load(cls, directory, embedder=None):
+        # the embeddings of the fragments to look up must come from the model the index was built with
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if embedder is not None and (meta.get('embedder'), meta.get('embedding_model')) != (embedder.name,
+                                                                                            embedder.fingerprint):
+            raise ValueError(directory + ' was built with another embedding model (' + str(meta.get('embedder')) + ': '
+                             + json.dumps(meta.get('embedding_model')) + ')')
+        with open(os.path.join(directory, 'entries.json'), 'r') as f:
+            entries = json.load(f)
+        return cls(entries['document'], entries['summary'], np.load(os.path.join(directory, 'embeddings.npy')), meta)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def lookup(self, text):
+        # the entry of the same normalised document, or None
+        return self.exact.get(normalise(text))
+
+    def search(self, embeddings, k=5, chunk_size=1024):
+        # the cosine similarities and entries of the k nearest documents of each embedding, most similar first
+        queries = torch.from_numpy(unit_rows(np.asarray(embeddings, dtype=np.float32)))
+        k = min(k, len(self))
+        scores = []
+        indices = []
+        for i in range(0, len(queries), chunk_size):
+            top = torch.topk(queries[i:i + chunk_size] @ self.embeddings.T, k, dim=1)
+            scores.append(top.values)
+            indices.append(top.indices)
+        if not scores:
+            return np.zeros((0, k), dtype=np.float32), np.zeros((0, k), dtype=np.int64)
+        return torch.cat(scores).numpy(), torch.cat(indices).numpy()
+
+
+def with_context(fragment, labels):
+    # the fragment with the labels of its nearest documents, for a model fine-tuned on such inputs
+    return fragment + ' | similar: ' + '; '.join(labels)
+
+
+class RetrievalLabeler(object):
+    # labels of the fragments by lookup where possible, by the engine (InferenceEngine) otherwise
+    def __init__(self, index, embedder, engine, threshold=0.95, k=3, context=False):
+        self.index = index
+        self.embedder = embedder
+        self.engine = engine
+        self.threshold = threshold
+        self.k = k
+        self.context = context
+        self.counts = {'exact': 0, 'neighbour': 0, 'generated': 0}
+        self.seconds = {'lookup': 0., 'generation': 0.}
+
+    def label(self, fragments, stats=None):
+        # the label of each fragment, and how it was found: 'exact', 'neighbour' or 'generated'
+        labels = [None] * len(fragments)
+        sources = [None] * len(fragments)
+        start = time.perf_counter()
+        rest = []
+        for i, fragment in enumerate(fragments):
+            entry = self.index.lookup(fragment)
+            if entry is None:
+                rest.append(i)
+            else:
+                labels[i] = self.index.labels[entry]
+                sources[i] = 'exact'
+        misses = []
+        if rest:
+            scores, indices = self.index.search(self.embedder([normalise(fragments[i]) for i in rest]), self.k)
+            for i, row_scores, row_indices in zip(rest, scores, indices):
+                if row_scores[0] >= self.threshold:
+                    labels[i] = self.index.labels[row_indices[0]]
+                    sources[i] = 'neighbour'
+                else:
+                    misses.append((i, [self.index.labels[j] for j in row_indices]))
+        self.seconds['lookup'] += time.perf_counter() - start
+
+        if misses:
+            start = time.perf_counter()
+            inputs = [with_context(fragments[i], neighbours) if self.context else fragments[i]
+                      for i, neighbours in misses]
+            for (i, _), label in zip(misses, self.engine.generate(inputs, stats)):
+                labels[i] = label
+                sources[i] = 'generated'
+            self.seconds['generation'] += time.perf_counter() - start
+        for source in sources:
+            self.counts[source] += 1
+        return labels, sources
+
+    def summary(self):
+        # hit rates, and the generation time saved: the hits at the mean generation time of a miss, less the
+        # time of all lookups
+        total = sum(self.counts.values())
+        hits = self.counts['exact'] + self.counts['neighbour']
+        per_generated = self.seconds['generation'] / self.counts['generated'] if self.counts['generated'] else None
+        summary = {'fragments': total, 'exact_hit_rate': self.counts['exact'] / total if total else 0.,
+                   'neighbour_hit_rate': self.counts['neighbour'] / total if total else 0.,
+                   'hit_rate': hits / total if total else 0.,
+                   'lookup_ms': 1000 * self.seconds['lookup'] / total if total else 0.,
+                   'generation_ms': 1000 * per_generated if per_generated is not None else None}
+        if per_generated is not None:
+            summary['seconds_saved'] = hits * per_generated - self.seconds['lookup']
+        return summary
+
+
+def make_embedder(args, model=None, tokenizer=None):
+    if args.embedder == 'doc2vec':
+        return Doc2VecEmbedder(args.doc2vec_model)
+    if model is None:
+        model, tokenizer = load_model(args.model_name, args.input_model, 'cpu')
+    return EncoderEmbedder(model, tokenizer, args.model_name, args.input_model)
+
+
+def build(args):
+    set_threads(args.threads)
+    documents, labels = [], []
+    for path in args.labeled:
+        d, s = read_pairs(path, args.document_key, args.summary_key)
+        documents += d
+        labels += s
+    start = time.perf_counter()
+    index = LabelIndex.build(documents, labels, make_embedder(args))
+    index.save(args.output)
+    print('{} documents ({} distinct) indexed in {:.1f} s, written to {}'.format(
+        len(documents), len(index), time.perf_counter() - start, args.output))
+
+
+def label(args):
+    set_threads(args.threads)
+    model, tokenizer = load_model(args.model_name, args.input_model, 'cpu')
+    embedder = make_embedder(args, model, tokenizer)
+    index = LabelIndex.load(args.index, embedder)
+    generator = model
+    if args.backend != 'fp32':
+        from inference_backends import prepare_backend
+        generator = prepare_backend(model, args.backend)
+    generate_kwargs = {k: v for k, v in [('num_beams', args.num_beams), ('max_new_tokens', args.max_new_tokens)]
+                       if v is not None}
+    engine = InferenceEngine(generator, tokenizer, 'cpu', max_tokens=args.max_tokens, **generate_kwargs)
+    labeler = RetrievalLabeler(index, embedder, engine, args.threshold, args.k, args.context)
+    fragments = read_fragments(args.input, args.key)
+    stats = InferenceStats()
+    start = time.perf_counter()
+    labels, sources = labeler.label(fragments, stats)
+    seconds = time.perf_counter() - start
+    if args.output:
+        with open(args.output, 'w') as f:
+            for i, (fragment, label, source) in enumerate(zip(fragments, labels, sources)):
+                f.write(json.dumps({'index': i, 'fragment': fragment, 'label': label, 'source': source}) + '\n')
+
+    summary = labeler.summary()
+    print('fragments, exact hits, neighbour hits, hit rate, lookup ms per fragment, generation ms per generated '
+          'fragment, seconds, seconds saved', file=sys.stderr)
+    print('{}, {:.1%}, {:.1%}, {:.1%}, {:.2f}, {}, {:.2f}, {}'.format(
+        summary['fragments'], summary['exact_hit_rate'], summary['neighbour_hit_rate'], summary['hit_rate'],
+        summary['lookup_ms'], '{:.0f}'.format(summary['generation_ms']) if summary['generation_ms'] is not None else '-',
+        seconds, '{:.2f}'.format(summary['seconds_saved']) if 'seconds_saved' in summary else '-'), file=sys.stderr)
+
+    if args.reference_key:
+        # BERTScore of the labels against the references, and of the labels of the hits alone
+        from bert_scoring import get_scorer
+        with open(args.input, 'r') as f:
+            refs = json.load(f)[args.reference_key]
+        scorer_kwargs = {k: v for k, v in [('model_type', args.scorer_model_type),
+                                           ('num_layers', args.scorer_num_layers),
+                                           ('baseline_path', args.scorer_baseline_path)] if v is not None}
+        _, _, F1 = get_scorer(lang='en', rescale_with_baseline=True, cache_dir=args.cache_dir,
+                              **scorer_kwargs).score(labels, refs)
+        for source in ['exact', 'neighbour', 'generated']:
+            idx = [i for i, x in enumerate(sources) if x == source]
+            if idx:
+                print('{}: {} fragments, BERTScore F1 {:.3f}'.format(source, len(idx), F1[idx].mean()),
+                      file=sys.stderr)
+        print('all: BERTScore F1 {:.3f}'.format(F1.mean()), file=sys.stderr)
+
+
+def add_embedder_arguments(parser):
+    parser.add_argument('--embedder', default='encoder', choices=['encoder', 'doc2vec'])
+    parser.add_argument('--doc2vec-model', help='gensim Doc2Vec model file, for --embedder doc2vec')
+    parser.add_argument('--model-name', default='google/pegasus-large')
+    parser.add_argument('--input-model', help='checkpoint saved by save() in the notebooks')
+    parser.add_argument('--threads', type=int, help='CPU threads, i.e. the number of physical cores')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='label lookup of labeled documents before generation')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='index the documents of labeled datasets')
+    build_parser.add_argument('labeled', nargs='+', help='i.e. human_evaluation/process_model_distribution/files/final_labeled_dataset.json')
+    build_parser.add_argument('--document-key', help="by default 'document' or 'document_train'")
+    build_parser.add_argument('--summary-key')
+    build_parser.add_argument('--output', default='./label_index')
+    add_embedder_arguments(build_parser)
+
+    label_parser = subparsers.add_parser('label', help='label fragments, by lookup where possible')
+    label_parser.add_argument('input', help='JSON file of fragments (or label lists), or a text file of one fragment per line')
+    label_parser.add_argument('--key', help="key of the fragments in a JSON dict, by default 'document_test' or 'document'")
+    label_parser.add_argument('--index', default='./label_index')
+    label_parser.add_argument('--threshold', type=float, default=0.95,
+                              help='cosine similarity of the nearest document from which its label is returned')
+    label_parser.add_argument('--k', type=int, default=3, help='nearest documents searched per fragment')
+    label_parser.add_argument('--context', action='store_true',
+                              help='generate from the fragment with the labels of its nearest documents')
+    label_parser.add_argument('--output', help='JSON lines file of the labels and how they were found')
+    label_parser.add_argument('--backend', default='fp32', choices=BACKENDS, help='see inference_backends.py')
+    label_parser.add_argument('--max-tokens', type=int, default=4096)
+    label_parser.add_argument('--num-beams', type=int)
+    label_parser.add_argument('--max-new-tokens', type=int)
+    label_parser.add_argument('--reference-key', help="i.e. summary_test: BERTScore of the labels by how they were found")
+    label_parser.add_argument('--cache-dir', default='.bert_score_cache')
+    label_parser.add_argument('--scorer-model-type')
+    label_parser.add_argument('--scorer-num-layers', type=int)
+    label_parser.add_argument('--scorer-baseline-path')
+    add_embedder_arguments(label_parser)
+
+    args = parser.parse_args(argv)
+    {'build': build, 'label': label}[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from inference import InferenceEngine, load_model, read_fragments, set_threads
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_preprocessing'))
+from corpus_builder import extract_fragments
+
+# Long-running label service: the model is loaded once, and concurrent requests are coalesced into
+# micro-batches, i.e. all requests arriving within batch_window seconds of the first waiting one
+# (up to max_batch_fragments fragments) are labeled by one InferenceEngine call.
+#
+# POST /label  {"fragment": "..."}, {"fragments": ["...", ...]} or {"model": <BPMAI model JSON>}
+#              -> {"labels": [...]} (and the "fragments" of the sorted flows of a model)
+# GET /metrics -> queue depth, batch sizes and request latencies
+# GET /health
+#
+# python label_server.py serve --input-model ./model_summarization/summarization_7_epoch.pth
+# python label_server.py load data/train_test_labeled_dataset.json --concurrency 16
+
+
+class ServerMetrics(object):
+    # counters of the micro-batcher; latencies of the last 10000 requests, from arrival to labels
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.fragments = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes = deque(maxlen=10000)
+        self.latencies = deque(maxlen=10000)
+        self.start = time.time()
+
+    def add_batch(self, requests, fragments):
+        with self.lock:
+            self.batches += 1
+            self.requests += requests
+            self.fragments += fragments
+            self.batch_sizes.append(fragments)
+
+    def add_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def summary(self, queue_depth):
+        with self.lock:
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            batch_sizes = np.array(self.batch_sizes) if self.batch_sizes else np.zeros(1)
+            return {'queue_depth': queue_depth,
+                    'requests': self.requests,
+                    'fragments': self.fragments,
+                    'batches': self.batches,
+                    'errors': self.errors,
+                    'mean_batch_size': float(batch_sizes.mean()),
+                    'max_batch_size': int(batch_sizes.max()),
+                    'p50_latency_ms': float(np.percentile(latencies, 50) * 1000),
+                    'p99_latency_ms': float(np.percentile(latencies, 99) * 1000),
+                    'uptime_s': time.time() - self.start}
+
+
+class MicroBatcher(object):
+    # a single worker thread runs the model, so requests never compete for the CPU threads of torch
+    def __init__(self, engine, batch_window=0.02, max_batch_fragments=64):
+        self.engine = engine
+        self.batch_window = batch_window
+        self.max_batch_fragments = max_batch_fragments
+        self.requests = queue.Queue()
+        self.metrics = ServerMetrics()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, fragments):
+        # returns a Future of the labels of the fragments
+        future = Future()
+        self.requests.put((fragments, future, time.perf_counter()))
+        return future
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def next_batch(self):
+        # wait for a request, then gather the ones arriving within the batch window
+        batch = [self.requests.get()]
+        n_fragments = len(batch[0][0])
+        deadline = time.perf_counter() + self.batch_window
+        while n_fragments < self.max_batch_fragments:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_fragments += len(request[0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            fragments = [f for request in batch for f in request[0]]
+            try:
+                labels = self.engine.generate(fragments) if fragments else []
+            except Exception as e:
+                with self.metrics.lock:
+                    self.metrics.errors += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            self.metrics.add_batch(len(batch), len(fragments))
+            i = 0
+            for request_fragments, future, arrival in batch:
+                future.set_result(labels[i:i + len(request_fragments)])
+                i += len(request_fragments)
+                self.metrics.add_latency(time.perf_counter() - arrival)
+
+
+class LabelHandler(BaseHTTPRequestHandler):
+    batcher = None
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.batcher.metrics.summary(self.batcher.queue_depth()))
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/label':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            response = {}
+            if 'model' in request:
+                model = request['model']
+                # the sorted flow of each start event, as parsed with load_JSON and sort_process_flows
+                fragments = extract_fragments(model if isinstance(model, str) else json.dumps(model))
+                response['fragments'] = fragments
+            elif 'fragments' in request:
+                fragments = [str(f) for f in request['fragments']]
+            else:
+                fragments = [str(request['fragment'])]
+        except Exception as e:
+            self.send_json(400, {'error': repr(e)})
+            return
+        try:
+            response['labels'] = self.batcher.submit(fragments).result()
+        except Exception as e:
+            self.send_json(500, {'error': repr(e)})
+            return
+        self.send_json(200, response)
+
+    def log_message(self, format, *args):
+        # no log line per request
+        pass
+
+
+class LabelServer(ThreadingHTTPServer):
+    # the default listen backlog of 5 resets connections under a burst of concurrent requests
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(args):
+    set_threads(args.threads, args.interop_threads)
+    # CPU only, the model is loaded once for the lifetime of the server
+    model, tokenizer = load_model(args.model_name, args.input_model, 'cpu', args.backend, args.export_dir)
+    engine = InferenceEngine(model, tokenizer, 'cpu', max_tokens=args.max_tokens,
+                             max_batch_size=args.max_batch_fragments, max_length=args.max_length)
+    LabelHandler.batcher = MicroBatcher(engine, args.batch_window, args.max_batch_fragments)
+    server = LabelServer((args.host, args.port), LabelHandler)
+    print('serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def load(args):
+    # local load generator: sends every fragment of the input as its own request, concurrency at a time
+    fragments = read_fragments(args.input, args.key)[:args.requests] if args.requests else read_fragments(args.input, args.key)
+    url = args.url.rstrip('/')
+    latencies = []
+
+    def label(fragment):
+        start = time.perf_counter()
+        post(url + '/label', {'fragment': fragment})
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(label, fragments))
+    elapsed = time.perf_counter() - start
+    with urllib.request.urlopen(url + '/metrics') as response:
+        metrics = json.loads(response.read())
+    print('{} requests, concurrency {}: {:.1f} requests/s, latency p50 {:.0f} ms, p99 {:.0f} ms'.format(
+        len(fragments), args.concurrency, len(fragments) / elapsed, np.percentile(latencies, 50) * 1000,
+        np.percentile(latencies, 99) * 1000))
+    print('server: ' + json.dumps(metrics))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='label server for process fragments, and its load generator')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--model-name', default='google/pegasus-large')
+    serve_parser.add_argument('--input-model', help='checkpoint saved by save() in the notebooks')
+    serve_parser.add_argument('--batch-window', type=float, default=0.02, help='seconds to wait for more requests')
+    serve_parser.add_argument('--max-batch-fragments', type=int, default=64)
+    serve_parser.add_argument('--max-tokens', type=int, default=4096, help='token budget of a batch, padding included')
+    serve_parser.add_argument('--max-length', type=int, default=512)
+    serve_parser.add_argument('--backend', default='fp32', choices=['fp32', 'int8', 'exported'],
+                              help='int8 quantised or exported graphs, see inference_backends.py')
+    serve_parser.add_argument('--export-dir', help='directory the exported graphs are saved to, and loaded from if present')
+    serve_parser.add_argument('--threads', type=int, help='CPU threads, i.e. the number of physical cores')
+    serve_parser.add_argument('--interop-threads', type=int)
+
+    load_parser = subparsers.add_parser('load')
+    load_parser.add_argument('input', help='JSON file of fragments, or a text file of one fragment per line')
+    load_parser.add_argument('--key')
+    load_parser.add_argument('--url', default='http://127.0.0.1:8000')
+    load_parser.add_argument('--concurrency', type=int, default=8)
+    load_parser.add_argument('--requests', type=int, help='number of fragments sent, all by default')
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        serve(args)
+    else:
+        load(args)
+
+
+if __name__ == '__main__':
+    main()
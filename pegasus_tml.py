@@ -0,0 +1,169 @@
+import argparse
+import json
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Triplet margin loss on the encoder of Pegasus (Control-flow Relation Learning, see Pegasus_TML.ipynb).
+# Each sentence is represented by the encoder's last hidden state at its </s> token.
+
+
+def get_eos_idx(batch, eos_token_id=1):
+    # index of the first </s> end-of-sentence token of each sentence in the batch
+    return (batch['input_ids'] == eos_token_id).int().argmax(dim=1)
+
+
+def stack_triplets(anchors, positives, negatives, pad_token_id=0):
+    # anchors, positives and negatives as one batch (padded to the longest of them), so they go through
+    # the encoder together
+    length = max(x['input_ids'].size(1) for x in (anchors, positives, negatives))
+    stacked = {}
+    for key, pad in [('input_ids', pad_token_id), ('attention_mask', 0)]:
+        stacked[key] = torch.cat([F.pad(x[key], (0, length - x[key].size(1)), value=pad)
+                                  for x in (anchors, positives, negatives)])
+    return stacked
+
+
+class PegasusTMLModel(nn.TripletMarginLoss):
+    # encoder_only: anchors, positives and negatives go through the encoder in one stacked batch,
+    # instead of through the whole model (decoder included) one group at a time
+    # mining: None to use the negative of each triplet, 'hardest' to use the closest of the in-batch
+    # negatives (the negatives of all triplets, and the positives of the other triplets), or
+    # 'semi-hard' to use the closest in-batch negative that is still farther than the positive
+    def __init__(self, model, margin: float = 1.0, p: float = 2., eps: float = 1e-6,
+                 swap: bool = False, size_average=None, reduce=None, reduction: str = 'mean',
+                 encoder_only: bool = True, mining=None, eos_token_id: int = 1, pad_token_id: int = 0):
+        super().__init__(margin, p, eps, swap, size_average, reduce, reduction)
+        if mining not in [None, 'hardest', 'semi-hard']:
+            raise ValueError('mining ' + str(mining) + ' is unknown!')
+        self.model = model
+        self.encoder_only = encoder_only
+        self.mining = mining
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+
+    def embed(self, anchors, positives, negatives):
+        # </s> embeddings of anchors, positives and negatives
+        if self.encoder_only:
+            stacked = stack_triplets(anchors, positives, negatives, self.pad_token_id)
+            # the encoder of a model wrapped in nn.DataParallel
+            encoder = getattr(self.model, 'module', self.model).get_encoder()
+            encoder_output = encoder(input_ids=stacked['input_ids'],
+                                     attention_mask=stacked['attention_mask']).last_hidden_state
+            eos = get_eos_idx(stacked, self.eos_token_id)
+            embeddings = encoder_output[torch.arange(encoder_output.size(0), device=eos.device), eos]
+            return embeddings.chunk(3)
+
+        embeddings = []
+        for batch in (anchors, positives, negatives):
+            # get </s> token from encoder output - last hidden layer
+            encoder_output = self.model(**batch).encoder_last_hidden_state
+            eos = get_eos_idx(batch, self.eos_token_id)
+            embeddings.append(encoder_output[torch.arange(encoder_output.size(0), device=eos.device), eos])
+        return embeddings
+
+    def mine(self, a_eos, p_eos, n_eos, anchors, positives, negatives):
+        # the in-batch negative of each anchor, among the negatives of all triplets and the positives of
+        # the other triplets; candidates with the same text as the anchor or its positive are left out
+        batch_size = a_eos.size(0)
+        candidates = torch.cat([n_eos, p_eos])
+        with torch.no_grad():
+            distances = torch.cdist(a_eos, candidates, p=self.p)
+            a_ids, p_ids, n_ids = stack_triplets(anchors, positives, negatives, self.pad_token_id)['input_ids'].chunk(3)
+            candidate_ids = torch.cat([n_ids, p_ids]).unsqueeze(0)
+            invalid = (candidate_ids == a_ids.unsqueeze(1)).all(-1) | (candidate_ids == p_ids.unsqueeze(1)).all(-1)
+            hardest = distances.masked_fill(invalid, float('inf'))
+            if self.mining == 'semi-hard':
+                # farther than the positive, but the closest of those
+                positive_distance = F.pairwise_distance(a_eos, p_eos, p=self.p, eps=self.eps).unsqueeze(1)
+                semi_hard = hardest.masked_fill(hardest <= positive_distance, float('inf'))
+                idx = torch.where(torch.isinf(semi_hard.min(dim=1).values), hardest.argmin(dim=1), semi_hard.argmin(dim=1))
+            else:
+                idx = hardest.argmin(dim=1)
+            # without any valid candidate, the negative of the triplet is kept
+            own = torch.arange(batch_size, device=idx.device)
+            idx = torch.where(torch.isinf(hardest.min(dim=1).values), own, idx)
+        return candidates[idx]
+
+    def forward(self, triplet_batch):
+        # retrieve triplets in batch
+        anchors, positives, negatives = triplet_batch[0], triplet_batch[1], triplet_batch[2]
+        a_eos, p_eos, n_eos = self.embed(anchors, positives, negatives)
+        if self.mining is not None:
+            n_eos = self.mine(a_eos, p_eos, n_eos, anchors, positives, negatives)
+        # compute the loss
+        triplet_margin_loss = F.triplet_margin_loss(a_eos, p_eos, n_eos,
+                                                    margin=self.margin, p=self.p,
+                                                    eps=self.eps, swap=self.swap,
+                                                    reduction=self.reduction)
+
+        return triplet_margin_loss
+
+
+def saved_activation_bytes(loss_fn, batch):
+    # bytes of the tensors kept for the backward pass of one forward pass, i.e. the training memory of the batch
+    saved = [0]
+
+    def pack(tensor):
+        saved[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = loss_fn(batch)
+    return loss, saved[0]
+
+
+def benchmark(argv=None):
+    # training step time and memory per triplet of the full three-pass model and the single encoder pass
+    from transformers import PegasusForConditionalGeneration, PegasusTokenizerFast
+    parser = argparse.ArgumentParser(description='step time and memory of the Pegasus-TML loss')
+    parser.add_argument('--model-name', default='google/pegasus-large')
+    parser.add_argument('--data', default='./data/triplet_train_dataset.json')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--threads', type=int)
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    tokenizer = PegasusTokenizerFast.from_pretrained(args.model_name)
+    model = PegasusForConditionalGeneration.from_pretrained(args.model_name, return_dict=True)
+    model.train()
+    with open(args.data, 'r') as f:
+        data = json.load(f)
+    triplets = [[x.lower() for x in t] for t in data['easy_negatives'] + data['hard_negatives']]
+    batches = []
+    for i in range(args.steps):
+        triplet_batch = triplets[i * args.batch_size:(i + 1) * args.batch_size]
+        batch = []
+        for j in range(3):
+            # as TripletDataset in Pegasus_TML.ipynb, with the dummy labels of the decoder
+            encodings = dict(tokenizer([t[j] for t in triplet_batch], truncation=True, padding='max_length',
+                                       max_length=50, return_tensors='pt'))
+            encodings['labels'] = encodings['input_ids'].clone()
+            batch.append(encodings)
+        batches.append(batch)
+
+    print('mode, step (ms), per triplet (ms), saved activations per triplet (kB)')
+    for name, kwargs in [('three full passes', {'encoder_only': False}), ('one encoder pass', {}),
+                         ('one encoder pass, hardest negatives', {'mining': 'hardest'})]:
+        loss_fn = PegasusTMLModel(model, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id,
+                                  **kwargs)
+        elapsed = 0.
+        memory = 0
+        for batch in batches:
+            start = time.perf_counter()
+            loss, saved = saved_activation_bytes(loss_fn, batch)
+            loss.backward()
+            elapsed += time.perf_counter() - start
+            memory += saved
+            model.zero_grad()
+        n_triplets = args.steps * args.batch_size
+        print('{}, {:.1f}, {:.2f}, {:.0f}'.format(name, elapsed / args.steps * 1000, elapsed / n_triplets * 1000,
+                                                 memory / n_triplets / 1024))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import socket
+import tempfile
+import time
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from transformers.optimization import Adafactor
+
+from bert_scoring import generate_and_score, get_scorer
+from data_module import Seq2SeqCollator, Seq2SeqDataset, TripletCollator, TripletDataset, load_tokenized
+from distributed import (DistributedLengthGroupedBatchSampler, all_reduce_sum, barrier, cleanup, get_rank,
+                         get_world_size, init_distributed, is_distributed, is_main_process,
+                         local_main_process_first)
+from inference import InferenceEngine, load_model, set_threads
+from pegasus_tml import PegasusTMLModel
+from trainer import EarlyStopping, Trainer, save
+
+# Data-parallel training of the three training steps of the notebooks on CPU processes (gloo backend), one replica
+# of the model per process, each on its own shard of the batches (see distributed.py):
+#   masked_sent  further pre-training with masked sentences, as Pegasus.ipynb
+#   tml          triplet margin loss on the encoder, as Pegasus_TML.ipynb
+#   finetune     fine-tuning on the labeled data, as Pegasus_Finetuned_and_Automatic_Evaluation.ipynb
+# Validation (loss, or BERTScore of the generated labels) is sharded too, and summed over the processes.
+# Only the first process logs (and to WandB, with --wandb-project), saves models and writes checkpoints.
+#
+# torchrun --nproc_per_node 4 train_ddp.py masked_sent --threads 4 --output-model ./model_maskedSent/maskedSent_{}_epoch.pth
+# torchrun --nnodes 2 --node_rank 0 --master_addr 10.0.0.1 --master_port 29500 --nproc_per_node 2 train_ddp.py tml ...
+# python train_ddp.py scaling masked_sent --world-sizes 1 2 4 --steps 20   (processes on this machine)
+
+TASKS = ['masked_sent', 'tml', 'finetune']
+TRIPLET_GROUPS = ['easy_negatives', 'negatives', 'one_step_away_negs', 'hard_negatives']
+
+
+class Seq2SeqLoss(nn.Module):
+    # the loss of the model on a batch, as the forward pass of the module wrapped in DistributedDataParallel
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, batch):
+        return self.model(**batch).loss
+
+
+def sharded_loader(dataset, collate_fn, batch_size, shuffle, even=True, max_samples=None, seed=0):
+    # the batches of this process; max_samples keeps the first samples only (to measure scaling)
+    lengths = dataset.lengths[:max_samples] if max_samples else dataset.lengths
+    batch_sampler = DistributedLengthGroupedBatchSampler(lengths, batch_size, shuffle, seed=seed, even=even)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn)
+
+
+def mean_loss(loss_fn, loader):
+    # mean of the batch losses of all processes, as val() in the notebooks
+    total = 0.
+    with torch.no_grad():
+        for batch in loader:
+            total += loss_fn(batch).item()
+    total, n_batches = all_reduce_sum([total, len(loader)])
+    return torch.tensor(total / max(n_batches, 1))
+
+
+def read_labeled(path):
+    # the train and validation split of the labeled data, as in the fine-tuning notebook
+    with open(path, 'r') as f:
+        process = json.load(f)
+    if 'document_val' in process:
+        # the augmented dataset comes with its validation split
+        return process['document_train'], process['summary_train'], process['document_val'], process['summary_val']
+    from sklearn.model_selection import train_test_split
+    doc_train, doc_val, sum_train, sum_val = train_test_split(process['document_train'], process['summary_train'],
+                                                              test_size=0.175, random_state=41)
+    return doc_train, sum_train, doc_val, sum_val
+
+
+def build_task(args, model, tokenizer, max_samples=None):
+    # the module computing the loss of a batch, the training loader of this process, the validation function,
+    # and whether (and how) early stopping is applied to the validation metric
+    if args.task == 'masked_sent':
+        train = load_tokenized(args.train_data or './data/masked_sent_train.json', tokenizer, lowercase=True)
+        val = load_tokenized(args.val_data or './data/masked_sent_val.json', tokenizer, lowercase=True)
+        loss_module = Seq2SeqLoss(model)
+        collate_fn = Seq2SeqCollator(tokenizer.pad_token_id)
+        train_loader = sharded_loader(Seq2SeqDataset(train['document'], train['summary']), collate_fn,
+                                      args.batch_size, True, max_samples=max_samples)
+        val_loader = sharded_loader(Seq2SeqDataset(val['document'], val['summary']), collate_fn,
+                                    args.batch_size, False, even=False)
+        return loss_module, train_loader, lambda: mean_loss(loss_module, val_loader), 'min'
+
+    if args.task == 'tml':
+        train = load_tokenized(args.train_data or './data/triplet_train_dataset.json', tokenizer, lowercase=True,
+                               max_length=50)
+        val = load_tokenized(args.val_data or './data/triplet_val_dataset.json', tokenizer, lowercase=True,
+                             max_length=50)
+        loss_module = PegasusTMLModel(model, encoder_only=not args.full_model, mining=args.mining,
+                                      eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id)
+        collate_fn = TripletCollator(tokenizer.pad_token_id)
+        train_loader = sharded_loader(TripletDataset(*[train[g] for g in TRIPLET_GROUPS]), collate_fn,
+                                      args.batch_size, True, max_samples=max_samples)
+        val_loader = sharded_loader(TripletDataset(*[val[g] for g in TRIPLET_GROUPS]), collate_fn,
+                                    args.batch_size, False, even=False)
+        return loss_module, train_loader, lambda: mean_loss(loss_module, val_loader), 'min'
+
+    doc_train, sum_train, doc_val, sum_val = read_labeled(args.train_data or './data/train_test_labeled_dataset.json')
+    loss_module = Seq2SeqLoss(model)
+    train_loader = sharded_loader(Seq2SeqDataset.from_texts(doc_train, sum_train, tokenizer,
+                                                            cache_dir='./cache/tokenized'),
+                                  Seq2SeqCollator(tokenizer.pad_token_id), args.batch_size, True,
+                                  max_samples=max_samples)
+    scorer_kwargs = {k: v for k, v in [('model_type', args.scorer_model_type), ('num_layers', args.scorer_num_layers),
+                                       ('baseline_path', args.scorer_baseline_path)] if v is not None}
+
+    def validate():
+        # BERTScore F1 of the labels generated for this process' share of the validation documents,
+        # averaged over all of them
+        shard = range(get_rank(), len(doc_val), get_world_size())
+        model.eval()
+        engine = InferenceEngine(model, tokenizer, 'cpu')
+        scorer = get_scorer(lang='en', rescale_with_baseline=True, **scorer_kwargs)
+        _, (P, R, F1) = generate_and_score(engine, [doc_val[i] for i in shard], [sum_val[i] for i in shard], scorer)
+        P, R, F1, n = all_reduce_sum([P.sum().item(), R.sum().item(), F1.sum().item(), len(shard)])
+        if is_main_process():
+            print(f"bert_score_P: {P / n:.3f}, bert_score_R, {R / n:.3f}, bert_score_F1, {F1 / n:.3f}")
+        return torch.tensor(F1 / n)
+
+    return loss_module, train_loader, validate, 'max'
+
+
+def setup(args, max_samples=None):
+    # model, optimizer, training loader, loss module and validation of this process, and the early stopping mode
+    set_threads(args.threads)
+    torch.manual_seed(args.seed)
+    model, tokenizer = load_model(args.model_name, args.input_model, 'cpu')
+    for name, parameter in model.named_parameters():
+        # the sinusoidal position embeddings are fixed, and never get a gradient DistributedDataParallel waits for
+        if 'embed_positions' in name:
+            parameter.requires_grad_(False)
+    optimizer = Adafactor(model.parameters(), scale_parameter=True, relative_step=True, warmup_init=True, lr=None)
+    with local_main_process_first():
+        loss_module, train_loader, validate, mode = build_task(args, model, tokenizer, max_samples)
+    # the decoder is unused by the triplet loss; DistributedDataParallel also broadcasts the weights of the
+    # first process, so all replicas start alike
+    ddp = loss_module
+    if is_distributed():
+        ddp = DistributedDataParallel(loss_module, find_unused_parameters=args.task == 'tml')
+    return model, optimizer, train_loader, ddp, validate, mode
+
+
+def train(args):
+    init_distributed(args.backend)
+    model, optimizer, train_loader, ddp, validate, mode = setup(args)
+    es = EarlyStopping(mode=mode, patience=args.es_patience)
+    run = None
+    if args.wandb_project and is_main_process():
+        import wandb
+        run = wandb.init(project=args.wandb_project, entity=args.wandb_entity,
+                         config=dict(vars(args), world_size=get_world_size()))
+
+    def train_log(loss, batch_num, epoch, throughput):
+        if run is not None:
+            run.log({"epoch": epoch, "loss": loss, **throughput}, step=batch_num)
+        print(f"Loss after " + str(batch_num).zfill(5) + f" steps: {loss:.3f}, "
+              f"{throughput['samples_per_s']:.1f} samples/s, {throughput['tokens_per_s']:.0f} tokens/s")
+
+    trainer = Trainer(model, optimizer, ddp, 'cpu', accumulation_steps=args.accumulation_steps,
+                      precision=args.precision, log_fn=train_log, log_every=args.log_every,
+                      checkpoint_path=args.checkpoint, checkpoint_every=args.checkpoint_every, early_stopping=es)
+    if args.resume:
+        trainer.load_checkpoint()
+    if is_main_process():
+        print('{} processes, num_training_steps {}'.format(get_world_size(),
+                                                           trainer.steps_per_epoch(train_loader) * args.epochs))
+    for epoch in range(trainer.epoch, args.epochs):
+        trainer.train_epoch(train_loader, epoch)
+        metric = validate()
+        if is_main_process():
+            if run is not None:
+                run.log({'val_metric': float(metric)})
+            print(f"Validation metric after epoch {epoch + 1}: {float(metric):.3f}")
+            if args.output_model:
+                save(model, optimizer, args.output_model.format(epoch + 1))
+        # every process steps early stopping with the same metric, and stops alike
+        stop = es.step(metric)
+        trainer.end_epoch()
+        if stop:
+            break
+    if run is not None:
+        run.finish()
+    cleanup()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def scaling_worker(rank, world_size, port, args, result_path):
+    # trains args.steps batches per process, after a warm-up pass; the first process reports the throughput
+    os.environ.update({'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port), 'RANK': str(rank),
+                       'WORLD_SIZE': str(world_size)})
+    init_distributed(args.backend)
+    model, optimizer, train_loader, ddp, _, _ = setup(args, max_samples=args.steps * args.batch_size * world_size)
+    trainer = Trainer(model, optimizer, ddp, 'cpu', accumulation_steps=args.accumulation_steps,
+                      precision=args.precision, log_every=10 ** 9)
+    trainer.train_epoch(train_loader, 0)
+    trainer.end_epoch()
+    trainer.take_throughput()
+    barrier()
+    start = time.perf_counter()
+    trainer.train_epoch(train_loader, 1)
+    barrier()
+    elapsed = time.perf_counter() - start
+    samples, tokens = all_reduce_sum([trainer.throughput['samples'], trainer.throughput['tokens']])
+    if rank == 0:
+        with open(result_path, 'w') as f:
+            json.dump({'samples_per_s': samples / elapsed, 'tokens_per_s': tokens / elapsed}, f)
+    cleanup()
+
+
+def scaling(args):
+    # throughput with each number of processes, and its efficiency against perfect scaling from the first one
+    print('processes, threads per process, samples/s, tokens/s, speedup, efficiency')
+    base = None
+    for world_size in args.world_sizes:
+        if args.threads_per_process:
+            args.threads = args.threads_per_process
+        else:
+            # the cores of the machine shared by the processes
+            args.threads = max(1, (os.cpu_count() or 1) // world_size)
+        with tempfile.TemporaryDirectory() as tmp:
+            result_path = os.path.join(tmp, 'result.json')
+            mp.spawn(scaling_worker, args=(world_size, free_port(), args, result_path), nprocs=world_size)
+            with open(result_path, 'r') as f:
+                result = json.load(f)
+        if base is None:
+            base = (world_size, result['samples_per_s'])
+        speedup = result['samples_per_s'] / base[1]
+        print('{}, {}, {:.2f}, {:.0f}, {:.2f}, {:.1%}'.format(world_size, args.threads, result['samples_per_s'],
+                                                              result['tokens_per_s'], speedup,
+                                                              speedup * base[0] / world_size))
+
+
+def add_training_arguments(parser):
+    parser.add_argument('task', choices=TASKS)
+    parser.add_argument('--model-name', default='google/pegasus-large')
+    parser.add_argument('--input-model', help='checkpoint saved by save() in the notebooks, to continue training')
+    parser.add_argument('--train-data', help='by default the dataset of the task in ./data')
+    parser.add_argument('--val-data')
+    parser.add_argument('--batch-size', type=int, default=2, help='per process')
+    parser.add_argument('--accumulation-steps', type=int, default=1)
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'])
+    parser.add_argument('--mining', choices=['hardest', 'semi-hard'], help='in-batch negatives of the triplet loss')
+    parser.add_argument('--full-model', action='store_true', help='triplet loss through the whole model, not the encoder')
+    parser.add_argument('--scorer-model-type', help='BERTScore model of the fine-tuning validation')
+    parser.add_argument('--scorer-num-layers', type=int)
+    parser.add_argument('--scorer-baseline-path')
+    parser.add_argument('--threads', type=int, help='CPU threads of each process')
+    parser.add_argument('--backend', default='gloo')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='data-parallel training of Pegasus on CPU processes')
+    subparsers = parser.add_subparsers(dest='command')
+
+    scaling_parser = subparsers.add_parser('scaling', help='throughput with 1, 2, ... processes on this machine')
+    add_training_arguments(scaling_parser)
+    scaling_parser.add_argument('--world-sizes', type=int, nargs='+', default=[1, 2, 4])
+    scaling_parser.add_argument('--steps', type=int, default=20, help='batches per process')
+    scaling_parser.add_argument('--threads-per-process', type=int,
+                                help='by default the cores of the machine divided by the processes')
+
+    if argv is None:
+        import sys
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'scaling':
+        args = parser.parse_args(argv)
+        scaling(args)
+        return
+
+    # torchrun ... train_ddp.py <task> [options]
+    train_parser = argparse.ArgumentParser(description='data-parallel training of Pegasus on CPU processes')
+    add_training_arguments(train_parser)
+    train_parser.add_argument('--epochs', type=int, default=10)
+    train_parser.add_argument('--es-patience', type=int, default=5, help='0 to never stop early')
+    train_parser.add_argument('--output-model', help="i.e. './model_maskedSent/maskedSent_{}_epoch.pth'")
+    train_parser.add_argument('--checkpoint', help='path of the checkpoint written while training, and resumed from')
+    train_parser.add_argument('--checkpoint-every', type=int, default=500, help='optimizer steps')
+    train_parser.add_argument('--resume', action='store_true')
+    train_parser.add_argument('--log-every', type=int, default=25, help='batches')
+    train_parser.add_argument('--wandb-project')
+    train_parser.add_argument('--wandb-entity')
+    train(train_parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
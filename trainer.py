@@ -0,0 +1,308 @@
+import contextlib
+import math
+import os
+import random
+import time
+
+import numpy as np
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+from distributed import all_reduce_sum, gather_object, get_rank, get_world_size, is_main_process
+
+# The training loop shared by Pegasus.ipynb, Pegasus_TML.ipynb and Pegasus_Finetuned_and_Automatic_Evaluation.ipynb:
+# - gradients of accumulation_steps batches are summed before each optimizer step, so the effective batch is
+#   accumulation_steps x batch_size at the memory of one batch
+# - the forward pass runs under bf16 autocast (precision='bf16'), on CPU as on GPU
+# - a checkpoint of the model, the optimizer (Adafactor), the early stopping and the random generators is written
+#   every checkpoint_every optimizer steps and at the end of each epoch; load_checkpoint() resumes from it on the
+#   same batch, with the same shuffle and dropout, as if the run had never stopped
+# - samples/s and tokens/s (non-padding input tokens) are logged with the loss
+# - in data-parallel training (train_ddp.py), loss_fn is the DistributedDataParallel module: gradients are only
+#   averaged across processes on the batch of an optimizer step, loss and throughput are summed over all processes
+#   for the log, and only the first process logs and writes checkpoints
+
+
+class EarlyStopping(object):
+    def __init__(self, mode='min', min_delta=0, patience=10, percentage=False):
+        self.mode = mode
+        self.min_delta = min_delta
+        self.patience = patience
+        self.best = None
+        self.num_bad_epochs = 0
+        self.is_better = None
+        self._init_is_better(mode, min_delta, percentage)
+
+        if patience == 0:
+            self.is_better = lambda a, b: True
+            self.step = lambda a: False
+
+    def step(self, metrics):
+        if self.best is None:
+            self.best = metrics
+            return False
+
+        if torch.isnan(metrics):
+            return True
+
+        if self.is_better(metrics, self.best):
+            self.num_bad_epochs = 0
+            self.best = metrics
+        else:
+            self.num_bad_epochs += 1
+
+        if self.num_bad_epochs >= self.patience:
+            return True
+
+        return False
+
+    def state_dict(self):
+        return {'best': self.best, 'num_bad_epochs': self.num_bad_epochs}
+
+    def load_state_dict(self, state):
+        self.best = state['best']
+        self.num_bad_epochs = state['num_bad_epochs']
+
+    def _init_is_better(self, mode, min_delta, percentage):
+        if mode not in {'min', 'max'}:
+            raise ValueError('mode ' + mode + ' is unknown!')
+        if not percentage:
+            if mode == 'min':
+                self.is_better = lambda a, best: a < best - min_delta
+            if mode == 'max':
+                self.is_better = lambda a, best: a > best + min_delta
+        else:
+            if mode == 'min':
+                self.is_better = lambda a, best: a < best - (
+                            best * min_delta / 100)
+            if mode == 'max':
+                self.is_better = lambda a, best: a > best + (
+                            best * min_delta / 100)
+
+
+def save(model, optimizer, output_model):
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict()
+    }, output_model)
+
+
+def load(model, optimizer, output_model):
+    checkpoint = torch.load(output_model)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+
+
+def to_device(batch, device):
+    # a batch of the data loaders of data_module.py: a dict of tensors, or a tuple of them (triplets)
+    if isinstance(batch, dict):
+        return {k: v.to(device) for k, v in batch.items()}
+    return tuple(to_device(x, device) for x in batch)
+
+
+def batch_size_and_tokens(batch):
+    # samples and non-padding input tokens of a batch; a triplet is one sample of three sentences
+    if isinstance(batch, dict):
+        return batch['input_ids'].size(0), int(batch['attention_mask'].sum())
+    sizes = [batch_size_and_tokens(x) for x in batch]
+    return sizes[0][0], sum(tokens for _, tokens in sizes)
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Trainer(object):
+    # loss_fn(batch) returns the loss of a batch moved to device, i.e. lambda batch: model(**batch).loss, or the
+    # PegasusTMLModel of the triplet loss; model is the module whose weights are trained and checkpointed (not
+    # wrapped in DistributedDataParallel)
+    def __init__(self, model, optimizer, loss_fn, device, accumulation_steps=1, precision='fp32',
+                 log_fn=None, log_every=25, progress_bar=None, checkpoint_path=None, checkpoint_every=None,
+                 early_stopping=None):
+        if precision not in ['fp32', 'bf16']:
+            raise ValueError('precision ' + precision + ' is unknown!')
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_fn = loss_fn
+        self.device = torch.device(device)
+        self.accumulation_steps = accumulation_steps
+        self.precision = precision
+        # log_fn(loss, batch_num, epoch, throughput), called every log_every batches with the mean loss
+        self.log_fn = log_fn
+        self.log_every = log_every
+        self.progress_bar = progress_bar
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.early_stopping = early_stopping
+        # position in training: the epoch, the batches of it done, all batches and optimizer steps done
+        self.epoch = 0
+        self.batch_in_epoch = 0
+        self.batch_ct = 0
+        self.optimizer_steps = 0
+        self.running_loss = 0.
+        # the random state at the start of the epoch, i.e. the one its shuffle was drawn from
+        self.epoch_rng_state = None
+        self.resume_rng_state = None
+        self.throughput = {'samples': 0, 'tokens': 0, 'seconds': 0.}
+
+    def steps_per_epoch(self, loader):
+        return math.ceil(len(loader) / self.accumulation_steps)
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.precision == 'bf16')
+
+    def train_epoch(self, loader, epoch):
+        # trains on the batches of the epoch, from where a resumed checkpoint left it; returns the mean loss
+        self.model.train()
+        batch_sampler = getattr(loader, 'batch_sampler', None)
+        if hasattr(batch_sampler, 'set_epoch'):
+            batch_sampler.set_epoch(epoch)
+        if self.epoch_rng_state is not None and self.batch_in_epoch:
+            # resumed within the epoch: draw the same shuffle again, skip the batches done, then continue with
+            # the random state of the checkpoint
+            set_rng_state(self.epoch_rng_state)
+        else:
+            self.epoch = epoch
+            self.batch_in_epoch = 0
+            self.epoch_rng_state = rng_state()
+        skip = self.batch_in_epoch
+        epoch_loss = 0.
+        n_batches = 0
+        self.optimizer.zero_grad()
+        start = time.perf_counter()
+        for idx, batch in enumerate(loader):
+            if idx < skip:
+                continue
+            if idx == skip:
+                start = time.perf_counter()
+                if self.resume_rng_state is not None:
+                    set_rng_state(self.resume_rng_state)
+                    self.resume_rng_state = None
+            samples, tokens = batch_size_and_tokens(batch)
+            batch = to_device(batch, self.device)
+            step = (idx + 1) % self.accumulation_steps == 0 or idx + 1 == len(loader)
+            with self.sync(step):
+                # forward pass
+                with self.autocast():
+                    loss = self.loss_fn(batch)
+                # backward pass, the gradients of the batches of one optimizer step are summed
+                (loss / self.accumulation_steps).backward()
+            self.batch_in_epoch = idx + 1
+            self.batch_ct += 1
+            loss = loss.item()
+            epoch_loss += loss
+            n_batches += 1
+            self.running_loss += loss
+            self.throughput['samples'] += samples
+            self.throughput['tokens'] += tokens
+            # step with optimizer every accumulation_steps batches, and on the last batch of the epoch
+            if step:
+                self.optimizer.step()
+                self.optimizer.zero_grad()
+                self.optimizer_steps += 1
+                if self.progress_bar is not None:
+                    self.progress_bar.update(1)
+                if self.checkpoint_every and self.optimizer_steps % self.checkpoint_every == 0:
+                    self.save_checkpoint()
+
+            # report metrics every log_every batches
+            if self.batch_ct % self.log_every == 0:
+                self.throughput['seconds'] += time.perf_counter() - start
+                start = time.perf_counter()
+                # the loss of the batches of all processes, and their throughput together
+                running_loss, samples, tokens = all_reduce_sum(
+                    [self.running_loss, self.throughput['samples'], self.throughput['tokens']])
+                self.throughput['samples'] = samples
+                self.throughput['tokens'] = tokens
+                throughput = self.take_throughput()
+                if self.log_fn is not None and is_main_process():
+                    self.log_fn(running_loss / (self.log_every * get_world_size()), self.batch_ct, epoch, throughput)
+                self.running_loss = 0.
+        self.throughput['seconds'] += time.perf_counter() - start
+        if self.resume_rng_state is not None:
+            # resumed from a checkpoint taken on the last batch of the epoch
+            set_rng_state(self.resume_rng_state)
+            self.resume_rng_state = None
+        return epoch_loss / max(n_batches, 1)
+
+    def sync(self, step):
+        # gradients are averaged across processes in the backward pass of the last batch of an optimizer step only
+        if isinstance(self.loss_fn, DistributedDataParallel) and not step:
+            return self.loss_fn.no_sync()
+        return contextlib.nullcontext()
+
+    def take_throughput(self):
+        # samples/s and tokens/s since the last call
+        seconds = max(self.throughput['seconds'], 1e-9)
+        throughput = {'samples_per_s': self.throughput['samples'] / seconds,
+                      'tokens_per_s': self.throughput['tokens'] / seconds}
+        self.throughput = {'samples': 0, 'tokens': 0, 'seconds': 0.}
+        return throughput
+
+    def end_epoch(self):
+        # to be called once the epoch is validated (and early stopping stepped): the next epoch starts
+        self.epoch += 1
+        self.batch_in_epoch = 0
+        self.epoch_rng_state = None
+        self.save_checkpoint()
+
+    def state_dict(self):
+        # the random states and running loss of every process, by rank
+        return {'epoch': self.epoch, 'batch_in_epoch': self.batch_in_epoch, 'batch_ct': self.batch_ct,
+                'optimizer_steps': self.optimizer_steps,
+                'processes': gather_object({'running_loss': self.running_loss, 'rng_state': rng_state(),
+                                            'epoch_rng_state': self.epoch_rng_state}),
+                'early_stopping': self.early_stopping.state_dict() if self.early_stopping is not None else None}
+
+    def save_checkpoint(self, path=None):
+        # written to a temporary file first, so an interrupted save never replaces the last checkpoint;
+        # called by all processes, written by the first one
+        path = path or self.checkpoint_path
+        if not path:
+            return
+        state = self.state_dict()
+        if not is_main_process():
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        torch.save({'model_state_dict': self.model.state_dict(),
+                    'optimizer_state_dict': self.optimizer.state_dict(),
+                    'trainer_state': state}, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def load_checkpoint(self, path=None):
+        # resumes from a checkpoint of save_checkpoint(); returns the epoch to continue with
+        path = path or self.checkpoint_path
+        checkpoint = torch.load(path, map_location=self.device, weights_only=False)
+        self.model.load_state_dict(checkpoint['model_state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        state = checkpoint['trainer_state']
+        self.epoch = state['epoch']
+        self.batch_in_epoch = state['batch_in_epoch']
+        self.batch_ct = state['batch_ct']
+        self.optimizer_steps = state['optimizer_steps']
+        # the state of the same rank, or of the first process when resuming with another number of processes
+        processes = state['processes']
+        process = processes[get_rank()] if len(processes) == get_world_size() else processes[0]
+        self.running_loss = process['running_loss']
+        self.epoch_rng_state = process['epoch_rng_state']
+        if self.early_stopping is not None and state['early_stopping'] is not None:
+            self.early_stopping.load_state_dict(state['early_stopping'])
+        if self.batch_in_epoch:
+            # restored once the batches done are skipped, see train_epoch
+            self.resume_rng_state = process['rng_state']
+        else:
+            set_rng_state(process['rng_state'])
+        return self.epoch